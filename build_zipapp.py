@@ -0,0 +1,34 @@
+#!/usr/bin/python3
+"""
+Builds passager into a single zipapp file runnable with "python3 passager.pyz".
+The accounts directory and byte code caches are left out; when run from the
+zipapp the accounts are kept under ~/.local/share/passager/accounts/.
+"""
+import argparse
+import os
+import zipapp
+
+_EXCLUDED_DIRS = ("accounts", "__pycache__")
+
+
+def _included(path) -> bool:
+    return not any(part in _EXCLUDED_DIRS for part in path.parts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build passager into a zipapp")
+    parser.add_argument("target", nargs="?", default="passager.pyz", help="the file to write")
+    args = parser.parse_args()
+
+    source = os.path.join(os.path.dirname(os.path.realpath(__file__)), "passager")
+    # The package itself has to be inside the archive for "import passager" to work
+    zipapp.create_archive(os.path.dirname(source),
+                          args.target,
+                          interpreter="/usr/bin/env python3",
+                          main="passager.main:run",
+                          filter=lambda path: path.parts[0] == "passager" and _included(path))
+    print("Wrote {}".format(args.target))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+#!/usr/bin/python3
+
+import passager.main
+
+passager.main.run()
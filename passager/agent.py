@@ -0,0 +1,268 @@
+#!/bin/python3
+"""
+Agent module keeps a main account unlocked in a long running process, much like
+ssh-agent does with keys. Thin clients talk to it over a Unix domain socket
+that only the same user may connect to, one JSON object per line:
+    {"command": "get", "service": "..."}
+    {"command": "add", "service": "...", "username": "...", "password": "..."}
+    {"command": "remove", "service": "..."}
+    {"command": "list"}
+    {"command": "lock"}
+Every answer has "ok" and, on failure, "error". The agent locks itself, i.e.
+forgets the main account and exits, after being idle for a while.
+
+The socket is in a directory only the user may enter, under $XDG_RUNTIME_DIR if
+it's set. The agent refuses to listen in a directory someone else owns or may
+enter, and clients refuse to talk to an agent run by someone else.
+"""
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import struct
+import tempfile
+import time
+
+from typing import TYPE_CHECKING, Dict, Optional
+
+from passager.lazy import lazy_import
+
+if TYPE_CHECKING:
+    from passager.data_formats import MainAccount
+
+# Only the agent itself needs these, not the thin clients
+data_formats = lazy_import("passager.data_formats")
+importer = lazy_import("passager.importer")
+sealed = lazy_import("passager.sealed")
+storage = lazy_import("passager.storage")
+
+DEFAULT_IDLE_TIMEOUT = 900
+SOCKET_ENVIRONMENT_VARIABLE = "PASSAGER_AGENT_SOCKET"
+
+# How often the agent wakes up to check whether it has been idle for too long
+_POLL_INTERVAL = 1.0
+# Clients hogging the single connection slot are dropped after this
+_CLIENT_TIMEOUT = 5.0
+_PEER_CREDENTIALS = struct.Struct("3i")
+
+_logger = logging.getLogger(__name__)
+
+
+class Agent:
+    def __init__(self, main_account: "MainAccount", idle_timeout: float = DEFAULT_IDLE_TIMEOUT):
+        self.main_account = main_account
+        self.idle_timeout = idle_timeout
+        self._last_used = time.monotonic()
+
+    def answer(self, request: Dict) -> Dict:
+        self._last_used = time.monotonic()
+        if self.main_account is None:
+            return _failure("the agent is locked")
+        storage.refresh_service_accounts(self.main_account)
+
+        command = request.get("command")
+        if command == "get":
+            return self._get(request)
+        if command == "add":
+            return self._add(request)
+        if command == "remove":
+            return self._remove(request)
+        if command == "list":
+            return {"ok": True, "services": list(self.main_account.service_names())}
+        if command == "lock":
+            self.lock()
+            return {"ok": True}
+        return _failure("unknown command {}".format(command))
+
+    def idle_too_long(self) -> bool:
+        return time.monotonic() - self._last_used > self.idle_timeout
+
+    def is_locked(self) -> bool:
+        return self.main_account is None
+
+    def lock(self):
+        _logger.info("Locking the agent")
+        if self.main_account is not None:
+            storage.unwatch_service_accounts(self.main_account)
+        self.main_account = None
+        sealed.wipe()
+
+    def _add(self, request: Dict) -> Dict:
+        fields = {field: request.get(field) for field in ("service", "username", "password")}
+        if None in fields.values():
+            return _failure("service, username and password are required")
+        reason = importer.rejection_reason(self.main_account, fields)
+        if reason is not None:
+            return _failure(reason)
+
+        service = data_formats.ServiceAccount(fields["service"], fields["username"], fields["password"])
+        service.change_filename(storage.store_service_account(self.main_account, service))
+        self.main_account.add_service_account(service)
+        return {"ok": True}
+
+    def _get(self, request: Dict) -> Dict:
+        service = self.main_account.service_account_by_name(request.get("service"))
+        if service is None:
+            return _failure("no service account for {}".format(request.get("service")))
+        return {"ok": True, "username": service.account_name, "password": service.service_password}
+
+    def _remove(self, request: Dict) -> Dict:
+        service = self.main_account.service_account_by_name(request.get("service"))
+        if service is None:
+            return _failure("no service account for {}".format(request.get("service")))
+        if not storage.delete_service_account(service.filename, self.main_account):
+            return _failure("the service account couldn't be removed")
+        self.main_account.remove_service_account(service.service_name)
+        return {"ok": True}
+
+
+class _AgentServer(socketserver.UnixStreamServer):
+    # Requests are handled one at a time so the main account needs no locking
+    def __init__(self, socket_path: str, agent: Agent):
+        self.agent = agent
+        super().__init__(socket_path, _AgentRequestHandler)
+        self.timeout = _POLL_INTERVAL
+
+
+class _AgentRequestHandler(socketserver.StreamRequestHandler):
+    timeout = _CLIENT_TIMEOUT
+
+    def handle(self):
+        if not same_user(self.request):
+            _logger.warning("Refused a connection from another user")
+            return
+        try:
+            for line in self.rfile:
+                self.wfile.write(json.dumps(self._answer(line)).encode("utf-8") + b"\n")
+                if self.server.agent.is_locked():
+                    return
+        except (socket.timeout, ConnectionError):
+            _logger.info("Dropped a client that stopped talking")
+
+    def _answer(self, line: bytes) -> Dict:
+        try:
+            request = json.loads(line)
+        except ValueError:
+            request = None
+        if not isinstance(request, dict):
+            return _failure("requests must be JSON objects")
+        return self.server.agent.answer(request)
+
+
+def connect(socket_path: str, timeout: float) -> socket.socket:
+    """Connects to the server listening on the socket. Raises PermissionError if
+    another user runs it and OSError if no one is listening.
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.settimeout(timeout)
+        connection.connect(socket_path)
+        if not same_user(connection):
+            raise PermissionError("{} is served by another user".format(socket_path))
+    except BaseException:
+        connection.close()
+        raise
+    return connection
+
+
+def default_socket_path() -> str:
+    path = os.environ.get(SOCKET_ENVIRONMENT_VARIABLE)
+    if path:
+        return path
+    return os.path.join(socket_directory(), "agent.sock")
+
+
+def _failure(error: str) -> Dict:
+    return {"ok": False, "error": error}
+
+
+def prepare_socket_directory(socket_path: str):
+    """Creates the socket's directory if needed. Raises PermissionError unless
+    the directory is the user's own and no one else may enter it, as anyone who
+    may could replace the socket with their own.
+    """
+    directory = os.path.dirname(socket_path)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    status = os.lstat(directory)
+    if (not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid() or
+            stat.S_IMODE(status.st_mode) != 0o700):
+        raise PermissionError("{} must be a directory of your own with the mode 0700".format(directory))
+
+
+def _prepare_socket_path(socket_path: str) -> Optional[str]:
+    # Returns the error if the agent can't listen on the path
+    try:
+        prepare_socket_directory(socket_path)
+    except OSError as e:
+        return str(e)
+    if os.path.exists(socket_path):
+        try:
+            request("list", socket_path)
+            return "another agent is already listening on {}".format(socket_path)
+        except OSError:
+            # Left behind by an agent that didn't exit cleanly
+            os.remove(socket_path)
+    return None
+
+
+def request(command: str, socket_path: str = None, **fields) -> Dict:
+    """Sends a request to a running agent and returns its answer. Raises OSError
+    if no agent is listening and PermissionError if another user runs it.
+    """
+    with connect(socket_path or default_socket_path(), _CLIENT_TIMEOUT) as connection:
+        fields["command"] = command
+        connection.sendall(json.dumps(fields).encode("utf-8") + b"\n")
+        with connection.makefile("rb") as answers:
+            answer = answers.readline()
+    if answer == b"":
+        raise ConnectionError("The agent closed the connection")
+    return json.loads(answer)
+
+
+def same_user(connection: socket.socket) -> bool:
+    # Whether the process at the other end of the connection is the user's
+    if not hasattr(socket, "SO_PEERCRED"):
+        # The socket's directory being private to the user has to do
+        return True
+    credentials = connection.getsockopt(socket.SOL_SOCKET,
+                                        socket.SO_PEERCRED,
+                                        _PEER_CREDENTIALS.size)
+    _, uid, _ = _PEER_CREDENTIALS.unpack(credentials)
+    return uid == os.getuid()
+
+
+def serve(agent: Agent, socket_path: str = None) -> Optional[str]:
+    """Answers requests until the agent is locked or has been idle for too long.
+    Returns None when done or the error that prevented serving.
+    """
+    socket_path = socket_path or default_socket_path()
+    error = _prepare_socket_path(socket_path)
+    if error is not None:
+        return error
+
+    previous_umask = os.umask(0o177)
+    try:
+        server = _AgentServer(socket_path, agent)
+    finally:
+        os.umask(previous_umask)
+    _logger.info("Agent listening on %s", socket_path)
+    try:
+        with server:
+            while not agent.is_locked():
+                server.handle_request()
+                sealed.expire()
+                if agent.idle_too_long():
+                    agent.lock()
+    finally:
+        os.remove(socket_path)
+    return None
+
+
+def socket_directory() -> str:
+    # The user's runtime directory is private already, the temporary one isn't
+    runtime_directory = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_directory:
+        return os.path.join(runtime_directory, "passager")
+    return os.path.join(tempfile.gettempdir(), "passager-{}".format(os.getuid()))
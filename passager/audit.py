@@ -0,0 +1,144 @@
+#!/bin/python3
+"""
+Audit module goes through every password of a main account at once: how strong
+each one is, whether it's known from breaches and whether it's reused, as such
+or with small changes, by other service accounts.
+
+Reuse is found by bucketing the passwords by a keyed hash instead of comparing
+every pair. Near duplicates are bucketed by
+    - a normalized form: lowercase, common character substitutions undone and
+      the digits and symbols at the end dropped, e.g. "Summer2023!" and
+      "summ3r2024" both become "summer"
+    - the password and every form of it with one character deleted, as two
+      passwords within one edit of each other always share one of those
+so the work grows with the number of passwords times their length. The key is
+random and made for each audit, so the buckets say nothing about the passwords
+once the audit is over.
+"""
+import hashlib
+import hmac
+import logging
+import os
+import re
+
+from typing import Iterable, List, Sequence, Set
+
+import passager.breach as breach
+import passager.data_formats as data_formats
+import passager.profiling as profiling
+
+from passager.data_formats import MainAccount
+
+# Risk weights of the problems, the report is ranked by their sum
+_BREACHED_RISK = 10
+_REUSED_RISK = 6
+_SIMILAR_RISK = 3
+# The best score of data_formats.check_password_strength
+_STRONGEST = 5
+# Passwords shorter than this have too many neighbours one edit away to be
+# told apart from coincidence
+_SIMILAR_MIN_LENGTH = 8
+_SUBSTITUTIONS = str.maketrans("0134579@$!|", "oleastgasil")
+_TRAILING_NOISE = re.compile(r"[^a-z]+$")
+
+_logger = logging.getLogger(__name__)
+
+
+class Entry:
+    def __init__(self, service_name: str, strength: int, times_breached: int):
+        self.service_name = service_name
+        self.strength = strength
+        self.times_breached = times_breached
+        # The other services with the same password
+        self.reused_with = []
+        # The other services with a password only slightly different
+        self.similar_to = []
+
+    def risk(self) -> int:
+        risk = _STRONGEST - self.strength
+        if self.times_breached > 0:
+            risk += _BREACHED_RISK
+        if len(self.reused_with) != 0:
+            risk += _REUSED_RISK
+        if len(self.similar_to) != 0:
+            risk += _SIMILAR_RISK
+        return risk
+
+
+class Report:
+    def __init__(self, entries: List[Entry]):
+        # The riskiest first
+        self.entries = sorted(entries, key=lambda entry: (-entry.risk(), entry.service_name))
+
+    def breached_count(self) -> int:
+        return sum(1 for entry in self.entries if entry.times_breached > 0)
+
+    def reused_count(self) -> int:
+        return sum(1 for entry in self.entries if len(entry.reused_with) != 0)
+
+    def similar_count(self) -> int:
+        return sum(1 for entry in self.entries if len(entry.similar_to) != 0)
+
+
+def audit(main_account: MainAccount) -> Report:
+    with profiling.timed("audit"):
+        names = []
+        passwords = []
+        # Lazily loaded credentials are decrypted here, each file once
+        for service in main_account.service_accounts:
+            names.append(service.service_name)
+            passwords.append(service.service_password)
+
+        entries = [Entry(name, strength, times_breached)
+                   for name, strength, times_breached in zip(names,
+                                                             _strengths(passwords),
+                                                             map(breach.times_breached, passwords))]
+
+        key = os.urandom(32)
+        reused = _groups(key, ([password] for password in passwords))
+        similar = _groups(key, map(_similarity_forms, passwords))
+        for index, entry in enumerate(entries):
+            entry.reused_with = [names[other] for other in sorted(reused[index])]
+            entry.similar_to = [names[other] for other in sorted(similar[index] - reused[index])]
+    _logger.info("Audited %s service accounts", len(entries))
+    return Report(entries)
+
+
+def _groups(key: bytes, forms_of_passwords: Iterable[Sequence[str]]) -> List[Set[int]]:
+    # Returns for every password the others sharing at least one of its forms
+    buckets = {}
+    form_digests = []
+    for index, forms in enumerate(forms_of_passwords):
+        digests = {hmac.new(key, form.encode("utf-8"), hashlib.sha256).digest() for form in forms}
+        for digest in digests:
+            buckets.setdefault(digest, []).append(index)
+        form_digests.append(digests)
+
+    groups = []
+    for index, digests in enumerate(form_digests):
+        group = set()
+        for digest in digests:
+            bucket = buckets[digest]
+            if len(bucket) > 1:
+                group.update(bucket)
+        group.discard(index)
+        groups.append(group)
+    return groups
+
+
+def _similarity_forms(password: str) -> List[str]:
+    # Prefixed so that the two kinds of forms never match each other
+    forms = []
+    normalized = _TRAILING_NOISE.sub("", password.lower()).translate(_SUBSTITUTIONS)
+    if len(normalized) >= _SIMILAR_MIN_LENGTH // 2:
+        # Shorter ones are little more than the noise, e.g. all digits
+        forms.append("n" + normalized)
+    if len(password) >= _SIMILAR_MIN_LENGTH:
+        forms.append("d" + password)
+        forms.extend("d" + password[:position] + password[position + 1:]
+                     for position in range(len(password)))
+    return forms
+
+
+def _strengths(passwords: Sequence[str]) -> List[int]:
+    return [data_formats.check_password_strength(password) for password in passwords]
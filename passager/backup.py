@@ -0,0 +1,257 @@
+#!/bin/python3
+"""
+Backup module keeps point-in-time copies of the accounts directory in a backup
+directory that stores every distinct file only once:
+    objects/<first 2 characters>/<SHA-256 in hex>: the contents of a file
+    snapshots/<UTC time>.json: the path, hash, size and modification time of
+        every file in the accounts directory at the time
+The account files are encrypted already, so they're copied as they are. A
+backup only hashes the files whose size or modification time differs from the
+previous snapshot and only copies contents the backup doesn't have yet, so it
+takes time in proportion to what changed since. The snapshot is written last;
+an interrupted backup leaves at most some unreferenced objects behind.
+
+Restoring writes back only the files that differ from the snapshot and removes
+the ones it doesn't have. An interrupted restore can be run again.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import passager.layout as layout
+import passager.locking as locking
+
+_CHUNK_SIZE = 64 * 1024
+# Left out: locks, the crash journal, which is recovered before backing up, the
+# sync state, which has to see a restore as local changes, and the breach list,
+# which can be built again and is large
+_EXCLUDED_DIRS = (".journal", ".locks", ".sync")
+_EXCLUDED_FILES = ("breached-passwords.bin", )
+_OBJECT_DIR = "objects"
+_SNAPSHOT_DIR = "snapshots"
+_SNAPSHOT_FILE_EXT = ".json"
+_SNAPSHOT_VERSION = 1
+_TEMPORARY_FILE_EXT = ".tmp"
+
+_logger = logging.getLogger(__name__)
+
+
+class BackupResult:
+    def __init__(self, snapshot: "Snapshot"):
+        self.snapshot = snapshot
+        self.hashed_count = 0
+        self.copied_count = 0
+        self.copied_bytes = 0
+
+
+class Snapshot:
+    def __init__(self, name: str, created: float, files: Dict[str, List]):
+        self.name = name
+        # Seconds since the epoch
+        self.created = created
+        # Path relative to the accounts directory -> [hash, size, modification time in ns]
+        self.files = files
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self.files.values())
+
+
+def backup(backup_directory: str) -> BackupResult:
+    """Takes a snapshot of the accounts directory. Raises OSError if the backup
+    directory can't be written.
+    """
+    accounts_directory = layout.accounts_directory()
+    previous = latest_snapshot(backup_directory)
+    previous_files = previous.files if previous is not None else {}
+    created = time.time()
+    result = BackupResult(Snapshot(_snapshot_name(created), created, {}))
+
+    # No account may be written while the files are copied
+    with locking.all_accounts(accounts_directory, layout.main_account_names()):
+        for relative_path, stat in _account_files(accounts_directory):
+            known = previous_files.get(relative_path)
+            if (known is not None and known[1:] == [stat.st_size, stat.st_mtime_ns] and
+                    os.path.exists(_object_path(backup_directory, known[0]))):
+                result.snapshot.files[relative_path] = known
+                continue
+            file_hash, copied_bytes = _store_object(backup_directory,
+                                                    os.path.join(accounts_directory, relative_path))
+            result.hashed_count += 1
+            if copied_bytes is not None:
+                result.copied_count += 1
+                result.copied_bytes += copied_bytes
+            result.snapshot.files[relative_path] = [file_hash, stat.st_size, stat.st_mtime_ns]
+
+    _write_snapshot(backup_directory, result.snapshot)
+    _logger.info("Backed up %s files into %s, %s of them copied",
+                 len(result.snapshot.files), backup_directory, result.copied_count)
+    return result
+
+
+def _account_files(accounts_directory: str) -> Iterator[Tuple[str, os.stat_result]]:
+    # Yields the path relative to the accounts directory and the stat of every file backed up
+    for directory, subdirectories, filenames in os.walk(accounts_directory):
+        if directory == accounts_directory:
+            subdirectories[:] = [name for name in subdirectories if name not in _EXCLUDED_DIRS]
+        for filename in filenames:
+            if filename.endswith(_TEMPORARY_FILE_EXT) or filename in _EXCLUDED_FILES:
+                continue
+            path = os.path.join(directory, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            yield os.path.relpath(path, accounts_directory).replace(os.sep, "/"), stat
+
+
+def _copy(source_path: str, target_path: str) -> Tuple[str, int]:
+    # Hashes the contents on the way. Returns the hash and the bytes copied.
+    file_hash = hashlib.sha256()
+    copied_bytes = 0
+    with open(source_path, "rb") as source, open(target_path, "wb") as target:
+        for chunk in iter(lambda: source.read(_CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+            target.write(chunk)
+            copied_bytes += len(chunk)
+        target.flush()
+        os.fsync(target.fileno())
+    return file_hash.hexdigest(), copied_bytes
+
+
+def latest_snapshot(backup_directory: str, before: float = None) -> Optional[Snapshot]:
+    # The newest snapshot, or the newest taken at or before the given time
+    for snapshot in reversed(snapshots(backup_directory)):
+        if before is None or snapshot.created <= before:
+            return snapshot
+    return None
+
+
+def _object_path(backup_directory: str, file_hash: str) -> str:
+    return os.path.join(backup_directory, _OBJECT_DIR, file_hash[:2], file_hash)
+
+
+def restore(backup_directory: str, snapshot: Snapshot) -> Tuple[int, int]:
+    """Makes the accounts directory what it was when the snapshot was taken.
+    Returns the number of files written and removed. Raises OSError if the
+    files can't be written and ValueError if the backup is corrupt.
+    """
+    accounts_directory = layout.accounts_directory()
+    written = 0
+    removed = 0
+    main_accountnames = list(layout.main_account_names()) + list(_main_accountnames(snapshot))
+    with locking.all_accounts(accounts_directory, main_accountnames, exclusive_lock=True):
+        current = dict(_account_files(accounts_directory))
+        for relative_path, (file_hash, size, mtime) in snapshot.files.items():
+            stat = current.get(relative_path)
+            if stat is not None and (stat.st_size, stat.st_mtime_ns) == (size, mtime):
+                continue
+            _restore_file(_object_path(backup_directory, file_hash),
+                          os.path.join(accounts_directory, relative_path),
+                          file_hash,
+                          mtime)
+            written += 1
+
+        for relative_path in current.keys() - snapshot.files.keys():
+            os.remove(os.path.join(accounts_directory, relative_path))
+            removed += 1
+    _remove_empty_directories(accounts_directory)
+    # The vault config is cached by its modification time, which was set back
+    layout.set_accounts_directory(accounts_directory)
+    _logger.info("Restored snapshot %s: %s files written and %s removed",
+                 snapshot.name, written, removed)
+    return written, removed
+
+
+def _main_accountnames(snapshot: Snapshot) -> Iterator[str]:
+    # The main accounts whose files the snapshot has
+    for relative_path in snapshot.files:
+        filename = relative_path.rsplit("/", 1)[-1]
+        if filename.endswith(layout.MAIN_FILE_EXT):
+            yield filename[:-len(layout.MAIN_FILE_EXT)]
+
+
+def _remove_empty_directories(accounts_directory: str):
+    # Left behind by the removed files, e.g. shard directories
+    for directory, subdirectories, filenames in os.walk(accounts_directory, topdown=False):
+        if directory == accounts_directory or os.path.basename(directory) in _EXCLUDED_DIRS:
+            continue
+        if len(filenames) == 0 and len(os.listdir(directory)) == 0:
+            os.rmdir(directory)
+
+
+def _restore_file(object_path: str, target_path: str, file_hash: str, mtime: int):
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    temp_path = target_path + _TEMPORARY_FILE_EXT
+    if _copy(object_path, temp_path)[0] != file_hash:
+        os.remove(temp_path)
+        raise ValueError("The backup of {} is corrupt".format(target_path))
+    # Lets the next restore tell the file apart from a changed one
+    os.utime(temp_path, ns=(mtime, mtime))
+    os.replace(temp_path, target_path)
+
+
+def _snapshot_name(created: float) -> str:
+    return datetime.datetime.fromtimestamp(created, datetime.timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+
+
+def snapshots(backup_directory: str) -> List[Snapshot]:
+    # Every snapshot in the backup directory, the oldest first
+    snapshot_directory = os.path.join(backup_directory, _SNAPSHOT_DIR)
+    try:
+        filenames = sorted(os.listdir(snapshot_directory))
+    except FileNotFoundError:
+        return []
+    found = []
+    for filename in filenames:
+        if not filename.endswith(_SNAPSHOT_FILE_EXT):
+            continue
+        try:
+            with open(os.path.join(snapshot_directory, filename)) as source:
+                contents = json.load(source)
+            found.append(Snapshot(filename[:-len(_SNAPSHOT_FILE_EXT)],
+                                  contents["created"],
+                                  contents["files"]))
+        except (OSError, ValueError, KeyError) as e:
+            _logger.warning("Snapshot %s couldn't be read: %s", filename, e)
+    return found
+
+
+def _store_object(backup_directory: str, path: str) -> Tuple[str, Optional[int]]:
+    """Returns the hash of the file's contents and the bytes copied, None if the
+    backup had the contents already.
+    """
+    # Copied while hashing so that the file is read only once
+    object_directory = os.path.join(backup_directory, _OBJECT_DIR)
+    os.makedirs(object_directory, exist_ok=True)
+    temp_descriptor, temp_path = tempfile.mkstemp(suffix=_TEMPORARY_FILE_EXT, dir=object_directory)
+    os.close(temp_descriptor)
+    try:
+        file_hash, copied_bytes = _copy(path, temp_path)
+        object_path = _object_path(backup_directory, file_hash)
+        if os.path.exists(object_path):
+            return file_hash, None
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        os.replace(temp_path, object_path)
+        return file_hash, copied_bytes
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def _write_snapshot(backup_directory: str, snapshot: Snapshot):
+    snapshot_directory = os.path.join(backup_directory, _SNAPSHOT_DIR)
+    os.makedirs(snapshot_directory, exist_ok=True)
+    path = os.path.join(snapshot_directory, snapshot.name + _SNAPSHOT_FILE_EXT)
+    temp_path = path + _TEMPORARY_FILE_EXT
+    with open(temp_path, "w") as target:
+        json.dump({"version": _SNAPSHOT_VERSION, "created": snapshot.created, "files": snapshot.files},
+                  target)
+        target.flush()
+        os.fsync(target.fileno())
+    os.replace(temp_path, path)
@@ -0,0 +1,81 @@
+#!/bin/python3
+"""
+Generator module fills an accounts directory with synthetic data for the
+benchmarks: main accounts with a given number of service accounts each, written
+through the storage module like real ones, and orphaned service account files
+that no main account can decrypt, such as those left behind by removed accounts.
+"""
+import logging
+import os
+
+from typing import Dict, List, Tuple
+
+import passager.data_formats as data_formats
+import passager.layout as layout
+import passager.storage as storage
+
+from passager.data_formats import MainAccount, ServiceAccount
+
+# Long enough for a few AES blocks of made up credentials
+_ORPHAN_CONTENTS_LENGTH = 48
+_ORPHAN_NAME_LENGTH = 32
+
+_logger = logging.getLogger(__name__)
+
+
+def generate(directory: str,
+             main_account_count: int,
+             services_per_account: int,
+             orphan_count: int = 0,
+             layout_version: int = layout.LAYOUT_SHARDED,
+             kdf_parameters: Dict = None) -> List[Tuple[str, str]]:
+    """Generates an accounts directory and returns the names and passwords of the
+    main accounts in it. The directory is made the accounts directory in use.
+    """
+    os.makedirs(directory, exist_ok=True)
+    layout.set_accounts_directory(directory)
+    config = layout.vault_config()
+    config["layout"] = layout_version
+    if kdf_parameters is not None:
+        config["kdf"] = kdf_parameters
+    layout.store_vault_config(config)
+
+    credentials = []
+    for account_number in range(main_account_count):
+        username = "bench_{:04}".format(account_number)
+        password = "bench-password-{:04}".format(account_number)
+        main_account = MainAccount(username, password)
+        storage.register_main_account(main_account)
+        storage.store_service_accounts(main_account,
+                                       _service_accounts(account_number, services_per_account))
+        credentials.append((username, password))
+
+    for _ in range(orphan_count):
+        _write_orphan()
+    _logger.info("Generated %s main accounts with %s service accounts each and %s orphans",
+                 main_account_count, services_per_account, orphan_count)
+    return credentials
+
+
+def service_account(account_number: int, service_number: int) -> ServiceAccount:
+    return ServiceAccount("service-{}-{:06}".format(account_number, service_number),
+                          "user{:06}@example.com".format(service_number),
+                          "Synthetic-{:06}-password!".format(service_number))
+
+
+def _service_accounts(account_number: int, count: int):
+    for service_number in range(count):
+        yield service_account(account_number, service_number)
+
+
+def _write_orphan():
+    # Named and sized like a real service account file, which is what makes it
+    # cost a trial decryption when a login scans the directory
+    filename = (data_formats.decode_store(os.urandom(data_formats.IV_LENGTH)) +
+                data_formats.decode_store(os.urandom(_ORPHAN_NAME_LENGTH)) +
+                layout.SERVICE_FILE_EXT)
+    # The last candidate is where files of unknown owners are kept
+    path = layout.service_paths("", filename)[-1]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as target:
+        target.write(os.urandom(_ORPHAN_CONTENTS_LENGTH))
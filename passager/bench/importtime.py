@@ -0,0 +1,87 @@
+#!/bin/python3
+"""
+Importtime module measures how long the CLI spends importing modules before it
+gets to do anything, using the interpreter's own -X importtime report. Only the
+imports done after the interpreter has started count; those of site and the
+encodings are the same for every program.
+"""
+import logging
+import os
+import statistics
+import subprocess
+import sys
+
+from typing import Dict, Optional, Sequence
+
+import passager.agent as agent
+
+# Command lines whose import time is measured and checked against the budget
+COMMANDS = (("--help",), ("get", "example"))
+
+_PACKAGE = "passager"
+_REPORT_PREFIX = "import time:"
+
+_logger = logging.getLogger(__name__)
+
+
+def benchmark_name(arguments: Sequence[str]) -> str:
+    return "import_time[{}]".format(" ".join(arguments))
+
+
+def measure(arguments: Sequence[str], repeat: int = 3) -> Optional[Dict]:
+    """Runs the CLI with the arguments in a fresh interpreter and returns the
+    import time in seconds like the other benchmarks, None if it can't be told.
+    """
+    timings = []
+    for _ in range(repeat):
+        seconds = _import_seconds(arguments)
+        if seconds is None:
+            return None
+        timings.append(seconds)
+    return {
+        "median": statistics.median(timings),
+        "min": min(timings),
+        "max": max(timings),
+        "runs": repeat,
+    }
+
+
+def _import_seconds(arguments: Sequence[str]) -> Optional[float]:
+    package_parent = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    environment = dict(os.environ)
+    # Keeps the get command from reaching an agent that happens to be running
+    environment[agent.SOCKET_ENVIRONMENT_VARIABLE] = os.path.join(package_parent, ".no-agent")
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-m", _PACKAGE] + list(arguments),
+                               cwd=package_parent,
+                               env=environment,
+                               stdin=subprocess.DEVNULL,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE,
+                               universal_newlines=True)
+    seconds = _parse_report(completed.stderr)
+    if seconds is None:
+        _logger.warning("No import time report from %s", " ".join(arguments))
+    return seconds
+
+
+def _parse_report(report: str) -> Optional[float]:
+    # Sums the cumulative times of the top level imports from the package's
+    # first one on. The report lines look like
+    # "import time:  self [us] | cumulative | imported package"
+    total = 0
+    counting = False
+    for line in report.splitlines():
+        if not line.startswith(_REPORT_PREFIX):
+            continue
+        columns = line[len(_REPORT_PREFIX):].split("|")
+        if len(columns) != 3 or not columns[1].strip().isdigit():
+            continue
+        # Indented names were imported by the module on a later line
+        if columns[2].startswith("  "):
+            continue
+        name = columns[2].strip()
+        if name.split(".")[0] == _PACKAGE:
+            counting = True
+        if counting:
+            total += int(columns[1])
+    return total / 1000000 if counting else None
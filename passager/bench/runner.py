@@ -0,0 +1,192 @@
+#!/bin/python3
+"""
+Runner module times the storage hot paths on generated accounts directories of
+several sizes. Every benchmark is repeated and the median kept, as the fastest
+and slowest runs say more about the machine than the code. Results are plain
+JSON so that a run can be saved as a baseline and later runs compared to it.
+"""
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import passager.bench.generator as generator
+import passager.bench.importtime as importtime
+import passager.cipher as cipher
+import passager.data_formats as data_formats
+import passager.layout as layout
+import passager.storage as storage
+
+from passager.data_formats import MainAccount
+
+DEFAULT_SIZES = (100, 1000)
+# Results slower than the baseline by more than this fraction are regressions
+DEFAULT_TOLERANCE = 0.25
+
+# About what a service account file holds
+_CIPHER_PAYLOAD_LENGTH = 64
+_CIPHER_OPERATIONS = 1000
+_MAIN_ACCOUNT_COUNT = 3
+_ORPHANS_PER_SIZE = 0.1
+_RESULTS_VERSION = 1
+_SAMPLE_PASSWORDS = ("password", "Tr0ub4dor&3", "correct horse battery staple",
+                     "x" * 64, "aB3$" * 8)
+_STORED_PER_RUN = 20
+
+_logger = logging.getLogger(__name__)
+
+
+def compare(results: Dict, baseline: Dict,
+            tolerance: float = DEFAULT_TOLERANCE) -> List[Tuple[str, float, float]]:
+    # Returns (benchmark, baseline median, median) of every regression
+    regressions = []
+    for name, result in results["benchmarks"].items():
+        baseline_result = baseline.get("benchmarks", {}).get(name)
+        if baseline_result is None:
+            continue
+        if result["median"] > baseline_result["median"] * (1 + tolerance):
+            regressions.append((name, baseline_result["median"], result["median"]))
+    return regressions
+
+
+def load_results(path: str) -> Dict:
+    with open(path) as source:
+        return json.load(source)
+
+
+def _logged_in(username: str, password: str) -> MainAccount:
+    main_account = storage.validate_main_login(username, password)
+    storage.load_service_accounts(main_account)
+    return main_account
+
+
+def _measure(function: Callable[[], None], repeat: int, operations: int = 1) -> Dict:
+    # Seconds per operation of each run
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) / operations)
+    return {
+        "median": statistics.median(timings),
+        "min": min(timings),
+        "max": max(timings),
+        "runs": repeat,
+    }
+
+
+def _run_ciphers(measured: Callable[..., None]):
+    # Compares the algorithms and backends available on this machine
+    key = os.urandom(32)
+    payload = os.urandom(_CIPHER_PAYLOAD_LENGTH)
+    for algorithm, backend in cipher.available():
+        name = "{}/{}".format(algorithm, backend)
+        keyed = cipher.keyed(algorithm, key, backend)
+        other_keyed = cipher.keyed(algorithm, os.urandom(32), backend)
+        nonce = os.urandom(keyed.nonce_length)
+        ciphertext = keyed.encrypt(nonce, payload)
+        # Of unauthenticated files only the first block is tried with a wrong key
+        rejected = ciphertext if keyed.authenticated else ciphertext[:16]
+
+        measured("cipher_setup[{}]".format(name),
+                 lambda: [cipher.keyed(algorithm, key, backend) for _ in range(_CIPHER_OPERATIONS)],
+                 _CIPHER_OPERATIONS)
+        measured("cipher_encrypt[{}]".format(name),
+                 lambda: [keyed.encrypt(nonce, payload) for _ in range(_CIPHER_OPERATIONS)],
+                 _CIPHER_OPERATIONS)
+        measured("cipher_decrypt[{}]".format(name),
+                 lambda: [keyed.decrypt(nonce, ciphertext) for _ in range(_CIPHER_OPERATIONS)],
+                 _CIPHER_OPERATIONS)
+        measured("cipher_reject[{}]".format(name),
+                 lambda: [other_keyed.decrypt(nonce, rejected) for _ in range(_CIPHER_OPERATIONS)],
+                 _CIPHER_OPERATIONS)
+
+
+def run(sizes: Sequence[int] = DEFAULT_SIZES,
+        repeat: int = 3,
+        progress: Callable[[str], None] = None,
+        kdf_parameters: Dict = None) -> Dict:
+    """Runs every benchmark at every size, the size being the number of service
+    accounts per main account. The generated directories are removed afterwards
+    and the accounts directory in use restored.
+    """
+    results = {
+        "version": _RESULTS_VERSION,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "benchmarks": {},
+    }
+    benchmarks = results["benchmarks"]
+
+    def measured(name: str, function: Callable[[], None], operations: int = 1):
+        if progress is not None:
+            progress(name)
+        benchmarks[name] = _measure(function, repeat, operations)
+
+    measured("check_password_strength",
+             lambda: [data_formats.check_password_strength(password)
+                      for password in _SAMPLE_PASSWORDS],
+             len(_SAMPLE_PASSWORDS))
+    _run_ciphers(measured)
+    for arguments in importtime.COMMANDS:
+        name = importtime.benchmark_name(arguments)
+        if progress is not None:
+            progress(name)
+        result = importtime.measure(arguments, repeat)
+        if result is not None:
+            benchmarks[name] = result
+
+    previous_directory = layout.accounts_directory()
+    try:
+        for size in sizes:
+            directory = tempfile.mkdtemp(prefix="passager-bench-")
+            try:
+                _run_size(directory, size, kdf_parameters, measured)
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+    finally:
+        layout.set_accounts_directory(previous_directory)
+    return results
+
+
+def _run_size(directory: str, size: int, kdf_parameters: Optional[Dict],
+              measured: Callable[..., None]):
+    credentials = generator.generate(directory,
+                                     _MAIN_ACCOUNT_COUNT,
+                                     size,
+                                     int(size * _ORPHANS_PER_SIZE),
+                                     kdf_parameters=kdf_parameters)
+    username, password = credentials[0]
+    main_account = _logged_in(username, password)
+
+    measured("validate_main_login[{}]".format(size),
+             lambda: storage.validate_main_login(username, password))
+    measured("load_service_accounts[{}]".format(size),
+             lambda: storage.load_service_accounts(MainAccount(username,
+                                                               password,
+                                                               main_account.salt,
+                                                               main_account.data_key)))
+
+    stored_count = [0]
+
+    def store():
+        for _ in range(_STORED_PER_RUN):
+            service = generator.service_account(1000, size + stored_count[0])
+            service.change_filename(storage.store_service_account(main_account, service))
+            main_account.add_service_account(service)
+            stored_count[0] += 1
+
+    measured("store_service_account[{}]".format(size), store, _STORED_PER_RUN)
+    measured("update_service_accounts[{}]".format(size),
+             lambda: storage.update_service_accounts(main_account))
+
+
+def save_results(results: Dict, path: str):
+    with open(path, "w") as target:
+        json.dump(results, target, indent=2, sort_keys=True)
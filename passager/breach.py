@@ -0,0 +1,216 @@
+#!/bin/python3
+"""
+Breach module tells whether a password appears in a list of breached passwords
+such as the SHA-1 dump of Have I Been Pwned, without sending it anywhere. The
+dump, lines of "SHA-1 in hex:times seen", is converted once into a compact
+sorted binary file:
+    magic | version | record count | records
+where every record is the first 8 bytes of the hash and the times seen. Eight
+bytes keep false matches unlikely even among a billion hashes. Lookups binary
+search the file through a memory map, so only the few pages on the way are
+ever read no matter how large the list is.
+"""
+import hashlib
+import heapq
+import logging
+import mmap
+import os
+import struct
+import tempfile
+
+from typing import BinaryIO, Callable, Iterable, Iterator, List, Optional
+
+import passager.layout as layout
+import passager.profiling as profiling
+
+_HASH_HEX_LENGTH = 40
+_HEADER = struct.Struct(">8sBQ")
+_MAGIC = b"PSGRPWND"
+_MAX_COUNT = 2 ** 32 - 1
+# How often building reports its progress (in lines)
+_PROGRESS_INTERVAL = 1000000
+_RECORD = struct.Struct(">QI")
+# Records read at a time from the runs while merging them
+_RUN_READ_RECORDS = 64 * 1024
+# Records sorted in memory at a time; unsorted dumps are sorted in runs of
+# this size that are merged at the end
+_RUN_RECORDS = 4 * 1024 * 1024
+_VERSION = 1
+
+_logger = logging.getLogger(__name__)
+
+# The list in the accounts directory, opened on the first lookup
+_breach_list = None
+
+
+class BreachList:
+    def __init__(self, path: str):
+        """Raises OSError if the file can't be read and ValueError if it isn't
+        a breach list.
+        """
+        self.path = path
+        with open(path, "rb") as source:
+            header = source.read(_HEADER.size)
+            if len(header) != _HEADER.size:
+                raise ValueError("{} is too short to be a breach list".format(path))
+            magic, version, self._count = _HEADER.unpack(header)
+            if magic != _MAGIC or version != _VERSION:
+                raise ValueError("{} is not a supported breach list".format(path))
+            if os.fstat(source.fileno()).st_size != _HEADER.size + self._count * _RECORD.size:
+                raise ValueError("{} is truncated".format(path))
+            self._map = None
+            if self._count > 0:
+                self._map = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def times_breached(self, password: str) -> int:
+        prefix = int.from_bytes(hashlib.sha1(password.encode("utf-8")).digest()[:8], "big")
+        low = 0
+        high = self._count
+        while low < high:
+            middle = (low + high) // 2
+            record_prefix, count = _RECORD.unpack_from(self._map,
+                                                       _HEADER.size + middle * _RECORD.size)
+            if record_prefix < prefix:
+                low = middle + 1
+            elif record_prefix > prefix:
+                high = middle
+            else:
+                return count
+        return 0
+
+
+def build(source_path: str,
+          target_path: str = None,
+          progress: Callable[[int], None] = None) -> int:
+    """Converts a dump of "hash:count" lines, sorted or not, into a breach list,
+    by default the one used for the lookups. Returns the number of hashes in it.
+    """
+    target_path = target_path or layout.breach_list_path()
+    run_directory = tempfile.mkdtemp(prefix="passager-breach-",
+                                     dir=os.path.dirname(target_path) or ".")
+    run_paths = []
+    # Written next to the target so that the list is replaced atomically
+    temp_path = os.path.join(run_directory, "list")
+    try:
+        with open(source_path, "rb") as source:
+            for run in _sorted_runs(source, progress):
+                run_paths.append(os.path.join(run_directory, "{}.run".format(len(run_paths))))
+                with open(run_paths[-1], "wb") as target:
+                    _write_records(target, run)
+
+        run_files = [open(run_path, "rb") for run_path in run_paths]
+        try:
+            with open(temp_path, "wb") as target:
+                target.write(_HEADER.pack(_MAGIC, _VERSION, 0))
+                count = _write_records(target, _merged(heapq.merge(*map(_read_run, run_files))))
+                target.seek(0)
+                target.write(_HEADER.pack(_MAGIC, _VERSION, count))
+        finally:
+            for run_file in run_files:
+                run_file.close()
+        os.replace(temp_path, target_path)
+    finally:
+        for path in run_paths + [temp_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(run_directory)
+    _logger.info("Built a breach list of %s hashes into %s", count, target_path)
+    return count
+
+
+def _merged(records: Iterable[int]) -> Iterator[int]:
+    # Adds up the counts of hashes appearing more than once
+    previous = None
+    for record in records:
+        if previous is not None and previous >> 32 == record >> 32:
+            previous = (previous >> 32) << 32 | min(_MAX_COUNT, (previous & _MAX_COUNT) +
+                                                    (record & _MAX_COUNT))
+            continue
+        if previous is not None:
+            yield previous
+        previous = record
+    if previous is not None:
+        yield previous
+
+
+def _parse_line(line: bytes) -> Optional[int]:
+    # The record as an int that sorts by the hash prefix, None if malformed
+    hex_hash, _, count = line.strip().partition(b":")
+    if len(hex_hash) != _HASH_HEX_LENGTH:
+        return None
+    try:
+        prefix = int(hex_hash[:16], 16)
+        count = int(count) if count else 1
+    except ValueError:
+        return None
+    return prefix << 32 | min(count, _MAX_COUNT)
+
+
+def _read_run(run_file: BinaryIO) -> Iterator[int]:
+    while True:
+        data = run_file.read(_RUN_READ_RECORDS * _RECORD.size)
+        if not data:
+            return
+        for prefix, count in _RECORD.iter_unpack(data):
+            yield prefix << 32 | count
+
+
+def _sorted_runs(source: BinaryIO, progress: Callable[[int], None] = None) -> Iterator[List[int]]:
+    run = []
+    skipped = 0
+    for line_number, line in enumerate(source, 1):
+        record = _parse_line(line)
+        if record is None:
+            skipped += 1
+        else:
+            run.append(record)
+        if len(run) == _RUN_RECORDS:
+            # Sorted dumps are already in order, which sorting notices quickly
+            run.sort()
+            yield run
+            run = []
+        if progress is not None and line_number % _PROGRESS_INTERVAL == 0:
+            progress(line_number)
+    if skipped != 0:
+        _logger.warning("Skipped %s malformed lines of the breach dump", skipped)
+    run.sort()
+    yield run
+
+
+def times_breached(password: str) -> int:
+    """Returns how many times the password has been seen in breaches, 0 if never
+    or if no breach list has been built.
+    """
+    global _breach_list
+    path = layout.breach_list_path()
+    if _breach_list is None or _breach_list.path != path:
+        if not os.path.exists(path):
+            return 0
+        try:
+            _breach_list = BreachList(path)
+        except (OSError, ValueError) as e:
+            _logger.warning("The breach list couldn't be opened: %s", e)
+            return 0
+    with profiling.timed("breach check"):
+        return _breach_list.times_breached(password)
+
+
+def _write_records(target: BinaryIO, records: Iterable[int]) -> int:
+    count = 0
+    buffer = bytearray()
+    for record in records:
+        buffer += _RECORD.pack(record >> 32, record & _MAX_COUNT)
+        count += 1
+        if len(buffer) >= _RUN_READ_RECORDS * _RECORD.size:
+            target.write(buffer)
+            buffer.clear()
+    target.write(buffer)
+    return count
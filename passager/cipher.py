@@ -0,0 +1,156 @@
+#!/bin/python3
+"""
+Cipher module hides which library and algorithm the service accounts are
+encrypted with. The algorithms are
+    aes-cbc: unauthenticated, what every vault was written with at first
+    aes-gcm and chacha20-poly1305: authenticated encryption, a wrong key or a
+        modified ciphertext fails the tag check instead of decrypting to garbage
+and the backends the libraries implementing them: PyCrypto (or PyCryptodome)
+for AES-CBC and cryptography for all of them. Either library will do for
+AES-CBC; the authenticated algorithms need cryptography.
+
+A cipher is made for a key once and then reused for every nonce, so that the
+backend can expand the key only once. cryptography's AEAD objects do so,
+CBC in either library takes the IV at construction and can't.
+"""
+import abc
+
+from typing import List, Optional, Tuple
+
+try:
+    from Crypto.Cipher import AES
+except ImportError:
+    AES = None
+
+try:
+    import cryptography.hazmat.primitives.ciphers as primitives
+
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers import aead
+except ImportError:
+    primitives = None
+
+AES_CBC = "aes-cbc"
+AES_GCM = "aes-gcm"
+CHACHA20_POLY1305 = "chacha20-poly1305"
+ALGORITHMS = [AES_CBC, AES_GCM, CHACHA20_POLY1305]
+BACKEND_CRYPTOGRAPHY = "cryptography"
+BACKEND_PYCRYPTO = "pycrypto"
+# Bytes of the nonce, or the IV, each algorithm takes
+NONCE_LENGTHS = {
+    AES_CBC: 16,
+    AES_GCM: 12,
+    CHACHA20_POLY1305: 12,
+}
+
+
+class Cipher(abc.ABC):
+    # Encrypts and decrypts with one key of one algorithm
+    algorithm = None
+    authenticated = False
+    backend = None
+
+    @property
+    def nonce_length(self) -> int:
+        return NONCE_LENGTHS[self.algorithm]
+
+    @abc.abstractmethod
+    def decrypt(self, nonce: bytes, ciphertext: bytes, associated_data: bytes = b"") -> Optional[bytes]:
+        """Returns None if the ciphertext fails authentication. Unauthenticated
+        ciphers decrypt anything, so their callers have to check the plaintext.
+        """
+
+    @abc.abstractmethod
+    def encrypt(self, nonce: bytes, plaintext: bytes, associated_data: bytes = b"") -> bytes:
+        # The plaintext of unauthenticated ciphers must be whole blocks
+        pass
+
+
+class _AeadCipher(Cipher):
+    authenticated = True
+    backend = BACKEND_CRYPTOGRAPHY
+
+    def __init__(self, algorithm: str, key: bytes):
+        self.algorithm = algorithm
+        if algorithm == AES_GCM:
+            self._aead = aead.AESGCM(key)
+        else:
+            self._aead = aead.ChaCha20Poly1305(key)
+
+    def decrypt(self, nonce: bytes, ciphertext: bytes, associated_data: bytes = b"") -> Optional[bytes]:
+        try:
+            return self._aead.decrypt(nonce, ciphertext, associated_data)
+        except InvalidTag:
+            return None
+
+    def encrypt(self, nonce: bytes, plaintext: bytes, associated_data: bytes = b"") -> bytes:
+        return self._aead.encrypt(nonce, plaintext, associated_data)
+
+
+class _CryptographyCbcCipher(Cipher):
+    algorithm = AES_CBC
+    backend = BACKEND_CRYPTOGRAPHY
+
+    def __init__(self, key: bytes):
+        self._algorithm = primitives.algorithms.AES(key)
+
+    def decrypt(self, nonce: bytes, ciphertext: bytes, associated_data: bytes = b"") -> Optional[bytes]:
+        decryptor = primitives.Cipher(self._algorithm, primitives.modes.CBC(nonce)).decryptor()
+        return decryptor.update(ciphertext) + decryptor.finalize()
+
+    def encrypt(self, nonce: bytes, plaintext: bytes, associated_data: bytes = b"") -> bytes:
+        encryptor = primitives.Cipher(self._algorithm, primitives.modes.CBC(nonce)).encryptor()
+        return encryptor.update(plaintext) + encryptor.finalize()
+
+
+class _PyCryptoCbcCipher(Cipher):
+    algorithm = AES_CBC
+    backend = BACKEND_PYCRYPTO
+
+    def __init__(self, key: bytes):
+        self._key = key
+
+    def decrypt(self, nonce: bytes, ciphertext: bytes, associated_data: bytes = b"") -> Optional[bytes]:
+        return AES.new(self._key, AES.MODE_CBC, IV=nonce).decrypt(ciphertext)
+
+    def encrypt(self, nonce: bytes, plaintext: bytes, associated_data: bytes = b"") -> bytes:
+        return AES.new(self._key, AES.MODE_CBC, IV=nonce).encrypt(plaintext)
+
+
+def available() -> List[Tuple[str, str]]:
+    # The (algorithm, backend) pairs the installed libraries offer
+    pairs = []
+    if AES is not None:
+        pairs.append((AES_CBC, BACKEND_PYCRYPTO))
+    if primitives is not None:
+        pairs.extend([(AES_CBC, BACKEND_CRYPTOGRAPHY),
+                      (AES_GCM, BACKEND_CRYPTOGRAPHY),
+                      (CHACHA20_POLY1305, BACKEND_CRYPTOGRAPHY)])
+    return pairs
+
+
+def default_algorithm() -> str:
+    # The algorithm new files are encrypted with unless configured otherwise
+    if is_available(AES_GCM):
+        return AES_GCM
+    return AES_CBC
+
+
+def is_available(algorithm: str, backend: str = None) -> bool:
+    return any(algorithm == available_algorithm and backend in (None, available_backend)
+               for available_algorithm, available_backend in available())
+
+
+def keyed(algorithm: str, key: bytes, backend: str = None) -> Cipher:
+    """Returns a cipher of the algorithm for the key. The backend is picked
+    automatically unless given; PyCrypto is preferred for AES-CBC as the vaults
+    were written with it. Raises ValueError if no installed library has it.
+    """
+    if not is_available(algorithm, backend):
+        raise ValueError("{} isn't available, is the {} library installed?".format(
+            algorithm, backend or BACKEND_CRYPTOGRAPHY))
+    if algorithm != AES_CBC:
+        return _AeadCipher(algorithm, key)
+    if backend != BACKEND_CRYPTOGRAPHY and AES is not None:
+        return _PyCryptoCbcCipher(key)
+    return _CryptographyCbcCipher(key)
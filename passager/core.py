@@ -4,17 +4,44 @@ Core module is responsible for handling the software's execution flow after the
 user has logged in successfully.
 """
 import logging
+import time
 
 from typing import Sequence
 
+import passager.audit as audit
+import passager.breach as breach
 import passager.data_formats as data_formats
 import passager.interface as interface
+import passager.profiling as profiling
+import passager.sealed as sealed
 import passager.storage as storage
 
 from passager.data_formats import MainAccount, MenuOptions, ServiceAccount
 
+# Seconds after a full authentication during which re-authentication is
+# checked against the session's verifier instead of the slow KDF
+AUTH_GRACE_PERIOD = 120
+
 _logger = logging.getLogger(__name__)
 
+_auth_grace_period = AUTH_GRACE_PERIOD
+
+
+def _audit(main_account: MainAccount,
+           command_in: MenuOptions,
+           parameters_in: Sequence[str]):
+    _logger.debug("Handling audit")
+    if len(parameters_in) != 0:
+        interface.invalid_parameter_count(command_in,
+                                          parameters_in)
+        return
+
+    if not _authenticate_main(main_account):
+        # User couldn't authenticate properly
+        return
+
+    interface.audit_report(audit.audit(main_account))
+
 
 def _authenticate_main(main_account: MainAccount) -> bool:
     username, password = interface.authentication_login(main_account.account_name)
@@ -22,11 +49,16 @@ def _authenticate_main(main_account: MainAccount) -> bool:
         interface.invalid_login()
         return False
 
+    if (username == main_account.account_name and
+            main_account.authenticated_recently(password, _auth_grace_period)):
+        return True
+
     logged_account = storage.validate_main_login(username, password)
     if logged_account is None:
         # Login failed
         interface.invalid_login()
         return False
+    main_account.remember_authentication(password)
     return True
 
 
@@ -72,10 +104,10 @@ def _main_change_pw(main_account, command_in, parameters_in):
         # Ask the user whether they wish to confirm the password change
         if interface.accept_new_password(main_account.account_name,
                                          new_password,
-                                         strength):
-            main_account.change_password(new_password)
-            storage.update_service_accounts(main_account)
-            storage.store_main_account(main_account)
+                                         strength,
+                                         breach.times_breached(new_password)):
+            storage.change_main_password(main_account, new_password)
+            main_account.remember_authentication(new_password)
             break
 
 
@@ -94,8 +126,7 @@ def _main_remove(main_account: MainAccount,
 
     if interface.main_account_deletion_confirmation(main_account):
         # Delete the main account's service accounts from disk
-        for service_account in main_account.service_accounts:
-            storage.delete_service_account(service_account.filename)
+        storage.delete_service_accounts(main_account)
 
         # Delete main account from disk
         storage.delete_main_account(main_account)
@@ -105,7 +136,14 @@ def _main_remove(main_account: MainAccount,
         return True
 
 
-def run(main_account: MainAccount):
+def _refresh(main_account: MainAccount):
+    # Picks up what other processes have changed while waiting for the command
+    added, removed = storage.refresh_service_accounts(main_account)
+    if added != 0 or removed != 0:
+        interface.service_accounts_refreshed(added, removed)
+
+
+def run(main_account: MainAccount, auth_grace_period: float = AUTH_GRACE_PERIOD):
     """Try for modular structure:
         Open interface's main menu
         Use the result to logout / open up the selected menu
@@ -117,11 +155,17 @@ def run(main_account: MainAccount):
             Display services
             Print help
             Training
+            Audit
             Logout
     """
+    global _auth_grace_period
+    _auth_grace_period = auth_grace_period
+
     interface.login_successful(main_account.account_name)
     _logger.info("User %s logged in", main_account.account_name)
 
+    # Started first so that nothing written while loading goes unnoticed
+    storage.watch_service_accounts(main_account)
     storage.load_service_accounts(main_account)
     command_in = None
 
@@ -132,6 +176,11 @@ def run(main_account: MainAccount):
                       main_account.account_name,
                       command_in,
                       parameters_in)
+        # Without the time spent waiting at the command's own prompts
+        command_started = time.perf_counter()
+        input_started = profiling.input_seconds()
+        if command_in != MenuOptions.LOGOUT:
+            _refresh(main_account)
         if command_in == MenuOptions.SERVICE_ACCOUNT_ADD:
             _service_add(main_account, command_in, parameters_in)
 
@@ -157,6 +206,13 @@ def run(main_account: MainAccount):
 
         elif command_in == MenuOptions.HELP:
             _help(command_in, parameters_in)
+
+        elif command_in == MenuOptions.AUDIT:
+            _audit(main_account, command_in, parameters_in)
+        profiling.record("command " + command_in.name.lower(),
+                         time.perf_counter() - command_started - (profiling.input_seconds() - input_started))
+    storage.unwatch_service_accounts(main_account)
+    sealed.wipe()
     interface.logout(main_account.account_name)
 
 
@@ -190,14 +246,16 @@ def _service_add(main_account: MainAccount,
         interface.service_already_exists(service_name)
         return
 
+    times_breached = breach.times_breached(service_password)
+    if times_breached > 0 and not interface.accept_breached_password(service_name, times_breached):
+        return
+
     service_account = ServiceAccount(service_name,
                                      service_username,
                                      service_password)
-    filename = storage.store_service_account(main_account.main_pass,
-                                             main_account.account_name,
-                                             service_account)
+    filename = storage.store_service_account(main_account, service_account)
     service_account.change_filename(filename)
-    main_account.service_accounts.append(service_account)
+    main_account.add_service_account(service_account)
     interface.service_account_added(service_account)
 
 
@@ -230,12 +288,13 @@ def _service_change_pw(main_account, command_in, parameters_in):
         # Approximate the strength of the password
         strength = data_formats.check_password_strength(new_password)
         # Ask the user whether they wish to confirm the password change
-        if interface.accept_new_password(service_name, new_password, strength):
+        if interface.accept_new_password(service_name,
+                                         new_password,
+                                         strength,
+                                         breach.times_breached(new_password)):
             service = main_account.service_account_by_name(service_name)
             service.change_password(new_password)
-            storage.store_service_account(main_account.main_pass,
-                                          main_account.account_name,
-                                          service)
+            service.change_filename(storage.replace_service_account(main_account, service))
             break
 
 
@@ -276,7 +335,7 @@ def _service_remove(main_account: MainAccount,
     # Delete service from disk
     account = main_account.service_account_by_name(service_name)
     service_filename = account.filename
-    removal_success = storage.delete_service_account(service_filename)
+    removal_success = storage.delete_service_account(service_filename, main_account)
 
     if removal_success:
         # Delete service account from main account runtime list
@@ -4,8 +4,14 @@ The module that contains the data formats used internally within the software.
 """
 import base64
 import enum
+import hashlib
+import hmac
+import os
 import re
-from typing import Optional, Sequence
+import time
+from typing import Callable, KeysView, Optional, Tuple, ValuesView
+
+import passager.sealed as sealed
 
 IV_LENGTH = 16
 # TODO: Adjust
@@ -29,56 +35,134 @@ class MenuOptions(enum.IntEnum):
     MAIN_ACCOUNT_CHANGE_PASSWORD = 6
     MAIN_ACCOUNT_REMOVE = 7
     LOGOUT = 8
+    AUDIT = 9
 
 
 class MainAccount:
-    def __init__(self, account_name: str, main_pass: str, salt: bytes = None):
-        self.service_accounts = []
+    def __init__(self,
+                 account_name: str,
+                 main_pass: str,
+                 salt: bytes = None,
+                 data_key: bytes = None):
+        # Service name -> service account, in the order they were added
+        self._service_accounts = {}
         self.account_name = account_name
+        # Sealed, see the main_pass property
+        self._main_pass = None
         self.main_pass = main_pass
         self.salt = salt
+        # The key the service accounts are encrypted with
+        self.data_key = data_key
+        # Lets the session check the password again without the slow KDF for a
+        # while after a full authentication. The key never leaves the memory.
+        self._session_key = None
+        self._session_verifier = None
+        self._authenticated_at = None
+
+    def add_service_account(self, service_account: "ServiceAccount") -> bool:
+        # Returns False if there already is a service account of the same name
+        if service_account.service_name in self._service_accounts:
+            return False
+        self._service_accounts[service_account.service_name] = service_account
+        return True
+
+    def authenticated_recently(self, password: str, grace_period: float) -> bool:
+        if self._session_verifier is None or grace_period <= 0:
+            return False
+        if time.monotonic() - self._authenticated_at > grace_period:
+            return False
+        return hmac.compare_digest(self._session_verifier,
+                                   self._derive_session_verifier(password))
 
     def change_password(self, new_password: str):
         self.main_pass = new_password
         # Reset salt so that it shall be generated again
         self.salt = None
 
+    def _derive_session_verifier(self, password: str) -> bytes:
+        return hmac.new(self._session_key, encode_general(password), hashlib.sha256).digest()
+
+    @property
+    def main_pass(self) -> str:
+        # Only needed when the main account file is written again
+        return sealed.unseal(self._main_pass)
+
+    @main_pass.setter
+    def main_pass(self, main_pass: str):
+        self._main_pass = sealed.seal(main_pass)
+
+    def remember_authentication(self, password: str):
+        # Called after the password has been verified with the full KDF
+        self._session_key = os.urandom(32)
+        self._session_verifier = self._derive_session_verifier(password)
+        self._authenticated_at = time.monotonic()
+
     def remove_service_account(self, service_name: str):
-        if service_name not in self.service_names():
-            return
-        account = self.service_account_by_name(service_name)
-        if account is not None:
-            self.service_accounts.remove(account)
-            return
+        self._service_accounts.pop(service_name, None)
 
     def service_account_by_name(self, service_name: str) -> Optional["ServiceAccount"]:
-        for account in self.service_accounts:
-            if account.service_name == service_name:
-                return account
+        return self._service_accounts.get(service_name)
+
+    @property
+    def service_accounts(self) -> ValuesView["ServiceAccount"]:
+        # A live view, service accounts are added with add_service_account()
+        return self._service_accounts.values()
 
-    def service_names(self) -> Sequence[str]:
-        names = []
-        for account in self.service_accounts:
-            names.append(account.service_name)
-        return names
+    def service_names(self) -> KeysView[str]:
+        return self._service_accounts.keys()
 
 
 class ServiceAccount:
+    """When loaded lazily, only the service name is known at first. The account
+    name and the password are decrypted with load_credentials once either of
+    them is needed. They're held sealed and unsealed on every read.
+    """
+    # No per instance dictionary, vaults may hold a very large number of these
+    __slots__ = ("service_name",
+                 "_account_name",
+                 "_service_password",
+                 "filename",
+                 "_load_credentials")
+
     def __init__(self, service_name: str,
-                 account_name: str,
-                 service_password: str,
-                 filename: str = None):
+                 account_name: Optional[str],
+                 service_password: Optional[str],
+                 filename: str = None,
+                 load_credentials: Callable[[], Tuple[str, str]] = None):
         self.service_name = service_name
-        self.account_name = account_name
-        self.service_password = service_password
+        self._account_name = sealed.seal(account_name)
+        self._service_password = sealed.seal(service_password)
         self.filename = filename
+        self._load_credentials = load_credentials
+
+    @property
+    def account_name(self) -> str:
+        self._ensure_credentials()
+        return sealed.unseal(self._account_name)
+
+    @property
+    def service_password(self) -> str:
+        self._ensure_credentials()
+        return sealed.unseal(self._service_password)
 
     def change_password(self, new_password: str):
-        self.service_password = new_password
+        # The account name must be known before the credentials can be rewritten
+        self._ensure_credentials()
+        self._service_password = sealed.seal(new_password)
 
     def change_filename(self, new_filename: str):
         self.filename = new_filename
 
+    def credentials_loaded(self) -> bool:
+        return self._load_credentials is None
+
+    def _ensure_credentials(self):
+        if self._load_credentials is not None:
+            account_name, service_password = self._load_credentials()
+            self._account_name = sealed.seal(account_name)
+            self._service_password = sealed.seal(service_password)
+            self._load_credentials = None
+
 
 def check_password_strength(password: str) -> int:
     # 0: Poor
@@ -88,7 +172,8 @@ def check_password_strength(password: str) -> int:
     # 4: Strong
     # 5: Very strong
     # TODO: Could improve upon this classification to be more helpful
-    # TODO: as currently it only considers bruteforcing but not dictionaries
+    # TODO: as currently it only considers bruteforcing but not dictionaries.
+    # Passwords known from breaches are looked up by the breach module.
     # TODO: Adjust.
     if len(password) >= 20:
         return 5
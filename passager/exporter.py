@@ -0,0 +1,226 @@
+#!/bin/python3
+"""
+Exporter module writes a main account's service accounts into a file. By default
+the file is an archive encrypted with a passphrase of its own; plain CSV and
+JSON lines are written only when explicitly asked for. The service accounts are
+streamed from the storage a batch at a time, so exporting takes the same amount
+of memory regardless of the size of the vault.
+
+The archive is a header followed by the zlib compressed JSON lines encrypted
+with AES-CBC and an HMAC-SHA256 of everything before it:
+    magic | version | scrypt n, r, p | salt | IV | ciphertext | HMAC
+The ciphertext is encrypted a chunk at a time through the cipher module, each
+chunk chained to the previous one by taking its last block as the IV, which
+makes the whole of it a single CBC stream whichever library is installed.
+"""
+import csv
+import hashlib
+import hmac
+import io
+import json
+import logging
+import os
+import struct
+import zlib
+
+from typing import Dict, Iterator, Tuple
+
+import passager.cipher as cipher
+import passager.storage as storage
+
+from passager.data_formats import MainAccount
+
+ARCHIVE_FILE_EXT = ".psgr"
+FORMAT_ARCHIVE = "archive"
+FORMAT_CSV = "csv"
+FORMAT_JSONL = "jsonl"
+FORMATS = [FORMAT_ARCHIVE, FORMAT_CSV, FORMAT_JSONL]
+
+_ARCHIVE_HEADER = struct.Struct(">8sBIII16s16s")
+_ARCHIVE_MAGIC = b"PSGREXPT"
+_ARCHIVE_VERSION = 1
+_BLOCK_SIZE = 16
+_CHUNK_SIZE = 64 * 1024
+_FIELDS = ["service", "username", "password"]
+_KEY_LENGTH = 32
+_MAC_LENGTH = 32
+_SCRYPT_BLOCK_SIZE = 8
+_SCRYPT_COST = 2 ** 15
+_SCRYPT_MAX_MEMORY = 2 ** 26
+_SCRYPT_PARALLELISM = 1
+
+_logger = logging.getLogger(__name__)
+
+
+class _ArchiveWriter(io.RawIOBase):
+    # Compresses, encrypts and authenticates what's written into it on the fly
+    def __init__(self, target, passphrase: str):
+        super().__init__()
+        self._target = target
+        salt = os.urandom(16)
+        init_vector = os.urandom(16)
+        header = _ARCHIVE_HEADER.pack(_ARCHIVE_MAGIC,
+                                      _ARCHIVE_VERSION,
+                                      _SCRYPT_COST,
+                                      _SCRYPT_BLOCK_SIZE,
+                                      _SCRYPT_PARALLELISM,
+                                      salt,
+                                      init_vector)
+        encryption_key, mac_key = _derive_keys(passphrase,
+                                               salt,
+                                               _SCRYPT_COST,
+                                               _SCRYPT_BLOCK_SIZE,
+                                               _SCRYPT_PARALLELISM)
+        self._encryptor = cipher.keyed(cipher.AES_CBC, encryption_key)
+        self._init_vector = init_vector
+        self._mac = hmac.new(mac_key, header, hashlib.sha256)
+        self._compressor = zlib.compressobj()
+        # Compressed bytes not yet making up a whole cipher block
+        self._pending = b""
+        self._target.write(header)
+
+    def close(self):
+        if not self.closed:
+            # PKCS#7 padding, there's always at least one byte of it
+            self._pending += self._compressor.flush()
+            pad_length = _BLOCK_SIZE - len(self._pending) % _BLOCK_SIZE
+            self._pending += bytes([pad_length]) * pad_length
+            self._encrypt_pending()
+            self._target.write(self._mac.digest())
+        super().close()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        self._pending += self._compressor.compress(data)
+        if len(self._pending) >= _CHUNK_SIZE:
+            self._encrypt_pending()
+        return len(data)
+
+    def _encrypt_pending(self):
+        whole_length = len(self._pending) - len(self._pending) % _BLOCK_SIZE
+        if whole_length == 0:
+            return
+        ciphertext = self._encryptor.encrypt(self._init_vector, self._pending[:whole_length])
+        self._init_vector = ciphertext[-_BLOCK_SIZE:]
+        self._pending = self._pending[whole_length:]
+        self._mac.update(ciphertext)
+        self._target.write(ciphertext)
+
+
+def _derive_keys(passphrase: str, salt: bytes, cost: int, block_size: int,
+                 parallelism: int) -> Tuple[bytes, bytes]:
+    # Returns the encryption key and the MAC key
+    key_material = hashlib.scrypt(passphrase.encode("utf-8"),
+                                  salt=salt,
+                                  n=cost,
+                                  r=block_size,
+                                  p=parallelism,
+                                  maxmem=_SCRYPT_MAX_MEMORY,
+                                  dklen=_KEY_LENGTH * 2)
+    return key_material[:_KEY_LENGTH], key_material[_KEY_LENGTH:]
+
+
+def export_services(main_account: MainAccount,
+                    path: str,
+                    file_format: str,
+                    passphrase: str = None) -> int:
+    """Writes the main account's service accounts into the file. The archive
+    format requires the passphrase. Returns the number of service accounts.
+    """
+    temp_path = path + ".tmp"
+    # Readable by the owner only, the contents may well be plain text
+    descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with open(descriptor, "wb") as target:
+            if file_format == FORMAT_ARCHIVE:
+                binary = io.BufferedWriter(_ArchiveWriter(target, passphrase), _CHUNK_SIZE)
+            else:
+                binary = target
+            with io.TextIOWrapper(binary, encoding="utf-8", newline="") as text:
+                if file_format == FORMAT_CSV:
+                    count = _write_csv(main_account, text)
+                else:
+                    count = _write_jsonl(main_account, text)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    os.replace(temp_path, path)
+    _logger.info("Exported %s service accounts into %s", count, path)
+    return count
+
+
+def read_archive(path: str, passphrase: str) -> Iterator[Dict[str, str]]:
+    """Yields the records of an archive. The archive is authenticated in a first
+    pass before anything is decrypted; ValueError is raised if it was tampered
+    with or the passphrase is wrong.
+    """
+    with open(path, "rb") as source:
+        header = source.read(_ARCHIVE_HEADER.size)
+        if len(header) != _ARCHIVE_HEADER.size:
+            raise ValueError("{} is not an export archive".format(path))
+        (magic, version, cost, block_size, parallelism,
+         salt, init_vector) = _ARCHIVE_HEADER.unpack(header)
+        if magic != _ARCHIVE_MAGIC or version != _ARCHIVE_VERSION:
+            raise ValueError("{} is not a supported export archive".format(path))
+        encryption_key, mac_key = _derive_keys(passphrase, salt, cost, block_size, parallelism)
+
+        ciphertext_end = os.fstat(source.fileno()).st_size - _MAC_LENGTH
+        mac = hmac.new(mac_key, header, hashlib.sha256)
+        for chunk in _read_chunks(source, ciphertext_end):
+            mac.update(chunk)
+        if not hmac.compare_digest(mac.digest(), source.read(_MAC_LENGTH)):
+            raise ValueError("Wrong passphrase or the archive is corrupt")
+
+        source.seek(_ARCHIVE_HEADER.size)
+        decryptor = cipher.keyed(cipher.AES_CBC, encryption_key)
+        decompressor = zlib.decompressobj()
+        # Decrypted data is held back one block so that the padding can be removed
+        held_back = b""
+        line_buffer = b""
+        for chunk in _read_chunks(source, ciphertext_end):
+            plaintext = held_back + decryptor.decrypt(init_vector, chunk)
+            init_vector = chunk[-_BLOCK_SIZE:]
+            held_back = plaintext[-_BLOCK_SIZE:]
+            line_buffer += decompressor.decompress(plaintext[:-_BLOCK_SIZE])
+            *lines, line_buffer = line_buffer.split(b"\n")
+            for line in lines:
+                yield json.loads(line)
+        line_buffer += decompressor.decompress(held_back[:-held_back[-1]])
+        line_buffer += decompressor.flush()
+        for line in line_buffer.split(b"\n"):
+            if line != b"":
+                yield json.loads(line)
+
+
+def _read_chunks(source, end: int) -> Iterator[bytes]:
+    while source.tell() < end:
+        yield source.read(min(_CHUNK_SIZE, end - source.tell()))
+
+
+def _records(main_account: MainAccount) -> Iterator[Dict[str, str]]:
+    for service in storage.iter_service_accounts(main_account):
+        yield {
+            "service": service.service_name,
+            "username": service.account_name,
+            "password": service.service_password,
+        }
+
+
+def _write_csv(main_account: MainAccount, text: io.TextIOBase) -> int:
+    writer = csv.DictWriter(text, fieldnames=_FIELDS)
+    writer.writeheader()
+    count = 0
+    for record in _records(main_account):
+        writer.writerow(record)
+        count += 1
+    return count
+
+
+def _write_jsonl(main_account: MainAccount, text: io.TextIOBase) -> int:
+    count = 0
+    for record in _records(main_account):
+        text.write(json.dumps(record) + "\n")
+        count += 1
+    return count
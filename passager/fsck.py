@@ -0,0 +1,304 @@
+#!/bin/python3
+"""
+Fsck module checks the accounts directory for files that only cost time: left
+over temporary files, truncated or otherwise corrupt service account files,
+files of removed main accounts and dead records in packed containers. With a
+logged in main account it also finds the account's service account files that
+are left behind or duplicated, and those its manifest has lost track of. Every service account file is trial-decrypted
+by logins that have to scan the directory, so removing them speeds those up.
+"""
+import binascii
+import concurrent.futures
+import functools
+import logging
+import os
+
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import passager.cipher as cipher
+import passager.layout as layout
+import passager.locking as locking
+import passager.packed as packed
+import passager.storage as storage
+
+from passager.data_formats import MainAccount
+
+ISSUE_CORRUPT = "corrupt"
+ISSUE_DEAD_RECORDS = "dead records"
+ISSUE_DUPLICATE = "duplicate"
+ISSUE_ORPHAN = "orphan"
+ISSUE_STALE = "stale"
+ISSUE_TEMPORARY = "temporary"
+ISSUE_UNLISTED = "unlisted"
+
+_BLOCK_SIZE = 16
+# The files written through temporary files under the locks. Others, like the
+# layout's vault.json, are written without taking any.
+_LOCKED_FILE_EXTS = (layout.CONTAINER_FILE_EXT,
+                     layout.MAIN_FILE_EXT,
+                     layout.MANIFEST_FILE_EXT,
+                     layout.SERVICE_FILE_EXT)
+_TEMPORARY_FILE_EXT = ".tmp"
+
+_logger = logging.getLogger(__name__)
+
+
+class Finding:
+    def __init__(self,
+                 issue: str,
+                 path: str,
+                 size: int,
+                 description: str = "",
+                 recheck: Callable[[], bool] = None,
+                 fix: Callable[[], None] = None):
+        self.issue = issue
+        self.path = path
+        # The bytes a repair frees
+        self.size = size
+        self.description = description
+        # Tells whether the finding still holds, as the files may have changed
+        # between checking and repairing
+        self.recheck = recheck
+        # Repairs the finding, without one the file is removed
+        self.fix = fix
+        self.repaired = False
+
+    def still_holds(self) -> bool:
+        if not os.path.exists(self.path):
+            return False
+        return self.recheck is None or self.recheck()
+
+    def is_service_file(self) -> bool:
+        return self.path.endswith(layout.SERVICE_FILE_EXT)
+
+
+class Report:
+    def __init__(self):
+        self.findings = []
+        self.scanned_files = 0
+        self.scanned_bytes = 0
+        # The service account files a login without a manifest trial-decrypts
+        self.service_files = 0
+
+    def freed_bytes(self) -> int:
+        return sum(finding.size for finding in self.findings if finding.repaired)
+
+    def removed_service_files(self) -> int:
+        return sum(1 for finding in self.findings
+                   if finding.repaired and finding.fix is None and finding.is_service_file())
+
+
+def check(main_account: Optional[MainAccount] = None, workers: int = None) -> Report:
+    """Walks the accounts directory on a worker pool and reports what could be
+    removed or compacted. Nothing is changed; see repair().
+    """
+    # Interrupted writes are finished first so that their files aren't reported
+    storage.recover_storage()
+
+    report = Report()
+    directories = layout.storage_directories()
+    service_files = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for findings, files, scanned_bytes in executor.map(_check_directory, directories):
+            report.findings.extend(findings)
+            service_files.extend(files)
+            report.scanned_files += len(files) + len(findings)
+            report.scanned_bytes += scanned_bytes
+        report.service_files = len(service_files)
+
+        if main_account is not None:
+            # Files being written meanwhile would look stale
+            with storage.locked(main_account):
+                report.findings.extend(_check_owned_files(main_account, service_files, executor))
+    return report
+
+
+def _check_container(path: str, size: int) -> Optional[Finding]:
+    try:
+        vault = packed.open_vault(path)
+    except (ValueError, UnicodeDecodeError, OSError) as e:
+        return Finding(ISSUE_CORRUPT, path, size, str(e),
+                       functools.partial(_container_has, ISSUE_CORRUPT, path))
+    if vault is None:
+        return None
+    try:
+        wasted_bytes = vault.dead_bytes() + vault.torn_bytes()
+    finally:
+        vault.close()
+    if wasted_bytes == 0:
+        return None
+    return Finding(ISSUE_DEAD_RECORDS, path, wasted_bytes, "removed or torn records",
+                   functools.partial(_container_has, ISSUE_DEAD_RECORDS, path))
+
+
+def _check_directory(directory: Tuple[str, Optional[str]]) -> Tuple[List[Finding],
+                                                                    List[Tuple[str, str, int]],
+                                                                    int]:
+    # Returns the findings, the healthy service account files and the bytes scanned
+    path, owner = directory
+    owner_exists = _owner_exists(owner)
+    findings = []
+    service_files = []
+    scanned_bytes = 0
+    with os.scandir(path) as entries:
+        entries = [entry for entry in entries if entry.is_file()]
+    for entry in entries:
+        try:
+            size = entry.stat().st_size
+        except FileNotFoundError:
+            continue
+        scanned_bytes += size
+        finding = _check_file(entry.name, entry.path, size, owner, owner_exists)
+        if finding is not None:
+            findings.append(finding)
+        elif entry.name.endswith(layout.SERVICE_FILE_EXT):
+            service_files.append((entry.name, entry.path, size))
+    return findings, service_files, scanned_bytes
+
+
+def _check_file(filename: str,
+                path: str,
+                size: int,
+                owner: Optional[str],
+                owner_exists: bool) -> Optional[Finding]:
+    # The owner is the main account whose directory the file is in, if any
+    if filename.endswith(_TEMPORARY_FILE_EXT) and \
+            filename[:-len(_TEMPORARY_FILE_EXT)].endswith(_LOCKED_FILE_EXTS):
+        # Under the locks no write is in progress, so any left are stale
+        return Finding(ISSUE_TEMPORARY, path, size, "left behind by an interrupted write")
+
+    if filename.endswith(layout.SERVICE_FILE_EXT):
+        if not _is_well_formed(filename, size):
+            return Finding(ISSUE_CORRUPT, path, size, "truncated or malformed",
+                           lambda: not _is_well_formed(filename, os.path.getsize(path)))
+        if not owner_exists:
+            return Finding(ISSUE_ORPHAN, path, size, "the main account was removed",
+                           lambda: not _owner_exists(owner))
+        return None
+
+    for extension in (layout.MANIFEST_FILE_EXT, layout.CONTAINER_FILE_EXT):
+        if filename.endswith(extension):
+            main_accountname = filename[:-len(extension)]
+            if not layout.main_account_exists(main_accountname):
+                return Finding(ISSUE_ORPHAN, path, size, "the main account was removed",
+                               lambda: not layout.main_account_exists(main_accountname))
+            if extension == layout.CONTAINER_FILE_EXT:
+                return _check_container(path, size)
+    return None
+
+
+def _check_owned_files(main_account: MainAccount,
+                       service_files: Sequence[Tuple[str, str, int]],
+                       executor: concurrent.futures.Executor) -> List[Finding]:
+    # Finds the main account's files that no longer belong to any of its services
+    # and those missing from its manifest or container
+    listed = storage.listed_services(main_account)
+    results = executor.map(lambda service_file: storage.check_service_file(main_account,
+                                                                           service_file[0],
+                                                                           service_file[1]),
+                           service_files)
+    findings = []
+    kept = {}
+    for (filename, path, size), (result, service_name) in zip(service_files, results):
+        if result == storage.FILE_NOT_OWNED:
+            continue
+        if result == storage.FILE_UNDECRYPTABLE:
+            findings.append(Finding(ISSUE_CORRUPT, path, size,
+                                    "credentials of {} can't be decrypted".format(service_name),
+                                    functools.partial(_is_undecryptable, main_account, filename, path)))
+        elif listed is not None and listed.get(service_name, filename) != filename:
+            # Only removed when another file of the service is listed
+            findings.append(Finding(ISSUE_STALE, path, size,
+                                    "an old version of {}".format(service_name),
+                                    functools.partial(_is_stale, main_account, filename, service_name)))
+        elif service_name in kept:
+            # Without a listed one the most recently written one is kept
+            findings.append(_older_duplicate(kept, service_name, path, size))
+        else:
+            kept[service_name] = (path, size)
+
+    if listed is not None:
+        for service_name, (path, _) in kept.items():
+            if service_name not in listed:
+                # Possibly the only copy of the service, so it's listed again
+                findings.append(Finding(ISSUE_UNLISTED, path, 0,
+                                        "{} isn't in the manifest or container".format(service_name),
+                                        functools.partial(_is_unlisted, main_account, service_name),
+                                        functools.partial(storage.relist_service_file,
+                                                          main_account, os.path.basename(path))))
+    return findings
+
+
+def _container_has(issue: str, path: str) -> bool:
+    finding = _check_container(path, os.path.getsize(path))
+    return finding is not None and finding.issue == issue
+
+
+def _is_undecryptable(main_account: MainAccount, filename: str, path: str) -> bool:
+    return storage.check_service_file(main_account, filename, path)[0] == storage.FILE_UNDECRYPTABLE
+
+
+def _is_stale(main_account: MainAccount, filename: str, service_name: str) -> bool:
+    listed = storage.listed_services(main_account)
+    return listed is not None and listed.get(service_name, filename) != filename
+
+
+def _is_unlisted(main_account: MainAccount, service_name: str) -> bool:
+    listed = storage.listed_services(main_account)
+    return listed is not None and service_name not in listed
+
+
+def _is_well_formed(filename: str, size: int) -> bool:
+    # The filename is the base32 nonce followed by the encrypted service name.
+    # Both the name and the contents are whole cipher blocks, plus the tag of
+    # an authenticated cipher which is a block long as well.
+    try:
+        algorithm, nonce, name_blocks = storage.split_service_filename(filename)
+    except (binascii.Error, ValueError):
+        return False
+    return (len(nonce) == cipher.NONCE_LENGTHS[algorithm] and
+            len(name_blocks) > 0 and len(name_blocks) % _BLOCK_SIZE == 0 and
+            size > 0 and size % _BLOCK_SIZE == 0)
+
+
+def _older_duplicate(kept: dict, service_name: str, path: str, size: int) -> Finding:
+    kept_path, kept_size = kept[service_name]
+    if os.path.getmtime(path) > os.path.getmtime(kept_path):
+        kept[service_name] = (path, size)
+        path, size, kept_path = kept_path, kept_size, path
+    # The newer copy must still be there
+    return Finding(ISSUE_DUPLICATE, path, size, "another copy of {}".format(service_name),
+                   functools.partial(os.path.exists, kept_path))
+
+
+def _owner_exists(owner: Optional[str]) -> bool:
+    return owner is None or layout.main_account_exists(owner)
+
+
+def repair(report: Report):
+    """Removes the reported files and compacts the containers. No main account
+    may be written meanwhile, e.g. appended to a container or written through a
+    temporary file, so every finding is checked again under the locks.
+    """
+    accounts_directory = layout.accounts_directory()
+    with locking.all_accounts(accounts_directory, layout.main_account_names(), exclusive_lock=True):
+        for finding in report.findings:
+            try:
+                if not finding.still_holds():
+                    _logger.info("%s changed since the check, left as it is", finding.path)
+                    continue
+                if finding.fix is not None:
+                    finding.fix()
+                elif finding.issue == ISSUE_DEAD_RECORDS:
+                    vault = packed.open_vault(finding.path)
+                    vault.compact()
+                    vault.close()
+                else:
+                    os.remove(finding.path)
+            except OSError as e:
+                _logger.warning("Couldn't repair %s: %s", finding.path, e)
+                continue
+            finding.repaired = True
+        for _, owner in layout.storage_directories():
+            if owner is not None and not layout.main_account_exists(owner):
+                layout.remove_main_account_directory(owner)
@@ -0,0 +1,217 @@
+#!/bin/python3
+"""
+Importer module adds service accounts in bulk from files exported by other
+password managers. CSV, JSON lines and KeePass 2 XML exports are supported.
+The files are parsed incrementally and the service accounts written as a single
+batch, so importing a large export takes neither much memory nor a write per
+service account.
+"""
+import csv
+import json
+import logging
+import os
+import xml.etree.ElementTree as ElementTree
+
+from typing import Dict, Iterator, Optional, Tuple
+
+import passager.data_formats as data_formats
+import passager.exporter as exporter
+import passager.storage as storage
+
+from passager.data_formats import MainAccount, ServiceAccount
+
+FORMAT_ARCHIVE = exporter.FORMAT_ARCHIVE
+FORMAT_CSV = "csv"
+FORMAT_JSONL = "jsonl"
+FORMAT_KEEPASS = "keepass"
+FORMATS = [FORMAT_ARCHIVE, FORMAT_CSV, FORMAT_JSONL, FORMAT_KEEPASS]
+
+# Column and key names accepted for each field, in lower case
+_FIELD_NAMES = {
+    "service": ("service", "service_name", "title", "name"),
+    "username": ("username", "user", "login", "login_username", "account", "account_name"),
+    "password": ("password", "pass", "login_password"),
+}
+_FORMAT_EXTENSIONS = {
+    exporter.ARCHIVE_FILE_EXT: FORMAT_ARCHIVE,
+    ".csv": FORMAT_CSV,
+    ".json": FORMAT_JSONL,
+    ".jsonl": FORMAT_JSONL,
+    ".xml": FORMAT_KEEPASS,
+}
+_KEEPASS_FIELDS = {
+    "Title": "service",
+    "UserName": "username",
+    "Password": "password",
+}
+# How many of the rejected records are kept for the report
+_REJECTED_SAMPLE_SIZE = 20
+
+_logger = logging.getLogger(__name__)
+
+
+class ImportResult:
+    def __init__(self):
+        self.imported_count = 0
+        self.rejected_count = 0
+        # (position in the file, reason) of the first rejected records
+        self.rejected = []
+
+    def reject(self, position: int, reason: str):
+        self.rejected_count += 1
+        if len(self.rejected) < _REJECTED_SAMPLE_SIZE:
+            self.rejected.append((position, reason))
+
+
+def detect_format(path: str) -> Optional[str]:
+    return _FORMAT_EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+
+def import_services(main_account: MainAccount,
+                    path: str,
+                    file_format: str,
+                    passphrase: str = None) -> ImportResult:
+    """Adds the service accounts in the file to the main account. Records that
+    don't pass the same checks as SRV-ADD or whose service name is already in
+    use are skipped and reported. Archives require their passphrase.
+    """
+    result = ImportResult()
+    # The main account only gets the service accounts once they're stored
+    accepted = []
+    accepted_names = set()
+
+    def accepted_services() -> Iterator[ServiceAccount]:
+        for position, fields in read_records(path, file_format, passphrase):
+            reason = rejection_reason(main_account, fields)
+            if reason is None and fields["service"] in accepted_names:
+                reason = "{} already exists".format(fields["service"])
+            if reason is not None:
+                result.reject(position, reason)
+                continue
+            service = ServiceAccount(fields["service"], fields["username"], fields["password"])
+            accepted.append(service)
+            accepted_names.add(service.service_name)
+            yield service
+
+    storage.store_service_accounts(main_account, accepted_services())
+    for service in accepted:
+        main_account.add_service_account(service)
+    result.imported_count = len(accepted)
+    _logger.info("Imported %s service accounts, rejected %s",
+                 result.imported_count, result.rejected_count)
+    return result
+
+
+def _normalized(record: Dict[str, str]) -> Dict[str, str]:
+    # Maps the record's own field names to service, username and password
+    lowered = {str(name).strip().lower(): value for name, value in record.items()}
+    fields = {}
+    for field, names in _FIELD_NAMES.items():
+        for name in names:
+            if lowered.get(name) is not None:
+                fields[field] = str(lowered[name])
+                break
+    return fields
+
+
+def _read_archive(path: str, passphrase: str) -> Iterator[Tuple[int, Optional[Dict[str, str]]]]:
+    for record_number, record in enumerate(exporter.read_archive(path, passphrase), 1):
+        yield record_number, _normalized(record)
+
+
+def _read_csv(path: str) -> Iterator[Tuple[int, Optional[Dict[str, str]]]]:
+    with open(path, newline="", encoding="utf-8-sig") as source:
+        reader = csv.reader(source)
+        header = next(reader, None)
+        if header is None:
+            return
+        columns = [column.strip().lower() for column in header]
+        if not any(column in _FIELD_NAMES["service"] for column in columns):
+            # No header row: service, username, password
+            columns = ["service", "username", "password"]
+            yield reader.line_num, _normalized(dict(zip(columns, header)))
+        for row in reader:
+            if len(row) == 0:
+                continue
+            yield reader.line_num, _normalized(dict(zip(columns, row)))
+
+
+def _read_jsonl(path: str) -> Iterator[Tuple[int, Optional[Dict[str, str]]]]:
+    with open(path, encoding="utf-8") as source:
+        for line_number, line in enumerate(source, 1):
+            if line.strip() == "":
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                yield line_number, None
+                continue
+            if not isinstance(record, dict):
+                yield line_number, None
+                continue
+            yield line_number, _normalized(record)
+
+
+def _read_keepass(path: str) -> Iterator[Tuple[int, Optional[Dict[str, str]]]]:
+    # The position of a KeePass record is the number of the entry
+    entry_number = 0
+    history_depth = 0
+    for event, element in ElementTree.iterparse(path, events=("start", "end")):
+        if element.tag == "History":
+            # Old versions of an entry are nested entries inside its history
+            history_depth += 1 if event == "start" else -1
+            continue
+        if event != "end" or element.tag != "Entry":
+            continue
+        if history_depth == 0:
+            entry_number += 1
+            fields = {}
+            for string in element.findall("String"):
+                field = _KEEPASS_FIELDS.get(string.findtext("Key"))
+                if field is not None:
+                    fields[field] = string.findtext("Value") or ""
+            yield entry_number, fields
+        # Keeps the memory use constant regardless of the export's size
+        element.clear()
+
+
+def read_records(path: str,
+                 file_format: str,
+                 passphrase: str = None) -> Iterator[Tuple[int, Optional[Dict[str, str]]]]:
+    """Yields (position, fields) of every record in the file. The position is a
+    line, entry or record number and the fields are None for unreadable records.
+    """
+    if file_format == FORMAT_ARCHIVE:
+        return _read_archive(path, passphrase)
+    readers = {
+        FORMAT_CSV: _read_csv,
+        FORMAT_JSONL: _read_jsonl,
+        FORMAT_KEEPASS: _read_keepass,
+    }
+    return readers[file_format](path)
+
+
+def rejection_reason(main_account: MainAccount, fields: Optional[Dict[str, str]]) -> Optional[str]:
+    if fields is None:
+        return "unreadable record"
+    missing = [field for field in _FIELD_NAMES if field not in fields]
+    if len(missing) != 0:
+        return "missing {}".format(", ".join(missing))
+
+    service_name = fields["service"]
+    if len(service_name) == 0 or len(service_name) > data_formats.SERVICENAME_MAX_LENGTH:
+        return "service name must be 1-{} characters".format(data_formats.SERVICENAME_MAX_LENGTH)
+    # The menu commands split their parameters on spaces, so they couldn't name it
+    if any(character.isspace() for character in service_name):
+        return "service name can't contain whitespace"
+    if not (data_formats.USERNAME_MIN_LENGTH <= len(fields["username"]) <=
+            data_formats.USERNAME_MAX_LENGTH):
+        return "username must be {}-{} characters".format(data_formats.USERNAME_MIN_LENGTH,
+                                                          data_formats.USERNAME_MAX_LENGTH)
+    if not (data_formats.PASSWORD_MIN_LENGTH <= len(fields["password"]) <=
+            data_formats.PASSWORD_MAX_LENGTH):
+        return "password must be {}-{} characters".format(data_formats.PASSWORD_MIN_LENGTH,
+                                                          data_formats.PASSWORD_MAX_LENGTH)
+    if service_name in main_account.service_names():
+        return "{} already exists".format(service_name)
+    return None
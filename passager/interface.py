@@ -8,13 +8,26 @@ later on.
 """
 import getpass
 import logging
+import sys
+import time
 
-from typing import Optional, Sequence, Tuple
+from typing import TYPE_CHECKING, Callable, Dict, Optional, Sequence, Tuple
 
+import passager.breach as breach
 import passager.data_formats as data_formats
+import passager.locking as locking
+import passager.profiling as profiling
 
 from passager.data_formats import MainAccount, MenuOptions, ServiceAccount
 
+if TYPE_CHECKING:
+    # Importing these for real would load the whole storage for every command
+    from passager.audit import Report as AuditReport
+    from passager.backup import BackupResult, Snapshot
+    from passager.fsck import Report
+    from passager.importer import ImportResult
+    from passager.sync import SyncResult
+
 MENU_COMMANDS = {
     "HELP": MenuOptions.HELP,
     "H": MenuOptions.HELP,
@@ -43,6 +56,9 @@ MENU_COMMANDS = {
     "MAIN-ACCOUNT-REMOVE": MenuOptions.MAIN_ACCOUNT_REMOVE,
     "MAIN-RM": MenuOptions.MAIN_ACCOUNT_REMOVE,
 
+    "AUDIT": MenuOptions.AUDIT,
+    "PW-AUDIT": MenuOptions.AUDIT,
+
     "LOGOUT": MenuOptions.LOGOUT,
     "EXIT": MenuOptions.LOGOUT,
     "QUIT": MenuOptions.LOGOUT,
@@ -107,6 +123,13 @@ _MENU_COMMAND_INFO = {
         "example": "main-rm",
         "parameter-count": (0, ),
     },
+    MenuOptions.AUDIT: {
+        "name": ("AUDIT", "aliases: PW-AUDIT"),
+        "description": "check every service account's password for weakness, breaches and reuse",
+        "usage": "audit",
+        "example": "audit",
+        "parameter-count": (0, ),
+    },
     MenuOptions.LOGOUT: {
         "name": ("LOGOUT", "aliases: EXIT, QUIT, Q, SHUTDOWN, CLOSE"),
         "description": "log out of the system: shut down the program",
@@ -128,11 +151,26 @@ _PW_RANK = {
 _logger = logging.getLogger(__name__)
 
 
-def accept_new_password(account_name: str, password: str, strength: int) -> bool:
+def accept_breached_password(service_name: str, times_breached: int) -> bool:
+    _display_breach_warning(times_breached)
+    while True:
+        answer = _ask("Do you still wish to add the account for '{}' (yes/no)? >".format(service_name))
+        if answer.upper() in ("Y", "YES"):
+            return True
+        elif answer.upper() in ("N", "NO"):
+            print("\nService account wasn't added.")
+            return False
+        print("\nInvalid input.")
+
+
+def accept_new_password(account_name: str,
+                        password: str,
+                        strength: int,
+                        times_breached: int = 0) -> bool:
     # account_name can be either service name or main account name
-    _display_password_strength(account_name, password, strength)
+    _display_password_strength(account_name, password, strength, times_breached)
     while True:
-        answer = input("Do you wish to make the password change (yes/no)? >")
+        answer = _ask("Do you wish to make the password change (yes/no)? >")
         if answer.upper() in ("Y", "YES"):
             print("\nPassword was changed successfully.")
             return True
@@ -142,6 +180,67 @@ def accept_new_password(account_name: str, password: str, strength: int) -> bool
         print("\nInvalid input.")
 
 
+def agent_locked():
+    print("The agent locked itself and stopped.")
+
+
+def agent_not_started(error: str):
+    print("Couldn't start the agent: {}".format(error))
+
+
+def agent_password(password: str):
+    # Printed bare so that scripts can capture it
+    print(password)
+
+
+def agent_request_failed(error: str):
+    print("The agent refused: {}".format(error), file=sys.stderr)
+
+
+def agent_started(socket_path: str, idle_timeout: float):
+    print("Agent listening on {}.".format(socket_path))
+    print("It locks itself after {:g} seconds without requests.".format(idle_timeout))
+    print("Point clients to it with PASSAGER_AGENT_SOCKET={}".format(socket_path))
+
+
+def agent_unavailable(socket_path: str):
+    print("No agent is listening on {}. Start one with 'passager.py agent'.".format(socket_path),
+          file=sys.stderr)
+
+
+def agent_untrusted(error: str):
+    print("Not asking the agent: {}".format(error), file=sys.stderr)
+
+
+def _ask(prompt: str) -> str:
+    # The time spent waiting for the user is left out of the profile's timers
+    with profiling.prompting():
+        return input(prompt)
+
+
+def _ask_secret(prompt: str) -> str:
+    with profiling.prompting():
+        return getpass.getpass(prompt)
+
+
+def audit_report(report: "AuditReport"):
+    print("{:<{}} {:<12} {:>9}  {}".format("Service", _PADDING, "Strength", "Breached", "Shared with"))
+    for entry in report.entries:
+        shared = ", ".join(entry.reused_with + ["~" + name for name in entry.similar_to])
+        print("{:<{}} {:<12} {:>9}  {}".format(entry.service_name,
+                                               _PADDING,
+                                               _PW_RANK[entry.strength],
+                                               entry.times_breached,
+                                               shared).rstrip())
+    print("\nAudited {} service accounts: {} breached, {} reused and {} with a "
+          "similar password.".format(len(report.entries),
+                                     report.breached_count(),
+                                     report.reused_count(),
+                                     report.similar_count()))
+    if report.similar_count() != 0:
+        print("Services marked with ~ have a password only slightly different.")
+
+
 def authentication_login(main_username: str) -> Tuple[str, str]:
     print("You need to authenticate yourself to use this command.")
     print("Log in using your main account credentials\n")
@@ -150,10 +249,164 @@ def authentication_login(main_username: str) -> Tuple[str, str]:
     return username, password
 
 
-def _display_password_strength(account_name: str, password: str, strength: int):
+def backup_failed(error: str):
+    print("The backup failed: {}".format(error), file=sys.stderr)
+
+
+def backup_finished(result: "BackupResult", backup_directory: str):
+    print("Took snapshot {} of {} files into {}.".format(result.snapshot.name,
+                                                         len(result.snapshot.files),
+                                                         backup_directory))
+    print("{} changed files were read and {} new ones ({} bytes) copied.".format(result.hashed_count,
+                                                                                 result.copied_count,
+                                                                                 result.copied_bytes))
+
+
+def backup_snapshots(snapshots: Sequence["Snapshot"]):
+    if len(snapshots) == 0:
+        print("There are no snapshots.")
+        return
+    print("{:<24} {:<20} {:>8} {:>12}".format("snapshot", "taken", "files", "bytes"))
+    for snapshot in snapshots:
+        print("{:<24} {:<20} {:>8} {:>12}".format(snapshot.name,
+                                                  time.strftime("%Y-%m-%d %H:%M:%S",
+                                                                time.localtime(snapshot.created)),
+                                                  len(snapshot.files),
+                                                  snapshot.size()))
+
+
+def bench_import_budget(over_budget: Sequence[Tuple[str, float]], budget_ms: float):
+    if len(over_budget) == 0:
+        print("\nImports are within the budget of {:.1f} ms.".format(budget_ms))
+        return
+    print("\n{} commands spend over {:.1f} ms importing:".format(len(over_budget), budget_ms))
+    for command, seconds in over_budget:
+        print("  {}: {:.1f} ms".format(command, seconds * 1000))
+
+
+def bench_progress(benchmark: str):
+    print("Running {}...".format(benchmark))
+
+
+def bench_regressions(regressions: Sequence[Tuple[str, float, float]], tolerance: float):
+    if len(regressions) == 0:
+        print("\nNo regressions from the baseline.")
+        return
+    print("\n{} benchmarks are over {:.0%} slower than the baseline:".format(len(regressions),
+                                                                             tolerance))
+    for name, baseline_median, median in regressions:
+        print("  {}: {:.3f} ms -> {:.3f} ms".format(name, baseline_median * 1000, median * 1000))
+
+
+def bench_results(results: Dict):
+    print("\n{:<48} {:>12} {:>12} {:>12}".format("benchmark", "median ms", "min ms", "max ms"))
+    for name, result in results["benchmarks"].items():
+        print("{:<48} {:>12.3f} {:>12.3f} {:>12.3f}".format(name,
+                                                            result["median"] * 1000,
+                                                            result["min"] * 1000,
+                                                            result["max"] * 1000))
+
+
+def breach_list_building(source_path: str):
+    print("Converting {} into the breached password list. Large dumps take a while...".format(
+          source_path))
+
+
+def breach_list_built(count: int):
+    print("The breached password list has {} passwords. New passwords are checked against it.".format(
+          count))
+
+
+def breach_list_failed(error: str):
+    print("The breached password list couldn't be built: {}".format(error), file=sys.stderr)
+
+
+def breach_list_progress(line_count: int):
+    print("Read {} lines...".format(line_count))
+
+
+def cipher_selected(algorithm: str):
+    print("New service account files are encrypted with {}.".format(algorithm))
+    print("Existing ones are re-encrypted on their main account's next login.")
+
+
+def _display_breach_warning(times_breached: int):
+    print("WARNING: This password has appeared {} times in data breaches.".format(times_breached))
+    print("Attackers try such passwords first, so it shouldn't be used anywhere.\n")
+
+
+def _display_password_strength(account_name: str,
+                               password: str,
+                               strength: int,
+                               times_breached: int = 0):
     print("You've entered password '{}' for account {}.".format(password,
                                                                 account_name))
     print("This password is considered {}.\n".format(_PW_RANK[strength]))
+    if times_breached > 0:
+        _display_breach_warning(times_breached)
+
+
+def export_finished(count: int, path: str):
+    print("Exported {} service accounts into {}.".format(count, path))
+
+
+def export_passphrase() -> Optional[str]:
+    print("Choose a passphrase for the export. It's needed for importing the export later on.")
+    print("Enter empty to cancel.\n")
+    while True:
+        passphrase = _ask_secret("Passphrase: ")
+        if len(passphrase) == 0:
+            print("Canceling the export.")
+            return None
+        if _ask_secret("Confirm the passphrase: ") == passphrase:
+            return passphrase
+        print("The passphrases didn't match! Please enter the passphrase again.\n")
+
+
+def export_unencrypted_warning(path: str):
+    print("WARNING: {} will contain your passwords as plain text.".format(path))
+    print("Delete it as soon as you don't need it anymore.\n")
+
+
+def fsck_finished(report: "Report", repaired: bool):
+    for finding in report.findings:
+        print("{:>14}  {:>9} B  {}  ({})".format(finding.issue,
+                                                 finding.size,
+                                                 finding.path,
+                                                 finding.description))
+    print("\nChecked {} files ({} bytes), {} of them service account files.".format(
+          report.scanned_files, report.scanned_bytes, report.service_files))
+    if len(report.findings) == 0:
+        print("Nothing to repair.")
+    elif not repaired:
+        print("Found {} problems worth {} bytes. Run with --repair to fix them.".format(
+              len(report.findings), sum(finding.size for finding in report.findings)))
+    else:
+        removed_count = report.removed_service_files()
+        print("Freed {} bytes.".format(report.freed_bytes()))
+        print("Logins scanning the directory trial-decrypt {} fewer files ({} -> {}).".format(
+              removed_count, report.service_files, report.service_files - removed_count))
+
+
+def import_finished(result: "ImportResult"):
+    for position, reason in result.rejected:
+        print("Skipped record {}: {}".format(position, reason))
+    if result.rejected_count > len(result.rejected):
+        print("...and {} more.".format(result.rejected_count - len(result.rejected)))
+    print("Imported {} service accounts, skipped {}.".format(result.imported_count,
+                                                             result.rejected_count))
+
+
+def import_format_unknown(path: str):
+    print("Couldn't tell the format of {}, select it with --format.".format(path))
+
+
+def import_passphrase(path: str) -> str:
+    return _ask_secret("Passphrase of {}: ".format(path))
+
+
+def import_unreadable(path: str, reason: str):
+    print("Couldn't import {}: {}".format(path, reason))
 
 
 def invalid_command_for_help(command: str):
@@ -201,6 +454,32 @@ def invalid_service_name_length():
           data_formats.SERVICENAME_MAX_LENGTH))
 
 
+def kdf_calibrated(kdf_parameters: Dict):
+    parameters = ", ".join("{}={}".format(name, value) for name, value in kdf_parameters.items())
+    print("Selected the parameters: {}".format(parameters))
+    print("Main accounts are upgraded to these on their next login.")
+
+
+def kdf_calibration_started(kdf: str, target_ms: int):
+    print("Measuring {} on this machine for a {} ms unlock time...".format(kdf, target_ms))
+
+
+def lock_waiting(lock_name: str):
+    if lock_name == locking.REGISTRY:
+        lock_name = "the main accounts"
+    print("Waiting for another Passager process to finish with {}...".format(lock_name))
+
+
+def lock_wait_report(statistics: Dict[str, Tuple[int, float, float]]):
+    # Goes to stderr so that it doesn't mix with what scripts read from stdout
+    print("\nWaited for other Passager processes:", file=sys.stderr)
+    for lock_name, (waits, total, longest) in sorted(statistics.items()):
+        if lock_name == locking.REGISTRY:
+            lock_name = "the main accounts"
+        print("  {}: {} x, {:.2f} s total, {:.2f} s longest".format(lock_name, waits, total, longest),
+              file=sys.stderr)
+
+
 def login() -> Tuple[str, str]:
     print("\nWelcome to Passager!")
     print("Please enter your Main Account credentials to log in.")
@@ -214,8 +493,8 @@ def _login_input(known_username: str = None) -> Tuple[str, str]:
         print("Username: {}".format(known_username))
         username = known_username
     else:
-        username = input("Username: ")
-    password = getpass.getpass("Password: ")
+        username = _ask("Username: ")
+    password = _ask_secret("Password: ")
     return username, password
 
 
@@ -236,7 +515,7 @@ def main_account_deletion_confirmation(main_account: MainAccount) -> bool:
     print("All of your {} service accounts' login credentials will be deleted.\n".format(
         account_count))
     while True:
-        answer = input("Are you sure you want to delete this account (yes/no)? >")
+        answer = _ask("Are you sure you want to delete this account (yes/no)? >")
         if answer.upper() in ["Y", "N"]:
             print("Please, enter the entire word for confirmation.")
         elif answer.upper() == "NO":
@@ -248,7 +527,7 @@ def main_account_deletion_confirmation(main_account: MainAccount) -> bool:
 def main_account_register_password(username: str) -> Optional[str]:
     print("Please enter a password for your Main Account\nEnter empty to cancel.\n")
     while True:
-        password = input("Password: ")
+        password = _ask("Password: ")
 
         if len(password) == 0:
             # User wanted to cancel
@@ -260,12 +539,12 @@ def main_account_register_password(username: str) -> Optional[str]:
             continue
 
         strength = data_formats.check_password_strength(password)
-        _display_password_strength(username, password, strength)
+        _display_password_strength(username, password, strength, breach.times_breached(password))
 
         print("Confirm the password. Enter blank to change the password.")
         while True:
             # Confirm that the user is happy with the password
-            confirmation = getpass.getpass("Confirm the password: ")
+            confirmation = _ask_secret("Confirm the password: ")
             if confirmation == "":
                 print("Canceled the password selection.")
                 break
@@ -279,11 +558,11 @@ def main_account_register_password(username: str) -> Optional[str]:
         return password
 
 
-def main_account_register_username(usernames: Sequence[str]) -> Optional[str]:
+def main_account_register_username(username_taken: Callable[[str], bool]) -> Optional[str]:
     print("\nWelcome to Passager account registration!")
     print("Please enter a username for your Main Account\nEnter empty to cancel.\n")
     while True:
-        username = input("Username: ")
+        username = _ask("Username: ")
 
         if len(username) == 0:
             # User wanted to cancel
@@ -291,27 +570,31 @@ def main_account_register_username(usernames: Sequence[str]) -> Optional[str]:
             return None
 
         # TODO: Platform independency
-        if "/" in username:
-            print("Usernames are not allowed to contain '/' character. ", end="")
+        if "/" in username or ".." in username:
+            print("Usernames are not allowed to contain '/' or '..'. ", end="")
             print("Please select another one.\n")
             continue
 
         # Make sure the username is of an allowed length
         if not valid_username_length(username):
             continue
-        if username in usernames:
+        if username_taken(username):
             print("That username is already taken. Please select another one.\n")
             continue
         return username
 
 
+def main_account_register_username_taken(username: str):
+    print("{} was registered by someone else meanwhile. Please start over.".format(username))
+
+
 def main_account_removed(main_account: MainAccount):
     name = main_account.account_name
     service_account_count = len(main_account.service_accounts)
     print("{} service accounts have been removed successfully!".format(service_account_count))
     print("\nMain account {} has been removed successfully!".format(name))
     print("You will now be logged out and the program will shut down.\n")
-    input("{} PRESS ENTER TO CONTINUE {}".format(_PADDING * "=", _PADDING * "="))
+    _ask("{} PRESS ENTER TO CONTINUE {}".format(_PADDING * "=", _PADDING * "="))
 
 
 def main_menu() -> Optional[Tuple[MenuOptions, Sequence[str]]]:
@@ -328,7 +611,7 @@ def main_menu() -> Optional[Tuple[MenuOptions, Sequence[str]]]:
     print("\n{} MAIN MENU {}\n".format(_PADDING * "=", _PADDING * "="))
 
     while True:
-        user_input = input("Enter command >").split(" ")
+        user_input = _ask("Enter command >").split(" ")
         input_command = user_input[0]
         input_parameters = user_input[1:]
         print("")
@@ -338,11 +621,24 @@ def main_menu() -> Optional[Tuple[MenuOptions, Sequence[str]]]:
             print("Invalid command. Use command 'HELP' for help on commands.")
 
 
+def migration_finished(file_count: int):
+    print("Migration finished: {} files were moved into the new layout.".format(file_count))
+
+
+def migration_progress(file_count: int):
+    print("Moved {} files...".format(file_count))
+
+
+def migration_started():
+    print("Migrating the accounts directory into the new layout.")
+    print("Passager can be used meanwhile. If the migration is interrupted, run it again to resume.\n")
+
+
 def new_password(account_name: str) -> str:
     # account_name can be either service name or main account name
     print("Changing password for {}.".format(account_name))
     print("If you do not want to change the password, just press enter without entering any characters.\n")
-    password = input("Enter new password: ")
+    password = _ask("Enter new password: ")
     return password
 
 
@@ -401,6 +697,60 @@ def _print_service_account(service_account: ServiceAccount):
     print("PASSWORD: {}".format(service_account.service_password))
 
 
+def profile_report(timers: Dict[str, Tuple[int, float, float, Dict[int, int]]],
+                   counters: Dict[str, int],
+                   function_profile: Optional[str],
+                   memory_profile: Optional[Tuple[int, Sequence[str]]]):
+    # Goes to stderr so that it doesn't mix with what scripts read from stdout
+    print("\n{} PROFILE {}".format(_PADDING * "=", _PADDING * "="), file=sys.stderr)
+    for name, (count, total, longest, histogram) in sorted(timers.items()):
+        print("{}: {} x, {:.1f} ms total, {:.1f} ms longest".format(name,
+                                                                    count,
+                                                                    total * 1000,
+                                                                    longest * 1000),
+              file=sys.stderr)
+        for bound, bucket_count in sorted(histogram.items()):
+            print("  <= {:>6} ms  {}".format(bound, bucket_count), file=sys.stderr)
+    for name, value in sorted(counters.items()):
+        print("{}: {}".format(name, value), file=sys.stderr)
+    if function_profile is not None:
+        print("\nFunctions of the main thread by cumulative time:", file=sys.stderr)
+        print(function_profile, file=sys.stderr)
+    if memory_profile is not None:
+        peak, lines = memory_profile
+        print("Peak traced memory {:.1f} MB. Lines allocating the most:".format(peak / 2 ** 20),
+              file=sys.stderr)
+        for line in lines:
+            print("  " + line, file=sys.stderr)
+
+
+def restore_confirmation(snapshot: "Snapshot") -> bool:
+    print("Restoring snapshot {} taken at {}.".format(snapshot.name,
+                                                      time.strftime("%Y-%m-%d %H:%M:%S",
+                                                                    time.localtime(snapshot.created))))
+    print("Every change made to the accounts since will be lost.\n")
+    while True:
+        answer = _ask("Are you sure you want to restore it (yes/no)? >")
+        if answer.upper() in ["Y", "N"]:
+            print("Please, enter the entire word for confirmation.")
+        elif answer.upper() == "NO":
+            return False
+        elif answer.upper() == "YES":
+            return True
+
+
+def restore_failed(error: str):
+    print("The restore failed: {}".format(error), file=sys.stderr)
+
+
+def restore_finished(written: int, removed: int):
+    print("Restored the accounts: {} files written and {} removed.".format(written, removed))
+
+
+def restore_snapshot_not_found(backup_directory: str):
+    print("No snapshot to restore in {}.".format(backup_directory), file=sys.stderr)
+
+
 def service_account_added(service_account: ServiceAccount):
     print("Successfully added the following account: ")
     _print_service_account(service_account)
@@ -422,11 +772,49 @@ def service_accounts(main_account: MainAccount):
         print("")
 
 
+def service_accounts_already_packed(main_account: MainAccount):
+    print("The service accounts of {} are already packed into a single file.".format(
+          main_account.account_name))
+
+
+def service_accounts_packed(main_account: MainAccount):
+    print("{} service accounts of {} were packed into a single file.".format(
+          len(main_account.service_accounts), main_account.account_name))
+
+
+def service_accounts_refreshed(added: int, removed: int):
+    print("Another process has added {} and removed {} service accounts meanwhile.\n".format(added,
+                                                                                             removed))
+
+
 def service_already_exists(service_name: str):
     print("Service cannot be added: You already have a service account for {}".format(
           service_name))
 
 
+def sync_failed(error: str):
+    print("The sync failed: {}".format(error), file=sys.stderr)
+
+
+def sync_finished(result: "SyncResult"):
+    print("Synced: {} files sent and {} received in {} round trips.".format(result.sent,
+                                                                            result.received,
+                                                                            result.round_trips))
+    if len(result.conflicts) != 0:
+        print("Changed on both sides, the other version is kept under .sync/conflicts/:")
+        for path in result.conflicts:
+            print("  {}".format(path))
+
+
+def sync_not_served(error: str):
+    print("Couldn't serve the accounts for syncing: {}".format(error), file=sys.stderr)
+
+
+def sync_serving(socket_path: str):
+    print("Serving the accounts for syncing on {}. Stop with Ctrl+C.".format(socket_path))
+    print("Sync with them with 'passager.py sync --socket {}'".format(socket_path))
+
+
 def train_login_for(account: ServiceAccount, no_username: bool):
     # Actual implementation for the login
     success_counter = 1
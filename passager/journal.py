@@ -0,0 +1,243 @@
+#!/bin/python3
+"""
+Journal module makes storage operations spanning several files crash safe.
+
+The new contents of every file are first written into a staging directory and
+flushed to disk together, then a commit record listing the operations is moved
+into place. Only then are the staged files renamed over their targets and the
+removed files deleted. A transaction interrupted before its commit record
+exists is rolled back on the next startup by dropping the staged files; one
+interrupted after it is replayed. Either way no operation is left half done.
+"""
+import json
+import logging
+import os
+
+from typing import Dict, Iterable, List, Optional
+
+# The staging directory inside the accounts directory
+_JOURNAL_DIR = ".journal/"
+_COMMIT_FILE = "commit"
+_STAGED_FILE_EXT = ".staged"
+# From this many staged files on, the whole file system is flushed at once
+_SYNC_ALL_THRESHOLD = 256
+
+_logger = logging.getLogger(__name__)
+
+
+class Journal:
+    def __init__(self, directory: str):
+        self._directory = os.path.join(directory, "")
+        # One transaction directory per process so that concurrent processes
+        # don't stage into each other's transactions
+        self._transaction_dir = (self._directory + _JOURNAL_DIR +
+                                 "{}-{}/".format(os.getpid(), os.urandom(4).hex()))
+        # Target path -> staged file name, or None when the target is removed.
+        # Only the last operation on a path counts so replaying is idempotent.
+        self._operations = {}
+        self._staged_count = 0
+
+    def __len__(self) -> int:
+        return len(self._operations)
+
+    def abort(self):
+        if _read_record(self._transaction_dir) is not None:
+            # Failed while being applied, only recover() may finish it now
+            return
+        # Drops the staged files, nothing has been touched outside the journal
+        _remove_transaction(self._transaction_dir)
+        self._operations = {}
+
+    def commit(self):
+        if len(self._operations) == 0:
+            self.abort()
+            return
+
+        os.makedirs(self._transaction_dir, exist_ok=True)
+        # Flush all the staged files in one go instead of one write at a time
+        staged_names = [name for name in self._operations.values() if name is not None]
+        if len(staged_names) >= _SYNC_ALL_THRESHOLD and hasattr(os, "sync"):
+            # A single system wide flush beats thousands of separate ones
+            os.sync()
+        else:
+            for staged_name in staged_names:
+                _fsync_file(self._transaction_dir + staged_name)
+            _fsync_directory(self._transaction_dir)
+
+        # Moving the record into place is the point of no return
+        record = {os.path.relpath(path, self._directory): staged_name
+                  for path, staged_name in self._operations.items()}
+        record_path = self._transaction_dir + _COMMIT_FILE
+        with open(record_path + ".tmp", "w") as target:
+            json.dump(record, target)
+            target.flush()
+            os.fsync(target.fileno())
+        os.replace(record_path + ".tmp", record_path)
+        _fsync_directory(self._transaction_dir)
+
+        _apply(self._directory, self._transaction_dir, record)
+        _logger.info("Committed %s file operations", len(self._operations))
+        self._operations = {}
+
+    def current_path(self, path: str) -> Optional[str]:
+        """Where the contents the path will have after the commit are now, so
+        that the transaction sees its own changes. None if the path is removed.
+        """
+        if path not in self._operations:
+            return path
+        staged_name = self._operations[path]
+        if staged_name is None:
+            return None
+        return self._transaction_dir + staged_name
+
+    def remove(self, path: str):
+        self._drop_staged(path)
+        self._operations[path] = None
+
+    def staged_path(self, path: str) -> str:
+        """Reserves a staging file for the path and returns where it is. The
+        caller writes the file itself; it replaces the path on commit.
+        """
+        self._drop_staged(path)
+        os.makedirs(self._transaction_dir, exist_ok=True)
+        staged_name = "{}{}".format(self._staged_count, _STAGED_FILE_EXT)
+        self._staged_count += 1
+        self._operations[path] = staged_name
+        return self._transaction_dir + staged_name
+
+    def write(self, path: str, contents: bytes):
+        with open(self.staged_path(path), "wb") as target:
+            target.write(contents)
+
+    def _drop_staged(self, path: str):
+        staged_name = self._operations.pop(path, None)
+        if staged_name is not None:
+            try:
+                os.remove(self._transaction_dir + staged_name)
+            except FileNotFoundError:
+                pass
+
+
+def _apply(directory: str, transaction_dir: str, record: Dict[str, Optional[str]]):
+    # Carries out a committed transaction. Safe to repeat after a crash.
+    changed_dirs = set()
+    for relative_path, staged_name in record.items():
+        path = os.path.join(directory, relative_path)
+        changed_dirs.add(os.path.dirname(path))
+        if staged_name is None:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            continue
+
+        staged_path = transaction_dir + staged_name
+        if not os.path.exists(staged_path):
+            # Already moved into place before the interruption
+            continue
+        try:
+            os.replace(staged_path, path)
+        except FileNotFoundError:
+            # The main account's (shard) directory doesn't exist yet
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(staged_path, path)
+
+    for changed_dir in changed_dirs:
+        _fsync_directory(changed_dir)
+    _remove_transaction(transaction_dir)
+
+
+def _fsync_directory(path: str):
+    # Makes renames and removals in the directory durable
+    try:
+        descriptor = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return
+    try:
+        os.fsync(descriptor)
+    except OSError:
+        # Not supported for directories on every platform
+        pass
+    finally:
+        os.close(descriptor)
+
+
+def _fsync_file(path: str):
+    with open(path, "rb") as source:
+        os.fsync(source.fileno())
+
+
+def _is_running(transaction_name: str) -> bool:
+    pid = int(transaction_name.split("-")[0])
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def pending(directory: str) -> bool:
+    # Whether there are transactions, interrupted or in progress, in the directory
+    return len(_transaction_names(os.path.join(directory, ""))) != 0
+
+
+def _read_record(transaction_dir: str) -> Optional[Dict[str, Optional[str]]]:
+    try:
+        with open(transaction_dir + _COMMIT_FILE) as source:
+            return json.load(source)
+    except FileNotFoundError:
+        return None
+
+
+def recover(directory: str) -> int:
+    """Finishes the transactions interrupted by a crash: committed ones are
+    replayed and the rest rolled back. Returns the number of replayed ones.
+    """
+    directory = os.path.join(directory, "")
+    replayed_count = 0
+    for transaction_name in _transaction_names(directory):
+        if _is_running(transaction_name):
+            # Still being staged by another process
+            continue
+        transaction_dir = directory + _JOURNAL_DIR + transaction_name + "/"
+        record = _read_record(transaction_dir)
+        if record is None:
+            _logger.warning("Rolling back an uncommitted transaction %s", transaction_name)
+            _remove_transaction(transaction_dir)
+        else:
+            _logger.warning("Replaying a committed transaction %s", transaction_name)
+            _apply(directory, transaction_dir, record)
+            replayed_count += 1
+    return replayed_count
+
+
+def _remove_files(paths: Iterable[str]):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _remove_transaction(transaction_dir: str):
+    # The commit record goes first so that a half removed transaction is
+    # never mistaken for a committed one
+    _remove_files([transaction_dir + _COMMIT_FILE])
+    try:
+        with os.scandir(transaction_dir) as entries:
+            _remove_files([entry.path for entry in entries])
+        os.rmdir(transaction_dir)
+    except FileNotFoundError:
+        pass
+
+
+def _transaction_names(directory: str) -> List[str]:
+    try:
+        with os.scandir(directory + _JOURNAL_DIR) as entries:
+            return [entry.name for entry in entries if entry.is_dir()]
+    except FileNotFoundError:
+        return []
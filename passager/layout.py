@@ -0,0 +1,328 @@
+#!/bin/python3
+"""
+Layout module is responsible for knowing where the account files are located on
+disk. There are two versions of the on-disk layout:
+    1: every file is kept flat in the accounts directory
+    2: every main account has a subdirectory of its own and the service account
+       files inside it are sharded by a hash prefix of their filename
+The version in use is recorded in the accounts directory's vault file. Version 1
+directories can be converted into version 2 while they're in use with migrate().
+"""
+import hashlib
+import json
+import logging
+import os
+
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+CONTAINER_FILE_EXT = ".vault"
+LAYOUT_FLAT = 1
+LAYOUT_SHARDED = 2
+MAIN_FILE_EXT = ".account"
+MANIFEST_FILE_EXT = ".manifest"
+SERVICE_FILE_EXT = ".service"
+
+# TODO: Platform independency
+_FILE_DIR = os.path.dirname(os.path.realpath(__file__)) + "/accounts/"
+if not os.path.isdir(os.path.dirname(_FILE_DIR)):
+    # Run from a zipapp, which can't be written into
+    _FILE_DIR = os.path.join(os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share"),
+                             "passager", "accounts", "")
+    os.makedirs(_FILE_DIR, mode=0o700, exist_ok=True)
+_BREACH_LIST_FILE = "breached-passwords.bin"
+# Layout 2: the directory containing the main account subdirectories
+_MAIN_DIR = "main/"
+# How often the migration reports its progress (in files)
+_MIGRATION_PROGRESS_INTERVAL = 1000
+# Layout 2: the home of service account files whose owner isn't known yet.
+# The files are moved to the owner's directory when the owner logs in.
+_SERVICE_DIR = "services/"
+# Number of hex characters used for naming the shard directories
+_SHARD_LENGTH = 2
+_VAULT_FILE = "vault.json"
+
+_logger = logging.getLogger(__name__)
+
+_vault_config = None
+_vault_config_mtime = None
+
+
+def accounts_directory() -> str:
+    return _FILE_DIR
+
+
+def breach_list_path() -> str:
+    return _FILE_DIR + _BREACH_LIST_FILE
+
+
+def container_paths(main_accountname: str) -> List[str]:
+    # Where the main account's packed container file may be found
+    return _main_account_file_paths(main_accountname + CONTAINER_FILE_EXT)
+
+
+def _flat_path(filename: str) -> str:
+    return _FILE_DIR + filename
+
+
+def _is_migrating() -> bool:
+    return vault_config().get("migrating", False)
+
+
+def layout_version() -> int:
+    return vault_config().get("layout", LAYOUT_FLAT)
+
+
+def main_account_directory(main_accountname: str) -> str:
+    # Layout 2 only
+    return _FILE_DIR + _MAIN_DIR + main_accountname + "/"
+
+
+def main_account_exists(main_accountname: str) -> bool:
+    for path in main_account_paths(main_accountname):
+        if os.path.exists(path):
+            return True
+    return False
+
+
+def main_account_names() -> Iterator[str]:
+    if layout_version() == LAYOUT_SHARDED:
+        try:
+            with os.scandir(_FILE_DIR + _MAIN_DIR) as entries:
+                for entry in entries:
+                    if entry.is_dir() and main_account_exists(entry.name):
+                        yield entry.name
+        except FileNotFoundError:
+            pass
+        if not _is_migrating():
+            return
+
+    with os.scandir(_FILE_DIR) as entries:
+        for entry in entries:
+            if entry.name.endswith(MAIN_FILE_EXT) and entry.is_file():
+                yield entry.name[:-len(MAIN_FILE_EXT)]
+
+
+def _main_account_file_paths(filename: str) -> List[str]:
+    # Where a file of the main account may be found, in the order of likelihood.
+    # The filename begins with the main account's name.
+    main_accountname = filename[:filename.rindex(".")]
+    if layout_version() == LAYOUT_FLAT:
+        return [_flat_path(filename)]
+    paths = [main_account_directory(main_accountname) + filename]
+    if _is_migrating():
+        paths.append(_flat_path(filename))
+    return paths
+
+
+def main_account_paths(main_accountname: str) -> List[str]:
+    return _main_account_file_paths(main_accountname + MAIN_FILE_EXT)
+
+
+def manifest_path(main_accountname: str) -> str:
+    return manifest_paths(main_accountname)[0]
+
+
+def manifest_paths(main_accountname: str) -> List[str]:
+    return _main_account_file_paths(main_accountname + MANIFEST_FILE_EXT)
+
+
+def migrate(progress: Callable[[int], None] = None) -> int:
+    """Converts a layout 1 directory into layout 2. The files are moved one by
+    one with atomic renames while the directory is streamed, so the vault stays
+    usable during the migration and an interrupted migration can be resumed by
+    running it again. Returns the number of files moved.
+    """
+    config = vault_config()
+    config["layout"] = LAYOUT_SHARDED
+    config["migrating"] = True
+    store_vault_config(config)
+
+    created_dirs = set()
+    moved_count = 0
+    while True:
+        # Files created by processes that haven't noticed the layout change yet
+        # may appear during the pass, so keep going until nothing is left.
+        moved_in_pass = 0
+        with os.scandir(_FILE_DIR) as entries:
+            for entry in entries:
+                target = _migration_target(entry.name)
+                if target is None or not entry.is_file():
+                    continue
+
+                target_dir = os.path.dirname(target)
+                if target_dir not in created_dirs:
+                    os.makedirs(target_dir, exist_ok=True)
+                    created_dirs.add(target_dir)
+                try:
+                    if os.path.exists(target):
+                        # Already rewritten in the new layout, the old copy is stale
+                        os.remove(entry.path)
+                    else:
+                        os.rename(entry.path, target)
+                except FileNotFoundError:
+                    # Removed or moved by someone else meanwhile
+                    continue
+
+                moved_in_pass += 1
+                moved_count += 1
+                if progress is not None and moved_count % _MIGRATION_PROGRESS_INTERVAL == 0:
+                    progress(moved_count)
+        if moved_in_pass == 0:
+            break
+
+    config = vault_config()
+    config.pop("migrating", None)
+    store_vault_config(config)
+    _logger.info("Migrated %s files into layout %s", moved_count, LAYOUT_SHARDED)
+    return moved_count
+
+
+def _migration_target(filename: str):
+    if filename.endswith(SERVICE_FILE_EXT):
+        # The owner can't be known without the owner's key
+        return _FILE_DIR + _SERVICE_DIR + shard(filename) + "/" + filename
+    for extension in (MAIN_FILE_EXT, MANIFEST_FILE_EXT, CONTAINER_FILE_EXT):
+        if filename.endswith(extension):
+            main_accountname = filename[:-len(extension)]
+            return main_account_directory(main_accountname) + filename
+    return None
+
+
+def remove_main_account_directory(main_accountname: str):
+    # Removes the directory tree of a main account if nothing is left in it
+    if layout_version() == LAYOUT_FLAT:
+        return
+    directory = main_account_directory(main_accountname)
+    try:
+        with os.scandir(directory) as entries:
+            shard_dirs = [entry.path for entry in entries if entry.is_dir()]
+    except FileNotFoundError:
+        return
+    try:
+        for shard_dir in shard_dirs:
+            os.rmdir(shard_dir)
+        os.rmdir(directory)
+    except OSError as e:
+        _logger.warning("Main account directory %s couldn't be removed: %s", directory, e)
+
+
+def service_filenames(main_accountname: str) -> Iterator[Tuple[str, str]]:
+    """Yields (filename, path) of every service account file that may belong to
+    the main account. In layout 1 that's every service account file there is.
+    """
+    if layout_version() == LAYOUT_SHARDED:
+        yield from _sharded_files(main_account_directory(main_accountname))
+        yield from _sharded_files(_FILE_DIR + _SERVICE_DIR)
+        if not _is_migrating():
+            return
+
+    with os.scandir(_FILE_DIR) as entries:
+        for entry in entries:
+            if entry.name.endswith(SERVICE_FILE_EXT) and entry.is_file():
+                yield entry.name, entry.path
+
+
+def service_path(main_accountname: str, filename: str) -> str:
+    # Where the service account file is written to
+    if layout_version() == LAYOUT_FLAT:
+        return _flat_path(filename)
+    return main_account_directory(main_accountname) + shard(filename) + "/" + filename
+
+
+def service_paths(main_accountname: str, filename: str) -> List[str]:
+    # Where the service account file may be found, in the order of likelihood
+    if layout_version() == LAYOUT_FLAT:
+        return [_flat_path(filename)]
+    paths = [service_path(main_accountname, filename),
+             _FILE_DIR + _SERVICE_DIR + shard(filename) + "/" + filename]
+    if _is_migrating():
+        paths.append(_flat_path(filename))
+    return paths
+
+
+def set_accounts_directory(directory: str):
+    global _FILE_DIR, _vault_config, _vault_config_mtime
+    _FILE_DIR = os.path.join(directory, "")
+    _vault_config = None
+    _vault_config_mtime = None
+
+
+def shard(filename: str) -> str:
+    return hashlib.sha1(filename.encode("utf-8")).hexdigest()[:_SHARD_LENGTH]
+
+
+def _sharded_files(directory: str) -> Iterator[Tuple[str, str]]:
+    for shard_dir in _subdirectories(directory):
+        with os.scandir(shard_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(SERVICE_FILE_EXT):
+                    yield entry.name, entry.path
+
+
+def storage_directories() -> List[Tuple[str, Optional[str]]]:
+    """Lists every directory that may hold account files along with the name of
+    the main account owning the directory, None for the shared ones.
+    """
+    directories = [(_FILE_DIR, None)]
+    if layout_version() == LAYOUT_FLAT:
+        return directories
+
+    try:
+        with os.scandir(_FILE_DIR + _MAIN_DIR) as entries:
+            main_accountnames = [entry.name for entry in entries if entry.is_dir()]
+    except FileNotFoundError:
+        main_accountnames = []
+    for main_accountname in main_accountnames:
+        directory = main_account_directory(main_accountname)
+        directories.append((directory, main_accountname))
+        directories.extend((shard_dir, main_accountname) for shard_dir in _subdirectories(directory))
+    directories.extend((shard_dir, None) for shard_dir in _subdirectories(_FILE_DIR + _SERVICE_DIR))
+    return directories
+
+
+def store_vault_config(config: Dict):
+    # Replaced atomically as other processes may be reading it
+    path = _FILE_DIR + _VAULT_FILE
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as target:
+        json.dump(config, target)
+    os.replace(temp_path, path)
+
+
+def _subdirectories(directory: str) -> List[str]:
+    try:
+        with os.scandir(directory) as entries:
+            return [os.path.join(entry.path, "") for entry in entries if entry.is_dir()]
+    except FileNotFoundError:
+        return []
+
+
+def watched_directories(main_accountname: str) -> List[Tuple[str, bool]]:
+    """Lists the directories where the main account's files are changed along
+    with whether their subdirectories have to be watched too.
+    """
+    if layout_version() == LAYOUT_FLAT:
+        return [(_FILE_DIR, False)]
+    directories = [(main_account_directory(main_accountname), True),
+                   (_FILE_DIR + _SERVICE_DIR, True)]
+    if _is_migrating():
+        directories.append((_FILE_DIR, False))
+    return directories
+
+
+def vault_config() -> Dict:
+    # Re-read when changed on disk so that running processes notice migrations
+    global _vault_config, _vault_config_mtime
+    try:
+        mtime = os.stat(_FILE_DIR + _VAULT_FILE).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+
+    if _vault_config is None or mtime != _vault_config_mtime:
+        if mtime is None:
+            _vault_config = {}
+        else:
+            with open(_FILE_DIR + _VAULT_FILE) as source:
+                _vault_config = json.load(source)
+        _vault_config_mtime = mtime
+    return dict(_vault_config)
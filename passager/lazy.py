@@ -0,0 +1,25 @@
+#!/bin/python3
+"""
+Lazy module defers executing modules until they're used, so that a command only
+pays for importing the modules it needs and printing the usage for none. The
+command line tools are often run from scripts, where startup is a real share of
+the time taken.
+"""
+import importlib.util
+import sys
+import types
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """Returns the module without executing it yet; that happens when one of its
+    attributes is first used. Already imported modules are returned as they are.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
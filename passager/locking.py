@@ -0,0 +1,158 @@
+#!/bin/python3
+"""
+Locking module coordinates processes sharing an accounts directory. Every main
+account has a reader/writer lock of its own and registrations share one more,
+so readers never wait for each other and writers to one main account don't
+hold up the others. The locks are advisory flock() locks on files in the
+accounts directory; they are released by the kernel if a process dies.
+
+Locks are reentrant within a process. Taking an exclusive lock while holding the
+shared one upgrades it, which isn't atomic: another writer may get its turn in
+between, so whatever was read under the shared lock has to be re-read.
+"""
+import contextlib
+import logging
+import os
+import time
+
+from typing import Callable, Dict, Iterable, Iterator, Tuple
+
+import passager.profiling as profiling
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where the processes go uncoordinated
+    fcntl = None
+
+# Lock name of the set of main accounts
+REGISTRY = ".registry"
+
+_LOCK_DIR = ".locks/"
+_LOCK_FILE_EXT = ".lock"
+# Waits longer than this are logged as warnings
+_SLOW_WAIT_SECONDS = 1.0
+
+_logger = logging.getLogger(__name__)
+
+# Lock path -> [descriptor, exclusive, depth] of the locks this process holds
+_held = {}
+# Lock name -> [waits, total seconds, longest seconds]
+_wait_statistics = {}
+# Called with the lock name when a lock can't be taken right away
+_wait_listener = None
+
+
+@contextlib.contextmanager
+def all_accounts(directory: str,
+                 main_accountnames: Iterable[str],
+                 exclusive_lock: bool = False) -> Iterator[None]:
+    """Holds the registry's lock and those of the main accounts, e.g. to work on
+    the whole accounts directory. The registry's is taken first and the main
+    accounts' in a fixed order, like a registration does, so that two processes
+    can't deadlock.
+    """
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(_locked(directory, REGISTRY, exclusive_lock))
+        for main_accountname in sorted(set(main_accountnames)):
+            stack.enter_context(_locked(directory, main_accountname, exclusive_lock))
+        yield
+
+
+def exclusive(directory: str, name: str) -> contextlib.AbstractContextManager:
+    # For modifying the files the lock covers, no one else holds the lock meanwhile
+    return _locked(directory, name, True)
+
+
+def _lock_path(directory: str, name: str) -> str:
+    # The name comes from user input, it must not lead out of the lock directory
+    if os.sep in name or (os.altsep is not None and os.altsep in name) or ".." in name:
+        raise ValueError("{!r} can't be used as a lock name".format(name))
+    return os.path.join(directory, _LOCK_DIR, name + _LOCK_FILE_EXT)
+
+
+@contextlib.contextmanager
+def _locked(directory: str, name: str, exclusive_lock: bool) -> Iterator[None]:
+    if fcntl is None:
+        yield
+        return
+
+    path = _lock_path(directory, name)
+    held = _held.get(path)
+    if held is not None:
+        # Reentered; only an upgrade from shared to exclusive needs the kernel
+        descriptor, was_exclusive, _ = held
+        upgrade = exclusive_lock and not was_exclusive
+        if upgrade:
+            _wait_for(descriptor, name, fcntl.LOCK_EX)
+            held[1] = True
+        held[2] += 1
+        try:
+            yield
+        finally:
+            held[2] -= 1
+            if upgrade:
+                fcntl.flock(descriptor, fcntl.LOCK_SH)
+                held[1] = False
+        return
+
+    descriptor = _open_lock_file(path)
+    try:
+        _wait_for(descriptor, name, fcntl.LOCK_EX if exclusive_lock else fcntl.LOCK_SH)
+        _held[path] = [descriptor, exclusive_lock, 1]
+        try:
+            yield
+        finally:
+            del _held[path]
+    finally:
+        # Closing the last descriptor of the file releases the lock
+        os.close(descriptor)
+
+
+def _open_lock_file(path: str) -> int:
+    try:
+        return os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+
+def set_wait_listener(listener: Callable[[str], None]):
+    global _wait_listener
+    _wait_listener = listener
+
+
+def shared(directory: str, name: str) -> contextlib.AbstractContextManager:
+    # For reading the files the lock covers, any number of readers at a time
+    return _locked(directory, name, False)
+
+
+def _wait_for(descriptor: int, name: str, operation: int):
+    try:
+        fcntl.flock(descriptor, operation | fcntl.LOCK_NB)
+        return
+    except BlockingIOError:
+        pass
+
+    if _wait_listener is not None:
+        _wait_listener(name)
+    start = time.perf_counter()
+    fcntl.flock(descriptor, operation)
+    waited = time.perf_counter() - start
+
+    statistics = _wait_statistics.setdefault(name, [0, 0.0, 0.0])
+    statistics[0] += 1
+    statistics[1] += waited
+    statistics[2] = max(statistics[2], waited)
+    profiling.record("lock wait", waited)
+    if waited > _SLOW_WAIT_SECONDS:
+        _logger.warning("Waited %.2f s for the lock of %s", waited, name)
+    else:
+        _logger.info("Waited %.3f s for the lock of %s", waited, name)
+
+
+def wait_statistics() -> Dict[str, Tuple[int, float, float]]:
+    """Returns the number of waits, the total and the longest wait in seconds
+    for every lock this process had to wait for.
+    """
+    return {name: tuple(statistics) for name, statistics in _wait_statistics.items()}
@@ -7,27 +7,145 @@ Core module is started up when a login is successful.
 """
 import argparse
 import logging
+import os
+import sys
 
+from typing import TYPE_CHECKING, List, Optional
 
-import passager.core as core
-import passager.interface as interface
-import passager.storage as storage
+from passager.lazy import lazy_import
 
-from passager.data_formats import MainAccount
+if TYPE_CHECKING:
+    from passager.data_formats import MainAccount
+
+# Executed on first use
+datetime = lazy_import("datetime")
+agent = lazy_import("passager.agent")
+backup = lazy_import("passager.backup")
+bench = lazy_import("passager.bench.runner")
+breach = lazy_import("passager.breach")
+bench_importtime = lazy_import("passager.bench.importtime")
+cipher = lazy_import("passager.cipher")
+core = lazy_import("passager.core")
+data_formats = lazy_import("passager.data_formats")
+exporter = lazy_import("passager.exporter")
+fsck = lazy_import("passager.fsck")
+importer = lazy_import("passager.importer")
+interface = lazy_import("passager.interface")
+layout = lazy_import("passager.layout")
+locking = lazy_import("passager.locking")
+profiling = lazy_import("passager.profiling")
+storage = lazy_import("passager.storage")
+sync = lazy_import("passager.sync")
 
 _logger = logging.getLogger(__name__)
 
 
+def _agent(socket_path: str, idle_timeout: float):
+    main_account = _authenticate()
+    if main_account is None:
+        return
+
+    # Loaded once, every request is answered from memory and only the changes
+    # other processes make are read afterwards
+    storage.watch_service_accounts(main_account)
+    storage.load_service_accounts(main_account)
+    interface.agent_started(socket_path, idle_timeout)
+    error = agent.serve(agent.Agent(main_account, idle_timeout), socket_path)
+    if error is not None:
+        interface.agent_not_started(error)
+        return
+    interface.agent_locked()
+
+
 def _arg_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="Manage and train logging in with your passwords")
     parser.add_argument("command",
-                        choices=["login", "register"],
+                        choices=["login", "register", "migrate", "pack", "calibrate", "fsck", "import", "export",
+                                 "agent", "get", "bench", "breach", "backup", "restore", "sync"],
                         default="login",
                         help="command you wish to execute",)
+    parser.add_argument("target",
+                        nargs="?",
+                        help="import/export: the file to read or write; get: the service name; "
+                             "bench: the file to write the results into; "
+                             "breach: the breached password dump to convert; "
+                             "backup/restore: the backup directory; sync: the accounts directory to sync with",)
+    parser.add_argument("--workers",
+                        type=int,
+                        default=os.cpu_count() or 1,
+                        help="number of workers decrypting service accounts at login",)
+    parser.add_argument("--process-pool",
+                        action="store_true",
+                        help="decrypt service accounts in processes instead of threads",)
+    # No defaults or choices from the other modules here, so that parsing the
+    # arguments doesn't load them
+    parser.add_argument("--auth-grace",
+                        type=float,
+                        help="seconds during which re-authenticating skips the slow password check, 0 disables",)
+    parser.add_argument("--kdf",
+                        help="calibrate: the key derivation function to calibrate, pbkdf2 (default) or scrypt",)
+    parser.add_argument("--target-ms",
+                        type=int,
+                        default=500,
+                        help="calibrate: how long unlocking a main account should take",)
+    parser.add_argument("--cipher",
+                        help="calibrate: what new service account files are encrypted with, "
+                             "aes-gcm (default), chacha20-poly1305 or aes-cbc",)
+    parser.add_argument("--lazy",
+                        action="store_true",
+                        help="decrypt service account credentials only when they're needed",)
+    parser.add_argument("--repair",
+                        action="store_true",
+                        help="fsck: remove or compact the files found",)
+    parser.add_argument("--format",
+                        help="import/export: archive, csv, jsonl or keepass; imports tell it from the extension, "
+                             "exports are encrypted archives unless csv or jsonl is given",)
+    parser.add_argument("--login",
+                        action="store_true",
+                        help="fsck: also check the service account files of a main account",)
+    parser.add_argument("--profile",
+                        action="store_true",
+                        help="print timings and counters of where the command's time went",)
+    parser.add_argument("--profile-functions",
+                        action="store_true",
+                        help="--profile and the functions using the most time, which slows down what's timed",)
+    parser.add_argument("--profile-memory",
+                        action="store_true",
+                        help="--profile and the lines allocating the most memory, which slows down what's timed",)
+    parser.add_argument("--sizes",
+                        type=int,
+                        nargs="+",
+                        help="bench: the numbers of service accounts per main account to benchmark with",)
+    parser.add_argument("--repeat",
+                        type=int,
+                        default=3,
+                        help="bench: how many times every benchmark is run",)
+    parser.add_argument("--baseline",
+                        help="bench: earlier results to compare against",)
+    parser.add_argument("--tolerance",
+                        type=float,
+                        help="bench: how much slower than the baseline is still fine, e.g. 0.25 for 25%%",)
+    parser.add_argument("--import-budget",
+                        type=float,
+                        help="bench: milliseconds the CLI may spend importing before it runs a command",)
+    parser.add_argument("--at",
+                        help="restore: restore the latest snapshot taken at or before this time, "
+                             "e.g. 2024-05-01T18:00",)
+    parser.add_argument("--list",
+                        action="store_true",
+                        help="restore: list the snapshots instead of restoring one",)
+    parser.add_argument("--serve",
+                        action="store_true",
+                        help="sync: serve the accounts directory for syncing on --socket",)
+    parser.add_argument("--socket",
+                        help="agent/get: the socket the agent listens on; sync: the socket of the server to sync with",)
+    parser.add_argument("--idle-timeout",
+                        type=float,
+                        help="agent: seconds without requests after which the agent locks itself",)
     return parser
 
 
-def _login():
+def _authenticate() -> Optional["MainAccount"]:
     # Use interface to get input for username and password
     main_account = None
 
@@ -36,7 +154,7 @@ def _login():
 
         if username == "" and password == "":
             interface.logout()
-            return
+            return None
         if username == "" or password == "":
             interface.invalid_login()
             continue
@@ -45,20 +163,174 @@ def _login():
 
         if main_account is not None:
             # Login successful
-            break
+            return main_account
         interface.invalid_login()
 
+
+def _backup(backup_directory: str) -> bool:
+    try:
+        result = backup.backup(backup_directory)
+    except OSError as e:
+        interface.backup_failed(str(e))
+        return False
+    interface.backup_finished(result, backup_directory)
+    return True
+
+
+def _bench(output_path: Optional[str], sizes: List[int], repeat: int,
+           baseline_path: Optional[str], tolerance: float,
+           import_budget_ms: Optional[float]) -> bool:
+    # Returns False if the results regressed from the baseline or went over budget
+    baseline = bench.load_results(baseline_path) if baseline_path is not None else None
+    results = bench.run(sizes, repeat, interface.bench_progress)
+    interface.bench_results(results)
+    if output_path is not None:
+        bench.save_results(results, output_path)
+
+    passed = True
+    if import_budget_ms is not None:
+        over_budget = []
+        for arguments in bench_importtime.COMMANDS:
+            result = results["benchmarks"].get(bench_importtime.benchmark_name(arguments))
+            if result is not None and result["median"] * 1000 > import_budget_ms:
+                over_budget.append((" ".join(arguments), result["median"]))
+        interface.bench_import_budget(over_budget, import_budget_ms)
+        passed = len(over_budget) == 0
+    if baseline is None:
+        return passed
+    regressions = bench.compare(results, baseline, tolerance)
+    interface.bench_regressions(regressions, tolerance)
+    return passed and len(regressions) == 0
+
+
+def _breach(source_path: str) -> bool:
+    interface.breach_list_building(source_path)
+    try:
+        count = breach.build(source_path, progress=interface.breach_list_progress)
+    except OSError as e:
+        interface.breach_list_failed(str(e))
+        return False
+    interface.breach_list_built(count)
+    return True
+
+
+def _calibrate(kdf: str, target_ms: int, algorithm: Optional[str]):
+    interface.kdf_calibration_started(kdf, target_ms)
+    kdf_parameters = storage.calibrate_kdf(kdf, target_ms / 1000)
+    storage.set_kdf_parameters(kdf_parameters)
+    interface.kdf_calibrated(kdf_parameters)
+    if algorithm is not None:
+        storage.set_cipher(algorithm)
+        interface.cipher_selected(algorithm)
+
+
+def _export(path: str, file_format: Optional[str]):
+    if file_format is None:
+        file_format = exporter.FORMAT_ARCHIVE
+
+    main_account = _authenticate()
+    if main_account is None:
+        return
+
+    passphrase = None
+    if file_format == exporter.FORMAT_ARCHIVE:
+        passphrase = interface.export_passphrase()
+        if passphrase is None:
+            return
+    else:
+        interface.export_unencrypted_warning(path)
+    count = exporter.export_services(main_account, path, file_format, passphrase)
+    interface.export_finished(count, path)
+
+
+def _fsck(login: bool, repair: bool, workers: int):
+    main_account = None
+    if login:
+        main_account = _authenticate()
+        if main_account is None:
+            return
+
+    report = fsck.check(main_account, workers)
+    if repair:
+        fsck.repair(report)
+    interface.fsck_finished(report, repair)
+
+
+def _get(service_name: str, socket_path: str) -> bool:
+    try:
+        answer = agent.request("get", socket_path, service=service_name)
+    except PermissionError as e:
+        interface.agent_untrusted(str(e))
+        return False
+    except OSError:
+        interface.agent_unavailable(socket_path)
+        return False
+    if not answer["ok"]:
+        interface.agent_request_failed(answer["error"])
+        return False
+    interface.agent_password(answer["password"])
+    return True
+
+
+def _import(path: str, file_format: Optional[str]):
+    if file_format is None:
+        file_format = importer.detect_format(path)
+        if file_format is None:
+            interface.import_format_unknown(path)
+            return
+
+    main_account = _authenticate()
+    if main_account is None:
+        return
+
+    passphrase = None
+    if file_format == importer.FORMAT_ARCHIVE:
+        passphrase = interface.import_passphrase(path)
+
+    # The existing service accounts are needed for skipping duplicates
+    storage.load_service_accounts(main_account)
+    try:
+        result = importer.import_services(main_account, path, file_format, passphrase)
+    except ValueError as e:
+        # A wrong passphrase or a file that isn't what it claims to be
+        interface.import_unreadable(path, str(e))
+        return
+    interface.import_finished(result)
+
+
+def _login(auth_grace_period: Optional[float]):
+    main_account = _authenticate()
+    if main_account is None:
+        return
+
+    if auth_grace_period is None:
+        auth_grace_period = core.AUTH_GRACE_PERIOD
     # Finally; start core with the authenticated user
-    core.run(main_account)
+    core.run(main_account, auth_grace_period)
 
 
-def _register() -> bool:
+def _migrate():
+    interface.migration_started()
+    moved_count = layout.migrate(interface.migration_progress)
+    interface.migration_finished(moved_count)
+
+
+def _pack():
+    main_account = _authenticate()
+    if main_account is None:
+        return
+
+    storage.load_service_accounts(main_account)
+    if storage.pack_service_accounts(main_account):
+        interface.service_accounts_packed(main_account)
+    else:
+        interface.service_accounts_already_packed(main_account)
 
-    # Get existing usernames
-    unavailable_usernames = storage.get_usernames()
+
+def _register() -> bool:
 
     while True:
-        username = interface.main_account_register_username(unavailable_usernames)
+        username = interface.main_account_register_username(storage.main_account_exists)
 
         if username is None:
             # Registration canceled
@@ -69,25 +341,177 @@ def _register() -> bool:
             # Registration canceled
             break
 
-        main_account = MainAccount(username, password)
-        storage.store_main_account(main_account)
+        main_account = data_formats.MainAccount(username, password)
+        if not storage.register_main_account(main_account):
+            # Registered by another process while the password was asked for
+            interface.main_account_register_username_taken(username)
+            continue
         return True
     return False
 
 
+def _restore(backup_directory: str, at: Optional[float], list_only: bool) -> bool:
+    if list_only:
+        interface.backup_snapshots(backup.snapshots(backup_directory))
+        return True
+
+    snapshot = backup.latest_snapshot(backup_directory, at)
+    if snapshot is None:
+        interface.restore_snapshot_not_found(backup_directory)
+        return False
+    if not interface.restore_confirmation(snapshot):
+        return True
+    try:
+        written, removed = backup.restore(backup_directory, snapshot)
+    except (OSError, ValueError) as e:
+        interface.restore_failed(str(e))
+        return False
+    interface.restore_finished(written, removed)
+    return True
+
+
+def _run_command(arg_parser: argparse.ArgumentParser, args: argparse.Namespace):
+    if args.command == "login":
+        _login(args.auth_grace)
+    elif args.command == "register":
+        if _register():
+            # If account was registered successfully, enter login screen
+            _login(args.auth_grace)
+    elif args.command == "migrate":
+        _migrate()
+    elif args.command == "pack":
+        _pack()
+    elif args.command == "calibrate":
+        kdf = args.kdf or storage.KDF_PBKDF2
+        if kdf not in (storage.KDF_PBKDF2, storage.KDF_SCRYPT):
+            arg_parser.error("unknown key derivation function {}".format(kdf))
+        if args.cipher is not None and not cipher.is_available(args.cipher):
+            arg_parser.error("{} isn't available, choose one of {}".format(
+                args.cipher, ", ".join(sorted({algorithm for algorithm, _ in cipher.available()}))))
+        _calibrate(kdf, args.target_ms, args.cipher)
+    elif args.command == "fsck":
+        _fsck(args.login, args.repair, args.workers)
+    elif args.command == "import":
+        if args.target is None:
+            arg_parser.error("import requires the path of the file to import")
+        if args.format is not None and args.format not in importer.FORMATS:
+            arg_parser.error("unknown format {}".format(args.format))
+        _import(args.target, args.format)
+    elif args.command == "export":
+        if args.target is None:
+            arg_parser.error("export requires the path of the file to write")
+        if args.format is not None and args.format not in exporter.FORMATS:
+            arg_parser.error("exports can't be written as {}".format(args.format))
+        _export(args.target, args.format)
+    elif args.command == "agent":
+        _agent(args.socket or agent.default_socket_path(),
+               agent.DEFAULT_IDLE_TIMEOUT if args.idle_timeout is None else args.idle_timeout)
+    elif args.command == "get":
+        if args.target is None:
+            arg_parser.error("get requires the name of the service")
+        if not _get(args.target, args.socket or agent.default_socket_path()):
+            sys.exit(1)
+    elif args.command == "breach":
+        if args.target is None:
+            arg_parser.error("breach requires the path of the breached password dump")
+        if not _breach(args.target):
+            sys.exit(1)
+    elif args.command in ("backup", "restore"):
+        if args.target is None:
+            arg_parser.error("{} requires the backup directory".format(args.command))
+        backup_directory = os.path.realpath(args.target)
+        accounts_directory = os.path.realpath(layout.accounts_directory())
+        if os.path.commonpath([backup_directory, accounts_directory]) == accounts_directory:
+            arg_parser.error("the backup directory can't be inside the accounts directory")
+        if args.command == "backup":
+            succeeded = _backup(backup_directory)
+        else:
+            at = None
+            if args.at is not None:
+                try:
+                    # Local time unless the time zone is given
+                    at = datetime.datetime.fromisoformat(args.at).timestamp()
+                except ValueError:
+                    arg_parser.error("--at must be a time like 2024-05-01T18:00")
+            succeeded = _restore(backup_directory, at, args.list)
+        if not succeeded:
+            sys.exit(1)
+    elif args.command == "sync":
+        if args.serve:
+            succeeded = _sync_serve(args.socket or sync.default_socket_path())
+        elif args.socket is not None:
+            succeeded = _sync(sync.SocketReplica(args.socket))
+        elif args.target is not None:
+            other_directory = os.path.realpath(args.target)
+            accounts_directory = os.path.realpath(layout.accounts_directory())
+            if os.path.commonpath([other_directory, accounts_directory]) in (other_directory, accounts_directory):
+                arg_parser.error("the directory to sync with can't contain or be inside the accounts directory")
+            succeeded = _sync(sync.DirectoryReplica(other_directory))
+        else:
+            arg_parser.error("sync requires the directory to sync with, --socket or --serve")
+        if not succeeded:
+            sys.exit(1)
+    elif args.command == "bench":
+        if not _bench(args.target,
+                      args.sizes or list(bench.DEFAULT_SIZES),
+                      args.repeat,
+                      args.baseline,
+                      bench.DEFAULT_TOLERANCE if args.tolerance is None else args.tolerance,
+                      args.import_budget):
+            sys.exit(1)
+
+
 def run():
     # TODO: Turned "off" for now. Add configuration options later on.
     logging.basicConfig(level=logging.CRITICAL)
 
     arg_parser = _arg_parser()
     args = arg_parser.parse_args()
+    args.profile = args.profile or args.profile_functions or args.profile_memory
+    if args.profile:
+        profiling.enable(args.profile_functions, args.profile_memory)
 
-    if args.command == "login":
-        _login()
-    elif args.command == "register":
-        if _register():
-            # If account was registered successfully, enter login screen
-            _login()
+    try:
+        # The thin client doesn't touch the accounts directory
+        if args.command != "get":
+            with profiling.timed("startup"):
+                storage.configure_loading(args.workers, args.process_pool, args.lazy)
+                locking.set_wait_listener(interface.lock_waiting)
+                storage.recover_storage()
+        with profiling.timed(args.command):
+            _run_command(arg_parser, args)
+    finally:
+        # Only the commands that had to wait for other processes report it
+        if args.command != "get" and len(locking.wait_statistics()) != 0:
+            interface.lock_wait_report(locking.wait_statistics())
+        if args.profile:
+            interface.profile_report(profiling.timers(),
+                                     profiling.counters(),
+                                     profiling.function_profile(),
+                                     profiling.memory_profile())
+            profiling.disable()
+
+
+def _sync(remote: "sync.Replica") -> bool:
+    try:
+        result = sync.sync(sync.DirectoryReplica(layout.accounts_directory()), remote)
+    except (OSError, ValueError) as e:
+        interface.sync_failed(str(e))
+        return False
+    interface.sync_finished(result)
+    return True
+
+
+def _sync_serve(socket_path: str) -> bool:
+    interface.sync_serving(socket_path)
+    try:
+        error = sync.serve(layout.accounts_directory(), socket_path)
+    except KeyboardInterrupt:
+        return True
+    if error is not None:
+        interface.sync_not_served(error)
+        return False
+    return True
 
 
 if __name__ == "__main__":
@@ -0,0 +1,259 @@
+#!/bin/python3
+"""
+Packed module offers an alternative storage engine for the service accounts:
+instead of a file per service account, all of a main account's service accounts
+are kept in a single container file.
+
+The container starts with a small header followed by records:
+    type (1 byte) | name length (2 bytes) | data length (4 bytes) | name | data
+The name is the service account's encrypted filename and the data its encrypted
+contents, so the container holds exactly what the separate files would. Records
+are only ever appended: a removal appends a tombstone record and the dead records
+are dropped by compacting the container once they take up enough space. Reading
+is done through a memory map so that loading a vault is one sequential pass over
+a single file.
+"""
+import logging
+import mmap
+import os
+import struct
+
+from typing import Iterable, Iterator, Optional, Tuple
+
+# Compact only when the dead records take more space than this and the live ones
+_COMPACTION_MIN_DEAD_BYTES = 64 * 1024
+_HEADER = struct.Struct(">8sB")
+_MAGIC = b"PSGRPACK"
+_RECORD_DATA = 1
+_RECORD_HEADER = struct.Struct(">BHI")
+_RECORD_TOMBSTONE = 2
+_VERSION = 1
+
+_logger = logging.getLogger(__name__)
+
+
+class PackedVault:
+    def __init__(self, path: str):
+        self.path = path
+        self._dead_bytes = 0
+        # End of the last complete record; anything after it is a torn write
+        self._end = 0
+        self._file = None
+        self._map = None
+        # Record name -> (data offset, data length)
+        self._records = {}
+        # Identity and size of the file as last seen, to notice other processes' changes
+        self._signature = None
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._records
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def append(self, name: str, data: bytes):
+        self.append_many([(name, data)])
+
+    def append_many(self, records: Iterable[Tuple[str, bytes]]):
+        with open(self.path, "r+b" if os.path.exists(self.path) else "w+b") as target:
+            if self._end == 0:
+                target.write(_HEADER.pack(_MAGIC, _VERSION))
+                self._end = _HEADER.size
+            target.seek(self._end)
+            # All or nothing: a failure while the records are produced undoes the
+            # ones already appended
+            end, records_before, dead_bytes = self._end, dict(self._records), self._dead_bytes
+            try:
+                for name, data in records:
+                    offset = self._write_record(target, _RECORD_DATA, name, data)
+                    self._replace(name, offset, len(data))
+            except BaseException:
+                target.truncate(end)
+                self._end, self._records, self._dead_bytes = end, records_before, dead_bytes
+                self._signature = _signature(self.path)
+                self._unmap()
+                raise
+            # Drop a possible torn write left behind by a crash
+            target.truncate(self._end)
+        self._signature = _signature(self.path)
+        self._unmap()
+        self._compact_if_needed()
+
+    def close(self):
+        self._unmap()
+
+    def compact(self):
+        # Rewrites the container with only the live records
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as target:
+            target.write(_HEADER.pack(_MAGIC, _VERSION))
+            self._end = _HEADER.size
+            for name, data in self.items():
+                self._write_record(target, _RECORD_DATA, name, data)
+            target.flush()
+            os.fsync(target.fileno())
+        self._unmap()
+        os.replace(temp_path, self.path)
+        _logger.info("Compacted %s, %s bytes freed", self.path, self._dead_bytes)
+        self.load()
+
+    def _compact_if_needed(self):
+        live_bytes = self._end - _HEADER.size - self._dead_bytes
+        if self._dead_bytes > _COMPACTION_MIN_DEAD_BYTES and self._dead_bytes > live_bytes:
+            self.compact()
+
+    def dead_bytes(self) -> int:
+        return self._dead_bytes
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def is_stale(self) -> bool:
+        # Whether another process has changed or replaced the container since
+        return _signature(self.path) != self._signature
+
+    def items(self) -> Iterator[Tuple[str, bytes]]:
+        for name in list(self._records):
+            yield name, self.read(name)
+
+    def load(self):
+        # Builds the record index with a single pass over the memory mapped file
+        self._records = {}
+        self._dead_bytes = 0
+        self._end = 0
+        self._unmap()
+
+        contents = self._mapped()
+        if contents is None:
+            self._signature = None
+            return
+        self._signature = _signature(self.path)
+        magic, version = _HEADER.unpack_from(contents, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError("{} is not a supported container file".format(self.path))
+
+        offset = _HEADER.size
+        while offset + _RECORD_HEADER.size <= len(contents):
+            record_type, name_length, data_length = _RECORD_HEADER.unpack_from(contents, offset)
+            name_offset = offset + _RECORD_HEADER.size
+            data_offset = name_offset + name_length
+            record_end = data_offset + data_length
+            if record_end > len(contents) or record_type not in (_RECORD_DATA, _RECORD_TOMBSTONE):
+                _logger.warning("Ignoring a torn record at the end of %s", self.path)
+                break
+
+            name = contents[name_offset:data_offset].decode("utf-8")
+            if record_type == _RECORD_DATA:
+                self._replace(name, data_offset, data_length)
+            else:
+                self._remove(name)
+                self._dead_bytes += record_end - offset
+            offset = record_end
+        self._end = offset
+
+    def _mapped(self) -> Optional[mmap.mmap]:
+        if self._map is None:
+            try:
+                self._file = open(self.path, "rb")
+            except FileNotFoundError:
+                return None
+            if os.fstat(self._file.fileno()).st_size < _HEADER.size:
+                self._file.close()
+                self._file = None
+                return None
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def names(self) -> Iterator[str]:
+        return iter(list(self._records))
+
+    def read(self, name: str) -> bytes:
+        offset, length = self._records[name]
+        return self._mapped()[offset:offset + length]
+
+    def remove(self, name: str) -> bool:
+        return self.remove_many([name]) == 1
+
+    def remove_many(self, names: Iterable[str]) -> int:
+        names = [name for name in names if name in self._records]
+        if len(names) == 0:
+            return 0
+        with open(self.path, "r+b") as target:
+            target.seek(self._end)
+            for name in names:
+                start = self._end
+                self._write_record(target, _RECORD_TOMBSTONE, name, b"")
+                self._remove(name)
+                self._dead_bytes += self._end - start
+            target.truncate(self._end)
+        self._signature = _signature(self.path)
+        self._unmap()
+        self._compact_if_needed()
+        return len(names)
+
+    def _remove(self, name: str):
+        record = self._records.pop(name, None)
+        if record is not None:
+            # The whole record, not just its data, became dead
+            self._dead_bytes += _RECORD_HEADER.size + len(name.encode("utf-8")) + record[1]
+
+    def _replace(self, name: str, data_offset: int, data_length: int):
+        self._remove(name)
+        self._records[name] = (data_offset, data_length)
+
+    def torn_bytes(self) -> int:
+        # Bytes after the last complete record, left behind by an interrupted write
+        try:
+            return max(0, os.path.getsize(self.path) - self._end)
+        except FileNotFoundError:
+            return 0
+
+    def _unmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write_record(self, target, record_type: int, name: str, data: bytes) -> int:
+        # Returns the offset of the record's data
+        name_bytes = name.encode("utf-8")
+        target.write(_RECORD_HEADER.pack(record_type, len(name_bytes), len(data)))
+        target.write(name_bytes)
+        target.write(data)
+        data_offset = self._end + _RECORD_HEADER.size + len(name_bytes)
+        self._end = data_offset + len(data)
+        return data_offset
+
+
+def _signature(path: str) -> Optional[Tuple[int, int, int]]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def open_vault(path: str) -> Optional[PackedVault]:
+    # Returns the loaded container or None if there's no container at the path
+    vault = PackedVault(path)
+    if not vault.exists():
+        return None
+    vault.load()
+    return vault
+
+
+def pack(path: str, records: Iterable[Tuple[str, bytes]]) -> PackedVault:
+    """Creates a new container at the path from the records. The container is
+    written beside the path and moved into place only once complete.
+    """
+    temp_vault = PackedVault(path + ".tmp")
+    if temp_vault.exists():
+        # Left behind by an interrupted packing
+        os.remove(temp_vault.path)
+    temp_vault.append_many(records)
+    with open(temp_vault.path, "rb") as source:
+        os.fsync(source.fileno())
+    os.replace(temp_vault.path, path)
+    return open_vault(path)
@@ -0,0 +1,162 @@
+#!/bin/python3
+"""
+Profiling module collects timers and counters from the hot paths, e.g. how long
+the KDF and the decryption of the service accounts take and how many files and
+bytes are read on the way. Nothing is recorded unless profiling is enabled;
+until then timed() hands out a shared do-nothing context manager and count()
+returns right away.
+
+Timings are kept as histograms with power of two millisecond buckets. Worker
+processes keep their own numbers, which aren't collected. The time spent waiting
+at prompts is timed on its own and left out of the timers around the prompts.
+
+cProfile and tracemalloc slow down the code they watch and so distort the
+timers; they're only turned on when asked for.
+"""
+import contextlib
+import io
+import threading
+import time
+
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from passager.lazy import lazy_import
+
+# These take longer to import than many commands take to run
+cProfile = lazy_import("cProfile")
+pstats = lazy_import("pstats")
+tracemalloc = lazy_import("tracemalloc")
+
+# Checked by the instrumented code before doing any work of its own
+enabled = False
+
+_NOT_TIMED = contextlib.nullcontext()
+
+_lock = threading.Lock()
+# The seconds the thread has waited at prompts
+_input_wait = threading.local()
+_counters = {}
+# Timer name -> [count, total seconds, longest seconds, {bucket: count}]
+_timers = {}
+_profiler = None
+
+
+def _bucket(seconds: float) -> int:
+    # The upper bound in milliseconds of the histogram bucket of the duration
+    bound = 1
+    while bound < seconds * 1000:
+        bound *= 2
+    return bound
+
+
+def count(name: str, amount: int = 1):
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def counters() -> Dict[str, int]:
+    with _lock:
+        return dict(_counters)
+
+
+def disable():
+    global enabled
+    enabled = False
+    if _profiler is not None:
+        _profiler.disable()
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def enable(profile_functions: bool = False, trace_memory: bool = False):
+    """Starts collecting the timers and counters and optionally a cProfile
+    profile of the calling thread and a trace of the memory allocations.
+    """
+    global enabled, _profiler
+    enabled = True
+    if profile_functions:
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    if trace_memory:
+        tracemalloc.start()
+
+
+def function_profile(limit: int = 25) -> Optional[str]:
+    # The functions taking the most cumulative time, None if not profiled
+    if _profiler is None:
+        return None
+    _profiler.disable()
+    output = io.StringIO()
+    stats = pstats.Stats(_profiler, stream=output)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+    if enabled:
+        _profiler.enable()
+    return output.getvalue()
+
+
+def input_seconds() -> float:
+    # The seconds the calling thread has waited at prompts so far
+    return getattr(_input_wait, "seconds", 0.0)
+
+
+def memory_profile(limit: int = 10) -> Optional[Tuple[int, List[str]]]:
+    # The peak traced memory and the lines that allocated most, None if not traced
+    if not tracemalloc.is_tracing():
+        return None
+    _, peak = tracemalloc.get_traced_memory()
+    statistics = tracemalloc.take_snapshot().statistics("lineno")
+    return peak, [str(statistic) for statistic in statistics[:limit]]
+
+
+@contextlib.contextmanager
+def prompting() -> Iterator[None]:
+    # Wraps a wait for the user's input
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        _input_wait.seconds = input_seconds() + seconds
+        record("input", seconds)
+
+
+def record(name: str, seconds: float):
+    if not enabled:
+        return
+    with _lock:
+        timer = _timers.get(name)
+        if timer is None:
+            timer = _timers[name] = [0, 0.0, 0.0, {}]
+        timer[0] += 1
+        timer[1] += seconds
+        timer[2] = max(timer[2], seconds)
+        bucket = _bucket(seconds)
+        timer[3][bucket] = timer[3].get(bucket, 0) + 1
+
+
+def timed(name: str) -> contextlib.AbstractContextManager:
+    # Records how long the block takes
+    if not enabled:
+        return _NOT_TIMED
+    return _timing(name)
+
+
+@contextlib.contextmanager
+def _timing(name: str):
+    start = time.perf_counter()
+    input_start = input_seconds()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start - (input_seconds() - input_start))
+
+
+def timers() -> Dict[str, Tuple[int, float, float, Dict[int, int]]]:
+    """Returns the number of timings, the total and the longest in seconds and
+    the histogram (upper bound in milliseconds -> count) of every timer.
+    """
+    with _lock:
+        return {name: (timer[0], timer[1], timer[2], dict(timer[3]))
+                for name, timer in _timers.items()}
@@ -0,0 +1,152 @@
+#!/bin/python3
+"""
+Sealed module keeps secrets encrypted while they're held in memory. Secrets are
+sealed with a key made for the process when they're stored and unsealed again
+whenever they're read, so a session holds only ciphertext no matter how long it
+runs or how many service accounts it touches.
+
+The plaintexts of the most recently read secrets are cached to keep repeated
+reads cheap. The cache is bounded both in size and in time: the least recently
+read plaintext is dropped once the cache is full and any plaintext not read for
+CACHE_TTL seconds is dropped the next time the cache is used or expire() is
+called. Dropped plaintexts are overwritten with zeros.
+
+Python can't overwrite its strings, so the string handed to a caller stays in
+memory until the caller lets go of it. The cache and the sealed secrets don't
+add to that.
+"""
+import collections
+import logging
+import os
+import threading
+import time
+
+from typing import Optional
+
+import passager.profiling as profiling
+
+from passager.lazy import lazy_import
+
+# The command line only needs this once secrets are stored
+cipher = lazy_import("passager.cipher")
+
+# Plaintexts cached at most at a time
+CACHE_SIZE = 32
+# Seconds a plaintext stays cached after it was last read
+CACHE_TTL = 60.0
+
+_BLOCK_SIZE = 16
+
+_logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+# Sealed secret -> [plaintext, time last read], the least recently read first
+_cache = collections.OrderedDict()
+_cipher = None
+
+
+def _drop(sealed: bytes):
+    plaintext, _ = _cache.pop(sealed)
+    _zero(plaintext)
+
+
+def expire():
+    # Drops the plaintexts that haven't been read for too long
+    with _lock:
+        _expire(time.monotonic())
+
+
+def _expire(now: float):
+    # The least recently read are first, so the expired ones are too
+    while len(_cache) != 0:
+        sealed, (_, last_read) = next(iter(_cache.items()))
+        if now - last_read <= CACHE_TTL:
+            return
+        _drop(sealed)
+
+
+def _pad(plaintext: bytes) -> bytes:
+    # Unauthenticated ciphers take whole blocks only
+    padding = _BLOCK_SIZE - len(plaintext) % _BLOCK_SIZE
+    return plaintext + bytes([padding]) * padding
+
+
+def _padded(plaintext: bytes) -> bool:
+    padding = plaintext[-1] if len(plaintext) != 0 else 0
+    return 0 < padding <= _BLOCK_SIZE and plaintext.endswith(bytes([padding]) * padding)
+
+
+def seal(secret: Optional[str]) -> Optional[bytes]:
+    if secret is None:
+        return None
+    session_cipher = _session_cipher()
+    nonce = os.urandom(session_cipher.nonce_length)
+    plaintext = secret.encode("utf-8")
+    if not session_cipher.authenticated:
+        plaintext = _pad(plaintext)
+    return nonce + session_cipher.encrypt(nonce, plaintext)
+
+
+def _session_cipher() -> "cipher.Cipher":
+    global _cipher
+    with _lock:
+        if _cipher is None:
+            _cipher = cipher.keyed(cipher.default_algorithm(), os.urandom(32))
+        return _cipher
+
+
+def unseal(sealed: Optional[bytes]) -> Optional[str]:
+    """Raises ValueError if the secret wasn't sealed by this process, e.g. by a
+    worker process with a key of its own.
+    """
+    if sealed is None:
+        return None
+    now = time.monotonic()
+    with _lock:
+        _expire(now)
+        cached = _cache.get(sealed)
+        if cached is not None:
+            profiling.count("sealed cache hit")
+            cached[1] = now
+            _cache.move_to_end(sealed)
+            return cached[0].decode("utf-8")
+
+    profiling.count("sealed cache miss")
+    session_cipher = _session_cipher()
+    nonce_length = session_cipher.nonce_length
+    try:
+        decrypted = session_cipher.decrypt(sealed[:nonce_length], sealed[nonce_length:])
+    except ValueError:
+        # Not whole blocks for an unauthenticated cipher
+        decrypted = None
+    if decrypted is None or (not session_cipher.authenticated and not _padded(decrypted)):
+        raise ValueError("The secret wasn't sealed by this process or is damaged")
+    plaintext = bytearray(decrypted)
+    if not session_cipher.authenticated:
+        del plaintext[-plaintext[-1]:]
+    try:
+        secret = plaintext.decode("utf-8")
+    except UnicodeDecodeError:
+        _zero(plaintext)
+        raise ValueError("The secret wasn't sealed by this process or is damaged")
+    with _lock:
+        if sealed in _cache:
+            # Another thread unsealed it meanwhile
+            _zero(plaintext)
+        else:
+            _cache[sealed] = [plaintext, now]
+            if len(_cache) > CACHE_SIZE:
+                _drop(next(iter(_cache)))
+    return secret
+
+
+def wipe():
+    # Drops every cached plaintext, e.g. when logging out
+    with _lock:
+        while len(_cache) != 0:
+            _drop(next(iter(_cache)))
+    _logger.debug("Wiped the cached secrets")
+
+
+def _zero(plaintext: bytearray):
+    plaintext[:] = bytes(len(plaintext))
@@ -6,35 +6,185 @@ security. However, as this is a password manager, the service account passwords
 need to be retrievable so hashing won't do. Encryption using the main account's
 password as a base for the key is therefore used instead.
 """
+import concurrent.futures
+import contextlib
+import functools
+import hmac
+import itertools
 import os
 import logging
+import struct
+import time
 
-from typing import Optional, Sequence, Tuple
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
+import passager.cipher as cipher
 import passager.data_formats as data_formats
+import passager.journal as journal
+import passager.layout as layout
+import passager.locking as locking
+import passager.packed as packed
+import passager.profiling as profiling
+import passager.watch as watch
 
 from passager.data_formats import MainAccount, ServiceAccount
 
 import hashlib
 
-from Crypto.Cipher import AES
 
-
-ENCRYPT_MODE = AES.MODE_CBC
-# TODO: Platform independency
-_FILE_DIR = os.path.dirname(os.path.realpath(__file__)) + "/accounts/"
+# Results of checking a service account file against a main account's key
+FILE_NOT_OWNED = 0
+FILE_OWNED = 1
+FILE_UNDECRYPTABLE = 2
+KDF_PBKDF2 = "pbkdf2"
+KDF_SCRYPT = "scrypt"
+
+# Main account file: header, salt, password verifier and the wrapped data key.
+# Version 1 files have no data key, it's derived from the password instead.
+_ACCOUNT_HEADERS = {
+    1: struct.Struct(">4sBBIIIBH"),
+    2: struct.Struct(">4sBBIIIBHH"),
+}
+_ACCOUNT_MAGIC = b"PSGR"
+_ACCOUNT_VERSION = 2
+_BLOCK_SIZE = 16
+# Keys whose ciphers are kept around, there's rarely more than one in use
+_CACHED_CIPHER_KEYS = 8
+# Iterations used when measuring the speed of PBKDF2
+_CALIBRATION_ITERATIONS = 20000
+# Authenticated manifests name their cipher with these and the filenames of
+# authenticated service account files start with the prefixes. Base32 has no
+# lowercase letters, so the files of unauthenticated ones never do.
+_CIPHER_IDS = {
+    cipher.AES_GCM: 1,
+    cipher.CHACHA20_POLY1305: 2,
+}
+_CIPHER_PREFIXES = {
+    cipher.AES_GCM: "g",
+    cipher.CHACHA20_POLY1305: "c",
+}
+# The random key the service accounts are encrypted with
+_DATA_KEY_LENGTH = 32
+# Password hash length in versioned main account files
+_HASH_LENGTH = 32
 # TODO: Adjust
 _ITERATIONS = 150000
-_MAIN_FILE_EXT = ".account"
+# Identifiers of the KDFs in the main account file header
+_KDF_IDS = {
+    KDF_PBKDF2: 1,
+    KDF_SCRYPT: 2,
+}
+_DEFAULT_KDF = {"kdf": KDF_PBKDF2, "iterations": _ITERATIONS}
+# Main account files without a header were hashed with these
+_LEGACY_KDF = {"kdf": KDF_PBKDF2, "iterations": _ITERATIONS}
 _MAIN_HASH_NAME = "sha256"
+# Upper limit for the number of service accounts handed to a worker at once
+_LOAD_BATCH_SIZE = 256
+_MANIFEST_IDENTIFIER = "MANIFEST"
+_MANIFEST_MAGIC = b"PSGRAEAD"
+# Separates the service filenames listed in a manifest
+_MANIFEST_SPLIT = "\n"
 _PADDING = " "
-_SERVICE_FILE_EXT = ".service"
+# Smaller loads are done without a worker pool as it would only add overhead
+_PARALLEL_LOAD_THRESHOLD = 64
 # The split character for separating metadata from service data on disk
 _SPLIT = ";;"
+_SCRYPT_BLOCK_SIZE = 8
+_SCRYPT_MAX_COST = 2 ** 20
+_SCRYPT_MIN_COST = 2 ** 14
+_SCRYPT_PARALLELISM = 1
 _SRV_IDENTIFIER = "SERVICE"
+# Contexts for deriving separate keys from the KDF output
+_VERIFIER_CONTEXT = b"passager-verifier"
+_WRAPPING_CONTEXT = b"passager-wrapping"
+# Contexts for deriving the keys of the authenticated ciphers from the data key
+_CONTENTS_CONTEXT = b"passager-contents"
+_NAMES_CONTEXT = b"passager-names"
 
 _logger = logging.getLogger(__name__)
 
+# Worker pool configuration for loading service accounts
+_load_workers = os.cpu_count() or 1
+_load_with_processes = False
+# Whether credentials are decrypted at login or only when first needed
+_load_lazily = False
+# The transaction the file operations are currently staged into, if any
+_journal = None
+# Open packed containers by their path
+_packed_vaults = {}
+# Main account name -> the watcher of the directories of its files
+_watchers = {}
+
+
+def _adopt_service_file(main_accountname: str, filename: str, file_path: str):
+    # Moves a service account file that was found outside of its owner's
+    # directory (e.g. after a layout migration) to where it belongs
+    owned_path = layout.service_path(main_accountname, filename)
+    if file_path == owned_path:
+        return
+    with _writing(main_accountname):
+        os.makedirs(os.path.dirname(owned_path), exist_ok=True)
+        os.rename(file_path, owned_path)
+    try:
+        # Leave no empty shard directories behind for the next scans
+        os.rmdir(os.path.dirname(file_path))
+    except OSError:
+        pass
+
+
+def calibrate_kdf(kdf: str, target_seconds: float) -> Dict:
+    """Measures the KDF on this machine and returns the parameters with which
+    unlocking a main account takes about the target time.
+    """
+    if kdf == KDF_SCRYPT:
+        parameters = {"kdf": KDF_SCRYPT,
+                      "n": _SCRYPT_MIN_COST,
+                      "r": _SCRYPT_BLOCK_SIZE,
+                      "p": _SCRYPT_PARALLELISM}
+        # The cost has to be a power of two, double it as long as it fits
+        while parameters["n"] < _SCRYPT_MAX_COST:
+            if _time_kdf(parameters) * 2 > target_seconds:
+                break
+            parameters["n"] *= 2
+        return parameters
+
+    elapsed = _time_kdf({"kdf": KDF_PBKDF2, "iterations": _CALIBRATION_ITERATIONS})
+    iterations = int(_CALIBRATION_ITERATIONS * target_seconds / elapsed)
+    # Round to thousands and never go below the old default
+    iterations = max(_ITERATIONS, iterations - iterations % 1000)
+    return {"kdf": KDF_PBKDF2, "iterations": iterations}
+
+
+def check_service_file(main_account: MainAccount,
+                       filename: str,
+                       file_path: str) -> Tuple[int, Optional[str]]:
+    """Tells whether the service account file belongs to the main account and
+    whether it can be decrypted. Returns the result and the service name.
+    """
+    key = main_account.data_key
+    try:
+        if not _may_be_owned(filename, key):
+            return FILE_NOT_OWNED, None
+        service = _decrypt_service_account(filename,
+                                           key,
+                                           functools.partial(_read_file, file_path),
+                                           lazy=True)
+    except Exception as e:
+        _logger.info("Service account file %s couldn't be decrypted: %s", filename, e)
+        return FILE_NOT_OWNED, None
+    if service is None:
+        return FILE_NOT_OWNED, None
+    service_name = service[0]
+
+    try:
+        credentials = _decrypt_contents(_read_file(file_path), key, filename)
+    except Exception as e:
+        _logger.info("Credentials in %s couldn't be decrypted: %s", filename, e)
+        credentials = None
+    if credentials is None:
+        return FILE_UNDECRYPTABLE, service_name
+    return FILE_OWNED, service_name
+
 
 def _compare_hash(first_hash: bytes, second_hash: bytes) -> bool:
     # TODO: Remove loggers from here
@@ -56,12 +206,22 @@ def _compare_hash(first_hash: bytes, second_hash: bytes) -> bool:
     return differences == 0
 
 
+def _current_path(file_path: str) -> Optional[str]:
+    # Takes the changes staged in the ongoing journal transaction into account
+    if _journal is None:
+        return file_path
+    return _journal.current_path(file_path)
+
+
 def _decrypt_contents(encrypted_contents: bytes,
                       key: bytes,
-                      init_vector: bytes) -> Optional[Tuple[str, str]]:
-
-    decryptor = AES.new(key, ENCRYPT_MODE, IV=init_vector)
-    contents_bytes = decryptor.decrypt(encrypted_contents)
+                      filename: str) -> Optional[Tuple[str, str]]:
+    algorithm, nonce, encrypted_name = split_service_filename(filename)
+    _, contents_cipher = _service_ciphers(key, algorithm)
+    contents_bytes = contents_cipher.decrypt(nonce, encrypted_contents, encrypted_name)
+    if contents_bytes is None:
+        _logger.warning("Service account's credentials failed the authentication!")
+        return None
 
     contents = data_formats.decode_load(contents_bytes)
 
@@ -80,10 +240,6 @@ def _decrypt_contents(encrypted_contents: bytes,
     # Pack up the credentials (if there are places in there with _SPLIT) and
     # get rid of the padding.
     credentials = _right_unpad("".join(split_contents[2:]))
-    _logger.debug(credentials)
-    _logger.debug("%s == %s",
-                  len(credentials),
-                  username_length + password_length)
 
     if len(credentials) != username_length + password_length:
         _logger.warning("Service account's decrypted credentials were of unexpected size!")
@@ -93,39 +249,231 @@ def _decrypt_contents(encrypted_contents: bytes,
     return username, password
 
 
-def _decrypt_filename(encrypted_service_name: bytes,
-                      key: bytes,
-                      init_vector: bytes) -> str:
-    decryptor = AES.new(key, ENCRYPT_MODE, IV=init_vector)
-    service_name = decryptor.decrypt(encrypted_service_name)
+def _decrypt_filename(filename: str, key: bytes) -> Optional[str]:
+    # None if the filename fails the authentication, i.e. isn't the key's
+    algorithm, nonce, encrypted_name = split_service_filename(filename)
+    name_cipher, _ = _service_ciphers(key, algorithm)
+    service_name = name_cipher.decrypt(nonce, encrypted_name)
+    if service_name is None:
+        return None
     return data_formats.decode_load(service_name)
 
 
-def delete_main_account(main_account: MainAccount):
-    username_file = main_account.account_name + _MAIN_FILE_EXT
-    file_path = _FILE_DIR + username_file
+def _decrypt_manifest(encrypted_manifest: bytes, key: bytes) -> Optional[List[str]]:
+    algorithm = cipher.AES_CBC
+    if encrypted_manifest.startswith(_MANIFEST_MAGIC):
+        cipher_id = encrypted_manifest[len(_MANIFEST_MAGIC)]
+        algorithm = next((name for name, known_id in _CIPHER_IDS.items() if known_id == cipher_id),
+                         None)
+        if algorithm is None:
+            return None
+        encrypted_manifest = encrypted_manifest[len(_MANIFEST_MAGIC) + 1:]
+
+    _, manifest_cipher = _service_ciphers(key, algorithm)
+    nonce_end = manifest_cipher.nonce_length
+    try:
+        manifest = manifest_cipher.decrypt(encrypted_manifest[:nonce_end],
+                                           encrypted_manifest[nonce_end:],
+                                           data_formats.encode_general(_MANIFEST_IDENTIFIER))
+        if manifest is None:
+            return None
+        manifest = data_formats.decode_load(manifest)
+    except (UnicodeDecodeError, ValueError):
+        # Wrong key or a damaged manifest; either way it can't be trusted
+        return None
 
-    if os.path.isfile(file_path):
-        os.remove(file_path)
-    else:
-        _logger.warning("ERROR: Couldn't remove main account file as it doesn't exist!")
+    manifest = _right_unpad(manifest)
+    if not manifest.startswith(_MANIFEST_IDENTIFIER + _SPLIT):
+        return None
+    manifest = manifest[len(_MANIFEST_IDENTIFIER + _SPLIT):]
+    if manifest == "":
+        return []
+    return manifest.split(_MANIFEST_SPLIT)
+
+
+def _decrypt_service_account(filename: str,
+                             key: bytes,
+                             read_contents: Callable[[], bytes],
+                             lazy: bool = False) -> Optional[Tuple]:
+    """Returns the arguments of the ServiceAccount, which is built by the caller:
+    ServiceAccounts seal their credentials with a key of the process that builds
+    them, so they can't be built in a worker process.
+    """
+    _logger.debug("LOAD - 'Final' filename: %s", filename)
+
+    service_name = _decrypt_filename(filename, key)
+    if service_name is None:
+        # Failed the authentication, so it's another main account's file
+        _logger.info("%s wasn't a service account for this main account.", filename)
+        return None
+
+    _logger.debug("LOAD - Padded filename: %s", service_name)
+    service_name = _right_unpad(service_name)
+    _logger.debug("LOAD - Actual filename: %s", service_name)
 
+    if not service_name.startswith(_SRV_IDENTIFIER + _SPLIT):
+        # This file didn't contain a service account for this main account
+        _logger.info("%s wasn't a service account for this main account.",
+                     service_name)
+        return None
 
-def delete_service_account(service_filename: str) -> bool:
-    if not service_filename.endswith(_SERVICE_FILE_EXT):
-        service_filename += _SERVICE_FILE_EXT
+    # Cut the service header from the name
+    service_name = "".join(service_name.split(_SPLIT)[1:])
+    # Decrypted successfully -> it's a correct service
 
-    file_path = _FILE_DIR + service_filename
+    if lazy:
+        _logger.info("Loaded service name for %s.", service_name)
+        return (service_name,
+                None,
+                None,
+                filename,
+                functools.partial(_load_credentials,
+                                  key,
+                                  filename,
+                                  read_contents))
+
+    encrypted_contents = read_contents()
+    credentials = _decrypt_contents(encrypted_contents, key, filename)
+    if credentials is None:
+        return None
+    username, password = credentials
+    _logger.info("Loaded service account for %s.", service_name)
+    return service_name, username, password, filename, None
 
-    if os.path.isfile(file_path):
-        os.remove(file_path)
+
+def change_main_password(main_account: MainAccount, new_password: str):
+    """Only the main account file is rewritten as the data key is just wrapped
+    with the new password. Accounts still using the key derived from their old
+    password get a random data key first, which re-encrypts the service accounts
+    once; otherwise the old password would keep decrypting them.
+    """
+    with _writing(main_account.account_name), _journaled():
+        # A crash must not leave the service accounts encrypted with a data key
+        # the main account file doesn't have
+        if _uses_password_derived_key(main_account):
+            _logger.info("Replacing the password derived data key of %s",
+                         main_account.account_name)
+            main_account.data_key = _generate_data_key()
+            update_service_accounts(main_account)
+
+        main_account.change_password(new_password)
+        store_main_account(main_account)
+
+
+def configure_loading(workers: int, use_processes: bool = False, lazy: bool = False):
+    """Sets how many workers decrypt service accounts at login and whether they
+    are threads or processes. Processes sidestep the GIL at a higher startup cost.
+    Lazy loading decrypts only the service names at login and the credentials
+    of a service account when they're first accessed.
+    """
+    global _load_workers, _load_with_processes, _load_lazily
+    _load_workers = max(1, workers)
+    _load_with_processes = use_processes
+    _load_lazily = lazy
+
+
+def delete_main_account(main_account: MainAccount):
+    with locking.exclusive(layout.accounts_directory(), locking.REGISTRY), \
+            _writing(main_account.account_name):
+        file_path = _find_file(layout.main_account_paths(main_account.account_name))
+
+        with _journaled():
+            if file_path is not None:
+                _remove_file(file_path)
+            else:
+                _logger.warning("ERROR: Couldn't remove main account file as it doesn't exist!")
+
+            # The manifest is useless without the main account
+            _delete_manifest(main_account.account_name)
+        layout.remove_main_account_directory(main_account.account_name)
+
+
+def _delete_manifest(main_accountname: str):
+    manifest_path = _find_file(layout.manifest_paths(main_accountname))
+    if manifest_path is not None:
+        _remove_file(manifest_path)
+
+
+def delete_service_account(service_filename: str, main_account: MainAccount) -> bool:
+    # Removes the service account file from disk and from the manifest
+    if not service_filename.endswith(layout.SERVICE_FILE_EXT):
+        service_filename += layout.SERVICE_FILE_EXT
+
+    with _writing(main_account.account_name):
+        vault = _packed_vault(main_account.account_name)
+        if vault is not None:
+            return vault.remove(service_filename)
+
+        with _journaled():
+            if _delete_service_file(main_account.account_name, service_filename):
+                _update_manifest(main_account.account_name,
+                                 main_account.data_key,
+                                 removed=[service_filename])
+                return True
+    return False
+
+
+def delete_service_accounts(main_account: MainAccount):
+    # Removes every service account of the main account along with the manifest
+    with _writing(main_account.account_name):
+        vault = _packed_vault(main_account.account_name)
+        if vault is not None:
+            vault.close()
+            _packed_vaults.pop(vault.path)
+            os.remove(vault.path)
+            return
+
+        with _journaled():
+            for service_account in main_account.service_accounts:
+                _delete_service_file(main_account.account_name, service_account.filename)
+            _delete_manifest(main_account.account_name)
+
+
+def _delete_service_file(main_accountname: str, service_filename: str) -> bool:
+    file_path = _find_file(layout.service_paths(main_accountname, service_filename))
+
+    if file_path is not None:
+        _remove_file(file_path)
         return True
     else:
         _logger.warning("ERROR: Couldn't remove service account file as it doesn't exist!")
         return False
 
 
+def _derive_key_pair(master_key: bytes) -> Tuple[bytes, bytes]:
+    # Returns the password verifier stored on disk and the key wrapping the
+    # data key. Neither can be derived from the other.
+    verifier = hmac.new(master_key, _VERIFIER_CONTEXT, hashlib.sha256).digest()
+    wrapping_key = hmac.new(master_key, _WRAPPING_CONTEXT, hashlib.sha256).digest()
+    return verifier, wrapping_key
+
+
+def _derive_password_hash(password_in: str,
+                          salt: bytes,
+                          kdf_parameters: Dict,
+                          hash_length: int) -> bytes:
+    password = data_formats.encode_general(password_in)
+    with profiling.timed("kdf"):
+        if kdf_parameters["kdf"] == KDF_SCRYPT:
+            cost = kdf_parameters["n"]
+            block_size = kdf_parameters["r"]
+            return hashlib.scrypt(password,
+                                  salt=salt,
+                                  n=cost,
+                                  r=block_size,
+                                  p=kdf_parameters["p"],
+                                  # Twice what scrypt needs to leave room for overhead
+                                  maxmem=256 * cost * block_size,
+                                  dklen=hash_length)
+        return hashlib.pbkdf2_hmac(_MAIN_HASH_NAME,
+                                   password,
+                                   salt,
+                                   kdf_parameters["iterations"],
+                                   dklen=hash_length)
+
+
 def _derive_encryption_key(main_pass: str, main_accountname: str) -> bytes:
+    # The data key of main accounts from before the data keys were wrapped.
     # Use both the accountname and the main password for creating the key
     #   - main accountname is unique for every main account but known to all
     #   - main password may not be unique but is unknown to other users
@@ -135,8 +483,9 @@ def _derive_encryption_key(main_pass: str, main_accountname: str) -> bytes:
 
 def _encrypt_contents(username: str,
                       password: str,
-                      key: bytes,
-                      init_vector: bytes) -> bytes:
+                      contents_cipher: cipher.Cipher,
+                      nonce: bytes,
+                      encrypted_name: bytes) -> bytes:
     # The lengths of username and password are stored so that the values can
     # be read from the file content string on load.
     username_length = str(len(username)) + _SPLIT
@@ -148,26 +497,74 @@ def _encrypt_contents(username: str,
     if len(plain_text) % 16 != 0:
         plain_text = _right_pad(plain_text)
 
-    encryptor = AES.new(key, ENCRYPT_MODE, IV=init_vector)
-    encrypted_contents = encryptor.encrypt(plain_text)
-    return encrypted_contents
+    # The contents are bound to the name so that they can't be swapped
+    return contents_cipher.encrypt(nonce,
+                                   data_formats.encode_general(plain_text),
+                                   encrypted_name)
+
 
+def _encrypt_service_account(service_account: ServiceAccount,
+                             encryption_key: bytes,
+                             algorithm: str) -> Tuple[str, bytes]:
+    name_cipher, contents_cipher = _service_ciphers(encryption_key, algorithm)
+    nonce = os.urandom(name_cipher.nonce_length)
 
-def _encrypt_filename(service_name_in: str, key: bytes, init_vector: bytes) -> str:
+    # Encrypt service name to be used as filename
+    # The filename includes the nonce at the beginning.
+    filename, encrypted_name = _encrypt_filename(service_account.service_name,
+                                                 name_cipher,
+                                                 nonce)
+
+    # Encrypt the accountname and the password
+    contents = _encrypt_contents(service_account.account_name,
+                                 service_account.service_password,
+                                 contents_cipher,
+                                 nonce,
+                                 encrypted_name)
 
-    encryptor = AES.new(key, ENCRYPT_MODE, IV=init_vector)
+    _logger.debug("STORE - Final filename: %s", filename)
+    return filename + layout.SERVICE_FILE_EXT, contents
+
+
+def _encrypt_filename(service_name_in: str,
+                      name_cipher: cipher.Cipher,
+                      nonce: bytes) -> Tuple[str, bytes]:
+    # Returns the filename and the encrypted service name in it
     service_name = _SRV_IDENTIFIER + _SPLIT + service_name_in
     if len(service_name) % 16 != 0:
         service_name = _right_pad(service_name)
-    _logger.debug("STORE - Padded filename (%s): %s",
-                  str(len(service_name)),
-                  service_name)
-    encrypted_filename = encryptor.encrypt(service_name)
-    _logger.debug("STORE - Encrypted filename RAW: %s", encrypted_filename)
-    _logger.debug("STORE - Encrypted filename: %s", data_formats.decode_store(encrypted_filename))
-    _logger.debug("LOAD - INIT VECTOR RAW: %s", data_formats.decode_store(init_vector))
-    _logger.debug("STORE - INIT VECTOR: %s", init_vector)
-    return data_formats.decode_store(init_vector) + data_formats.decode_store(encrypted_filename)
+    encrypted_name = name_cipher.encrypt(nonce, data_formats.encode_general(service_name))
+    filename = (_CIPHER_PREFIXES.get(name_cipher.algorithm, "") +
+                data_formats.decode_store(nonce) +
+                data_formats.decode_store(encrypted_name))
+    return filename, encrypted_name
+
+
+def _encrypt_manifest(filenames: Sequence[str], key: bytes) -> bytes:
+    algorithm = get_cipher()
+    _, manifest_cipher = _service_ciphers(key, algorithm)
+    nonce = os.urandom(manifest_cipher.nonce_length)
+    manifest = _MANIFEST_IDENTIFIER + _SPLIT + _MANIFEST_SPLIT.join(filenames)
+    manifest = _right_pad(manifest)
+
+    encrypted_manifest = nonce + manifest_cipher.encrypt(nonce,
+                                                         data_formats.encode_general(manifest),
+                                                         data_formats.encode_general(_MANIFEST_IDENTIFIER))
+    if not manifest_cipher.authenticated:
+        return encrypted_manifest
+    return _MANIFEST_MAGIC + bytes([_CIPHER_IDS[algorithm]]) + encrypted_manifest
+
+
+def _find_file(file_paths: Sequence[str]) -> Optional[str]:
+    # Returns the first of the possible locations where the file exists
+    for file_path in file_paths:
+        if os.path.exists(_current_path(file_path) or ""):
+            return file_path
+    return None
+
+
+def _generate_data_key() -> bytes:
+    return os.urandom(_DATA_KEY_LENGTH)
 
 
 def _generate_init_vector() -> bytes:
@@ -178,95 +575,511 @@ def _generate_salt() -> bytes:
     return os.urandom(data_formats.SALT_LENGTH)
 
 
-def get_usernames() -> Optional[Sequence[str]]:
-    filenames = _read_filenames(_MAIN_FILE_EXT)
-    # Cut the file extensions out
-    filenames = [filename.split(".")[0] for filename in filenames]
-    return filenames
-
-
-def _load_service_account(filename: str, key: bytes) -> Optional[ServiceAccount]:
-    encrypted_service_name = filename.split(".")[0]
-
-    _logger.debug("LOAD - 'Final' filename: %s", filename)
+def get_cipher() -> str:
+    # The algorithm new service account files are encrypted with
+    algorithm = layout.vault_config().get("cipher", cipher.default_algorithm())
+    if not cipher.is_available(algorithm):
+        _logger.warning("%s isn't available, encrypting with %s instead", algorithm, cipher.AES_CBC)
+        return cipher.AES_CBC
+    return algorithm
 
-    # Get the initialization vector
-    # 2x to accommodate for bytes in hex
-    init_vector = data_formats.encode_general(encrypted_service_name[:data_formats.IV_LENGTH * 2])
-    _logger.debug("LOAD - INIT VECTOR RAW: %s", init_vector)
-    init_vector = data_formats.encode_load(init_vector.decode("utf-8"))
-    _logger.debug("LOAD - INIT VECTOR: %s", init_vector)
 
-    # Cut out the initialization vector
-    # 2x to accommodate for bytes in hex
-    encrypted_service_name = encrypted_service_name[data_formats.IV_LENGTH * 2:]
-    _logger.debug("LOAD - Encrypted filename: %s", encrypted_service_name)
+def get_kdf_parameters() -> Dict:
+    # The parameters new main account files are hashed with
+    return layout.vault_config().get("kdf", _DEFAULT_KDF)
 
-    encrypted_service_name = data_formats.encode_load(encrypted_service_name)
-    _logger.debug("STORE - Encrypted filename RAW: %s", encrypted_service_name)
 
-    service_name = _decrypt_filename(encrypted_service_name, key, init_vector)
+def get_usernames() -> Optional[Sequence[str]]:
+    with locking.shared(layout.accounts_directory(), locking.REGISTRY):
+        return list(layout.main_account_names())
 
-    _logger.debug("LOAD - Padded filename: %s", service_name)
-    service_name = _right_unpad(service_name)
-    _logger.debug("LOAD - Actual filename: %s", service_name)
 
-    if not service_name.startswith(_SRV_IDENTIFIER + _SPLIT):
-        # This file didn't contain a service account for this main account
-        _logger.info("%s wasn't a service account for this main account.",
-                     service_name)
+def iter_service_accounts(main_account: MainAccount) -> Iterator[ServiceAccount]:
+    """Yields the main account's service accounts decrypted a batch at a time
+    without adding them to the main account, so that going through a huge
+    vault takes no more memory than a batch.
+    """
+    key = main_account.data_key
+    main_accountname = main_account.account_name
+    early_reject = False
+
+    # Held until the last batch so that no writer changes the files meanwhile
+    with _reading(main_accountname):
+        vault = _packed_vault(main_accountname)
+        if vault is not None:
+            records = ((filename, functools.partial(bytes, vault.read(filename)))
+                       for filename in vault.names())
+        else:
+            filenames = _load_manifest(main_accountname, key)
+            if filenames is not None:
+                file_paths = ((filename,
+                               _find_file(layout.service_paths(main_accountname, filename)))
+                              for filename in filenames)
+            else:
+                # Every file that may belong to the account has to be tried
+                file_paths = layout.service_filenames(main_accountname)
+                early_reject = True
+            records = ((filename, functools.partial(_read_file, file_path))
+                       for filename, file_path in file_paths if file_path is not None)
+
+        batch_size = _LOAD_BATCH_SIZE * _load_workers
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if len(batch) == 0:
+                return
+            for service in _load_in_parallel(key, batch, early_reject):
+                if service is not None:
+                    yield service
+
+
+@contextlib.contextmanager
+def _journaled():
+    """Stages the file writes and removals made within into a single journal
+    transaction that is committed at the end. Nested uses join the outer one.
+    """
+    global _journal
+    if _journal is not None:
+        yield
+        return
+
+    _journal = journal.Journal(layout.accounts_directory())
+    try:
+        yield
+        _journal.commit()
+    except BaseException:
+        _journal.abort()
+        raise
+    finally:
+        _journal = None
+
+
+def is_packed(main_account: MainAccount) -> bool:
+    with _reading(main_account.account_name):
+        return _packed_vault(main_account.account_name) is not None
+
+
+def listed_services(main_account: MainAccount) -> Optional[Dict[str, str]]:
+    """Maps the service names of the main account's manifest, or of its container
+    if it's packed, to the listed files. Files listed but missing are left out.
+    None if the main account has neither.
+    """
+    main_accountname = main_account.account_name
+    key = main_account.data_key
+    with _reading(main_accountname):
+        vault = _packed_vault(main_accountname)
+        if vault is not None:
+            filenames = list(vault.names())
+        else:
+            filenames = _load_manifest(main_accountname, key)
+            if filenames is not None:
+                filenames = [filename for filename in filenames
+                             if _find_file(layout.service_paths(main_accountname, filename)) is not None]
+    if filenames is None:
         return None
 
-    # Cut the service header from the name
-    service_name = "".join(service_name.split(_SPLIT)[1:])
-    # Decrypted successfully -> it's a correct service
+    services = {}
+    for filename in filenames:
+        try:
+            service = _decrypt_service_account(filename, key, None, lazy=True)
+        except ValueError as e:
+            _logger.info("Listed file %s couldn't be decrypted: %s", filename, e)
+            continue
+        if service is not None:
+            services[service[0]] = filename
+    return services
 
-    encrypted_contents = _read_file(filename)
-    username, password = _decrypt_contents(encrypted_contents,
-                                           key,
-                                           init_vector)
-    service = ServiceAccount(service_name,
-                             username,
-                             password,
-                             filename)
-    _logger.info("Loaded service account for %s.", service_name)
-    return service
 
+def _load_manifest(main_accountname: str, key: bytes) -> Optional[List[str]]:
+    manifest_path = _find_file(layout.manifest_paths(main_accountname))
+    if manifest_path is None:
+        return None
+    with profiling.timed("manifest"):
+        filenames = _decrypt_manifest(_read_file(manifest_path), key)
+    if filenames is None:
+        _logger.warning("Manifest of %s couldn't be decrypted!", main_accountname)
+    return filenames
 
-def load_service_accounts(main_account: MainAccount):
-    filenames = _read_filenames(_SERVICE_FILE_EXT)
-    decryption_key = _derive_encryption_key(main_account.main_pass,
-                                            main_account.account_name)
 
-    for filename in filenames:
+def _load_credentials(key: bytes,
+                      filename: str,
+                      read_contents: Callable[[], bytes]) -> Tuple[str, str]:
+    try:
+        credentials = _decrypt_contents(read_contents(), key, filename)
+    except Exception as e:
+        credentials = None
+        _logger.warning("Service account's credentials couldn't be loaded: %s", e)
+
+    if credentials is None:
+        # Too late to leave the account out, so it's shown without credentials
+        return "", ""
+    return credentials
+
+
+def _load_batch(key: bytes,
+                batch: Sequence[Tuple[str, Callable[[], bytes]]],
+                early_reject: bool,
+                lazy: bool) -> List[Optional[Tuple]]:
+    # Runs in the worker pool, hence everything passed in and out must be picklable
+    services = []
+    for filename, read_contents in batch:
         try:
-            service = _load_service_account(filename, decryption_key)
+            if early_reject and not _may_be_owned(filename, key):
+                service = None
+            else:
+                service = _decrypt_service_account(filename, key, read_contents, lazy)
         except Exception as e:
             # Very likely that the service account was for another main account
             # but it could be that there's a bug in the system.
             _logger.warning("Service account couldn't be loaded: %s", e)
             service = None
+        services.append(service)
+    if profiling.enabled:
+        profiling.count("files decrypted", len(services))
+        profiling.count("files rejected", services.count(None))
+    return services
+
+
+def _load_in_parallel(key: bytes,
+                      records: Sequence[Tuple[str, Callable[[], bytes]]],
+                      early_reject: bool = False) -> List[Optional[ServiceAccount]]:
+    """Decrypts the records in batches on the worker pool. The results are in
+    the same order as the records regardless of which worker finishes first.
+    """
+    with profiling.timed("decryption"):
+        if _load_workers == 1 or len(records) < _PARALLEL_LOAD_THRESHOLD:
+            return _service_accounts(_load_batch(key, records, early_reject, _load_lazily))
+
+        # Enough batches to keep every worker busy even if some finish early
+        batch_size = min(_LOAD_BATCH_SIZE, -(-len(records) // (_load_workers * 4)))
+        batches = [records[i:i + batch_size] for i in range(0, len(records), batch_size)]
+
+        if _load_with_processes:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=_load_workers)
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=_load_workers)
+        with executor:
+            results = executor.map(_load_batch,
+                                   itertools.repeat(key),
+                                   batches,
+                                   itertools.repeat(early_reject),
+                                   itertools.repeat(_load_lazily))
+            return _service_accounts(service for batch in results for service in batch)
 
+
+def load_service_accounts(main_account: MainAccount):
+    with profiling.timed("load service accounts"), _reading(main_account.account_name):
+        _load_service_accounts(main_account)
+    _upgrade_cipher(main_account)
+
+
+def _load_service_accounts(main_account: MainAccount):
+    decryption_key = main_account.data_key
+
+    vault = _packed_vault(main_account.account_name)
+    if vault is not None:
+        # The container is the index of the main account's service accounts.
+        # The records are read from the memory map up front so that they can
+        # be handed to worker processes as well.
+        records = [(filename, functools.partial(bytes, vault.read(filename)))
+                   for filename in vault.names()]
+        for service in _load_in_parallel(decryption_key, records):
+            if service is not None:
+                main_account.add_service_account(service)
+        return
+
+    filenames = _load_manifest(main_account.account_name, decryption_key)
+    if filenames is None:
+        # No (usable) manifest yet, e.g. the vault predates manifests. Find the
+        # services the slow way and index them for the next login. No service
+        # account may be stored between the scan and the indexing.
+        with _writing(main_account.account_name):
+            # Another process may have rebuilt it while this one waited
+            filenames = _load_manifest(main_account.account_name, decryption_key)
+            if filenames is None:
+                _logger.info("Rebuilding the manifest of %s", main_account.account_name)
+                _scan_service_accounts(main_account, decryption_key)
+                _store_manifest(main_account.account_name,
+                                decryption_key,
+                                [account.filename for account in main_account.service_accounts])
+                return
+
+    missing_files = []
+    file_paths = []
+    for filename in filenames:
+        file_path = _find_file(layout.service_paths(main_account.account_name, filename))
+        if file_path is None:
+            _logger.warning("Service account file %s listed in the manifest is missing",
+                            filename)
+            missing_files.append(filename)
+            continue
+        file_paths.append((filename, file_path))
+
+    records = [(filename, _service_file_reader(main_account.account_name, filename, file_path))
+               for filename, file_path in file_paths]
+    services = _load_in_parallel(decryption_key, records)
+    for service, (filename, file_path) in zip(services, file_paths):
         if service is not None:
-            main_account.service_accounts.append(service)
+            _adopt_service_file(main_account.account_name, filename, file_path)
+            main_account.add_service_account(service)
+
+    if len(missing_files) != 0:
+        with _writing(main_account.account_name):
+            _update_manifest(main_account.account_name,
+                             decryption_key,
+                             removed=missing_files)
+
+
+def locked(main_account: MainAccount, exclusive: bool = False) -> contextlib.AbstractContextManager:
+    """Holds the main account's lock across several storage calls, e.g. to keep
+    the files from changing between checking and acting on them.
+    """
+    if exclusive:
+        return _writing(main_account.account_name)
+    return _reading(main_account.account_name)
+
+
+def main_account_exists(username: str) -> bool:
+    return layout.main_account_exists(username)
+
+
+def _may_be_owned(filename: str, key: bytes) -> bool:
+    """Cheap check for whether the service account file may belong to the key's
+    owner. Authenticated names are checked by their tag. Of the others only the
+    first block is decrypted; with any other key it won't begin with the service
+    identifier.
+    """
+    algorithm, nonce, encrypted_name = split_service_filename(filename)
+    name_cipher, _ = _service_ciphers(key, algorithm)
+    if name_cipher.authenticated:
+        return name_cipher.decrypt(nonce, encrypted_name) is not None
 
+    identifier = data_formats.encode_general(_SRV_IDENTIFIER + _SPLIT)
+    return name_cipher.decrypt(nonce, encrypted_name[:_BLOCK_SIZE]).startswith(identifier)
 
-def _read_file(filename: str) -> bytes:
+
+def _pack_main_account(kdf_parameters: Dict,
+                       salt: bytes,
+                       verifier: bytes,
+                       wrapped_key: bytes) -> bytes:
+    if kdf_parameters["kdf"] == KDF_SCRYPT:
+        costs = (kdf_parameters["n"], kdf_parameters["r"], kdf_parameters["p"])
+    else:
+        costs = (kdf_parameters["iterations"], 0, 0)
+    header = _ACCOUNT_HEADERS[_ACCOUNT_VERSION].pack(_ACCOUNT_MAGIC,
+                                                     _ACCOUNT_VERSION,
+                                                     _KDF_IDS[kdf_parameters["kdf"]],
+                                                     *costs,
+                                                     len(salt),
+                                                     len(verifier),
+                                                     len(wrapped_key))
+    return header + salt + verifier + wrapped_key
+
+
+def pack_service_accounts(main_account: MainAccount) -> bool:
+    """Moves the main account's service accounts from separate files into a
+    packed container. The records are copied as they are, no re-encryption is
+    needed. Returns False if the account was already packed.
+    """
+    def records() -> Iterator[Tuple[str, bytes]]:
+        for account in main_account.service_accounts:
+            file_path = _find_file(layout.service_paths(main_account.account_name,
+                                                        account.filename))
+            yield account.filename, _read_file(file_path)
+
+    with _writing(main_account.account_name):
+        if _packed_vault(main_account.account_name) is not None:
+            return False
+
+        container_path = layout.container_paths(main_account.account_name)[0]
+        os.makedirs(os.path.dirname(container_path), exist_ok=True)
+        _packed_vaults[container_path] = packed.pack(container_path, records())
+
+        # The container is complete, the separate files can go
+        with _journaled():
+            for account in main_account.service_accounts:
+                _delete_service_file(main_account.account_name, account.filename)
+            _delete_manifest(main_account.account_name)
+    return True
+
+
+def _packed_vault(main_accountname: str) -> Optional[packed.PackedVault]:
+    # Returns the main account's container if the account uses the packed engine
+    container_path = _find_file(layout.container_paths(main_accountname))
+    if container_path is None:
+        return None
+
+    vault = _packed_vaults.get(container_path)
+    if vault is None:
+        vault = packed.open_vault(container_path)
+        _packed_vaults[container_path] = vault
+    elif vault.is_stale():
+        # Written by another process since, appending to the old view of the
+        # container would overwrite its records
+        vault.load()
+    return vault
+
+
+def recover_storage() -> int:
+    """Finishes the storage operations interrupted by a crash. Another process,
+    possibly one whose pid isn't visible here, may be in the middle of one, so
+    the journal is replayed only while holding every lock exclusively.
+    """
+    accounts_directory = layout.accounts_directory()
+    if not journal.pending(accounts_directory):
+        return 0
+    with locking.all_accounts(accounts_directory, layout.main_account_names(), exclusive_lock=True):
+        return journal.recover(accounts_directory)
+
+
+def _read_file(file_path: str) -> bytes:
     # TODO: Platform indepedency
-    file_path = _FILE_DIR + filename
-    with open(file_path, "rb") as source:
+    current_path = _current_path(file_path)
+    if current_path is None:
+        raise FileNotFoundError("{} is removed".format(file_path))
+    with open(current_path, "rb") as source:
         contents = source.read()
+    if profiling.enabled:
+        profiling.count("files read")
+        profiling.count("bytes read", len(contents))
     return contents
 
 
-def _read_filenames(extension: str = None) -> Sequence[str]:
+def _read_service_file(main_accountname: str, filename: str) -> bytes:
+    file_path = _find_file(layout.service_paths(main_accountname, filename))
+    if file_path is None:
+        raise FileNotFoundError("Service account file {} is missing".format(filename))
+    return _read_file(file_path)
+
+
+def _reading(main_accountname: str) -> contextlib.AbstractContextManager:
+    return locking.shared(layout.accounts_directory(), main_accountname)
+
+
+def relist_service_file(main_account: MainAccount, filename: str):
+    """Adds a service account file the main account's manifest has lost track of
+    back into it. A packed main account gets the file moved into its container.
+    """
+    main_accountname = main_account.account_name
+    with _writing(main_accountname):
+        vault = _packed_vault(main_accountname)
+        if vault is not None:
+            vault.append(filename, _read_service_file(main_accountname, filename))
+            _delete_service_file(main_accountname, filename)
+            return
+
+        with _journaled():
+            _update_manifest(main_accountname, main_account.data_key, added=[filename])
+
+
+def _remove_file(file_path: str):
+    if _journal is not None:
+        _journal.remove(file_path)
+    else:
+        os.remove(file_path)
+
+
+def replace_service_account(main_account: MainAccount, service_account: ServiceAccount) -> str:
+    """Stores the changed service account under a new file and removes the one
+    it had. Returns the new filename.
+    """
+    main_accountname = main_account.account_name
+    old_filename = service_account.filename
+    filename, contents = _encrypt_service_account(service_account, main_account.data_key, get_cipher())
+
+    with _writing(main_accountname):
+        vault = _packed_vault(main_accountname)
+        if vault is not None:
+            vault.append(filename, contents)
+            vault.remove(old_filename)
+            return filename
+
+        with _journaled():
+            _write_file(layout.service_path(main_accountname, filename), contents)
+            _delete_service_file(main_accountname, old_filename)
+            _update_manifest(main_accountname,
+                             main_account.data_key,
+                             added=[filename],
+                             removed=[old_filename])
+    return filename
+
 
-    files_list = [f for f in os.listdir(_FILE_DIR) if os.path.isfile(os.path.join(_FILE_DIR, f))]
-    if extension is not None:
-        # If file extension is specified, only return filenames with said extension
-        files_list = [f for f in files_list if f.endswith(extension)]
-    _logger.debug("Retrieved files list: %s", files_list)
-    return files_list
+def refresh_service_accounts(main_account: MainAccount) -> Tuple[int, int]:
+    """Applies the changes other processes have made to the main account's
+    service accounts since they were loaded, or since the previous refresh.
+    Only the changed files are read unless the watcher lost track of them.
+    Returns the number of service accounts added and removed.
+    """
+    main_accountname = main_account.account_name
+    key = main_account.data_key
+
+    # The changes are collected under the lock so that no write is seen halfway
+    with _reading(main_accountname):
+        watcher = _watchers.get(main_accountname)
+        if watcher is None or watcher.directories != layout.watched_directories(main_accountname):
+            # Not watched yet or the layout was migrated meanwhile
+            watch_service_accounts(main_account)
+            changed = None
+        else:
+            changed = watcher.changes()
+        if changed is not None and len(changed) == 0:
+            return 0, 0
+
+        with profiling.timed("refresh service accounts"):
+            known = {account.filename: account for account in main_account.service_accounts}
+            vault = _packed_vault(main_accountname)
+            if vault is not None:
+                if changed is not None and main_accountname + layout.CONTAINER_FILE_EXT not in changed:
+                    return 0, 0
+                # Comparing the names is cheap, only the new records are decrypted
+                filenames = set(vault.names())
+                removed = known.keys() - filenames
+                records = [(filename, functools.partial(bytes, vault.read(filename)))
+                           for filename in filenames - known.keys()]
+                file_paths = [(filename, None) for filename, _ in records]
+            else:
+                if changed is None:
+                    filenames = _load_manifest(main_accountname, key)
+                    if filenames is None:
+                        candidates = dict(layout.service_filenames(main_accountname))
+                    else:
+                        candidates = {filename: _find_file(layout.service_paths(main_accountname, filename))
+                                      for filename in filenames}
+                    removed = {filename for filename in known if candidates.get(filename) is None}
+                else:
+                    candidates = {filename: _find_file(layout.service_paths(main_accountname, filename))
+                                  for filename in changed if filename.endswith(layout.SERVICE_FILE_EXT)}
+                    removed = {filename for filename, file_path in candidates.items()
+                               if file_path is None and filename in known}
+                file_paths = [(filename, file_path) for filename, file_path in candidates.items()
+                              if file_path is not None and filename not in known]
+                records = [(filename, _service_file_reader(main_accountname, filename, file_path))
+                           for filename, file_path in file_paths]
+
+            for filename in removed:
+                main_account.remove_service_account(known[filename].service_name)
+            added = 0
+            # Files of other main accounts show up too in the shared directories
+            services = _load_in_parallel(key, records, early_reject=vault is None)
+            for service, (filename, file_path) in zip(services, file_paths):
+                if service is None:
+                    continue
+                if file_path is not None:
+                    _adopt_service_file(main_accountname, filename, file_path)
+                if main_account.add_service_account(service):
+                    added += 1
+    if added != 0 or len(removed) != 0:
+        _logger.info("Refreshed %s: %s service accounts added and %s removed",
+                     main_accountname, added, len(removed))
+    return added, len(removed)
+
+
+def register_main_account(main_account: MainAccount) -> bool:
+    # Stores a new main account. Returns False if the name was taken meanwhile.
+    with locking.exclusive(layout.accounts_directory(), locking.REGISTRY):
+        if layout.main_account_exists(main_account.account_name):
+            return False
+        store_main_account(main_account)
+    return True
 
 
 def _right_pad(payload: str, chunk_size: int = 16):
@@ -278,99 +1091,399 @@ def _right_unpad(string: str) -> str:
     return string.rstrip(_PADDING)
 
 
-def salt_and_hash(password_in: str, salt: bytes) -> bytes:
-    # Encode into bytes
-    password = data_formats.encode_general(password_in)
-    # Salt & hash
-    hashed_pass = hashlib.pbkdf2_hmac(_MAIN_HASH_NAME,
-                                      password,
-                                      salt,
-                                      _ITERATIONS,
-                                      dklen=data_formats.KEY_LENGTH)
-    return salt + hashed_pass
+def _scan_service_accounts(main_account: MainAccount, key: bytes):
+    # Trial-decrypts every service account file that may belong to the account.
+    # Sorted so that the accounts end up in the same order on every scan.
+    with profiling.timed("directory scan"):
+        file_paths = sorted(layout.service_filenames(main_account.account_name))
+    profiling.count("files scanned", len(file_paths))
+    records = [(filename, _service_file_reader(main_account.account_name, filename, file_path))
+               for filename, file_path in file_paths]
 
+    services = _load_in_parallel(key, records, early_reject=True)
+    for service, (filename, file_path) in zip(services, file_paths):
+        if service is not None:
+            _adopt_service_file(main_account.account_name, filename, file_path)
+            main_account.add_service_account(service)
 
-def store_main_account(main_account: MainAccount):
 
-    if main_account.salt is None:
-        main_account.salt = _generate_salt()
-    filename = main_account.account_name
-    salted_hash = salt_and_hash(main_account.main_pass, main_account.salt)
+def _service_accounts(decrypted: Iterable[Optional[Tuple]]) -> List[Optional[ServiceAccount]]:
+    # Built here rather than in the workers, whose sealing keys the process lacks
+    return [ServiceAccount(*fields) if fields is not None else None for fields in decrypted]
 
-    filename += _MAIN_FILE_EXT
-    _write_file(filename, salted_hash)
 
+@functools.lru_cache(maxsize=_CACHED_CIPHER_KEYS)
+def _service_ciphers(key: bytes, algorithm: str) -> Tuple[cipher.Cipher, cipher.Cipher]:
+    """Returns the ciphers of the service names and of the contents. They're
+    made once per key and reused for every file. A file's name and contents
+    share the nonce, so the authenticated ciphers get keys of their own.
+    """
+    if algorithm == cipher.AES_CBC:
+        legacy_cipher = cipher.keyed(algorithm, key)
+        return legacy_cipher, legacy_cipher
+    return (cipher.keyed(algorithm, hmac.new(key, _NAMES_CONTEXT, hashlib.sha256).digest()),
+            cipher.keyed(algorithm, hmac.new(key, _CONTENTS_CONTEXT, hashlib.sha256).digest()))
 
-def store_service_account(main_pass: str,
-                          main_accountname: str,
-                          service_account: ServiceAccount) -> str:
 
-    encryption_key = _derive_encryption_key(main_pass, main_accountname)
-    initiation_vector = _generate_init_vector()
+def salt_and_hash(password_in: str, salt: bytes) -> bytes:
+    # The format of main account files without a header
+    hashed_pass = _derive_password_hash(password_in,
+                                        salt,
+                                        _LEGACY_KDF,
+                                        data_formats.KEY_LENGTH)
+    return salt + hashed_pass
 
-    # Encrypt service name to be used as filename
-    # The filename includes the init vector at the beginning.
-    filename = _encrypt_filename(service_account.service_name,
-                                 encryption_key,
-                                 initiation_vector)
 
-    # Encrypt the accountname and the password
-    contents = _encrypt_contents(service_account.account_name,
-                                 service_account.service_password,
-                                 encryption_key,
-                                 initiation_vector)
+def set_cipher(algorithm: str):
+    # Service accounts are re-encrypted with it on their main account's next login
+    config = layout.vault_config()
+    config["cipher"] = algorithm
+    layout.store_vault_config(config)
 
-    # filename = data_formats.decode_to_string(filename)
-    _logger.debug("STORE - Final filename: %s", filename)
-    filename += _SERVICE_FILE_EXT
-    _write_file(filename, contents)
+
+def set_kdf_parameters(kdf_parameters: Dict):
+    # Main accounts switch to these on their next login
+    config = layout.vault_config()
+    config["kdf"] = kdf_parameters
+    layout.store_vault_config(config)
+
+
+def store_main_account(main_account: MainAccount):
+
+    if main_account.salt is None:
+        main_account.salt = _generate_salt()
+    if main_account.data_key is None:
+        # A new main account
+        main_account.data_key = _generate_data_key()
+    kdf_parameters = get_kdf_parameters()
+    master_key = _derive_password_hash(main_account.main_pass,
+                                       main_account.salt,
+                                       kdf_parameters,
+                                       _HASH_LENGTH)
+    verifier, wrapping_key = _derive_key_pair(master_key)
+    wrapped_key = _wrap_data_key(main_account.data_key, wrapping_key)
+
+    with _writing(main_account.account_name):
+        _write_file_replacing(layout.main_account_paths(main_account.account_name),
+                              _pack_main_account(kdf_parameters,
+                                                 main_account.salt,
+                                                 verifier,
+                                                 wrapped_key))
+
+
+def _service_file_reader(main_accountname: str,
+                         filename: str,
+                         file_path: str) -> Callable[[], bytes]:
+    if _load_lazily:
+        # The file may have been moved to its owner's directory by the time
+        # its credentials are needed
+        return functools.partial(_read_service_file, main_accountname, filename)
+    return functools.partial(_read_file, file_path)
+
+
+def split_service_filename(filename: str) -> Tuple[str, bytes, bytes]:
+    """Returns the cipher, the nonce and the encrypted service name that make up
+    the service account filename. Raises ValueError if it isn't one.
+    """
+    encrypted_name = filename.split(".")[0]
+    algorithm = cipher.AES_CBC
+    for prefixed_algorithm, prefix in _CIPHER_PREFIXES.items():
+        if encrypted_name.startswith(prefix):
+            algorithm = prefixed_algorithm
+            encrypted_name = encrypted_name[len(prefix):]
+            break
+    # Base32 takes 8 characters for every started 5 bytes
+    nonce_end = -(-cipher.NONCE_LENGTHS[algorithm] // 5) * 8
+    return (algorithm,
+            data_formats.encode_load(encrypted_name[:nonce_end]),
+            data_formats.encode_load(encrypted_name[nonce_end:]))
+
+
+def _store_manifest(main_accountname: str, key: bytes, filenames: Sequence[str]):
+    _write_file_replacing(layout.manifest_paths(main_accountname),
+                          _encrypt_manifest(filenames, key))
+
+
+def store_service_account(main_account: MainAccount, service_account: ServiceAccount) -> str:
+    main_accountname = main_account.account_name
+    encryption_key = main_account.data_key
+    filename, contents = _encrypt_service_account(service_account, encryption_key, get_cipher())
+
+    with _writing(main_accountname):
+        vault = _packed_vault(main_accountname)
+        if vault is not None:
+            vault.append(filename, contents)
+            return filename
+
+        with _journaled():
+            _write_file(layout.service_path(main_accountname, filename), contents)
+            _update_manifest(main_accountname, encryption_key, added=[filename])
     return filename
 
 
+def store_service_accounts(main_account: MainAccount, service_accounts: Iterable[ServiceAccount]):
+    """Stores new service accounts in bulk: as a single journal transaction with
+    one manifest update, or a single append to the container. The service
+    accounts are consumed one at a time and get their filenames set. Either
+    way nothing is stored if consuming them raises.
+    """
+    main_accountname = main_account.account_name
+    encryption_key = main_account.data_key
+    algorithm = get_cipher()
+
+    def records() -> Iterator[Tuple[str, bytes]]:
+        for service_account in service_accounts:
+            filename, contents = _encrypt_service_account(service_account, encryption_key, algorithm)
+            service_account.change_filename(filename)
+            yield filename, contents
+
+    with _writing(main_accountname):
+        vault = _packed_vault(main_accountname)
+        if vault is not None:
+            vault.append_many(records())
+            return
+
+        filenames = []
+        with _journaled():
+            for filename, contents in records():
+                _write_file(layout.service_path(main_accountname, filename), contents)
+                filenames.append(filename)
+            _update_manifest(main_accountname, encryption_key, added=filenames)
+
+
+def _time_kdf(kdf_parameters: Dict) -> float:
+    start = time.perf_counter()
+    _derive_password_hash("calibration", _generate_salt(), kdf_parameters, _HASH_LENGTH)
+    return time.perf_counter() - start
+
+
+def _unpack_main_account(contents: bytes) -> Tuple[Dict, bytes, bytes, Optional[bytes]]:
+    # Returns the KDF parameters, the salt, the password hash (or verifier) and
+    # the wrapped data key, which older formats don't have
+    version = contents[len(_ACCOUNT_MAGIC)] if len(contents) > len(_ACCOUNT_MAGIC) else None
+    header = _ACCOUNT_HEADERS.get(version)
+    if (header is not None and
+            contents.startswith(_ACCOUNT_MAGIC) and
+            len(contents) > header.size):
+        fields = header.unpack_from(contents)
+        kdf_id, first_cost, second_cost, third_cost, salt_length, hash_length = fields[2:8]
+        key_length = fields[8] if version >= 2 else 0
+        if len(contents) == header.size + salt_length + hash_length + key_length:
+            if kdf_id == _KDF_IDS[KDF_SCRYPT]:
+                kdf_parameters = {"kdf": KDF_SCRYPT,
+                                  "n": first_cost,
+                                  "r": second_cost,
+                                  "p": third_cost}
+            else:
+                kdf_parameters = {"kdf": KDF_PBKDF2, "iterations": first_cost}
+            salt_end = header.size + salt_length
+            hash_end = salt_end + hash_length
+            wrapped_key = contents[hash_end:] if version >= 2 else None
+            return (kdf_parameters,
+                    contents[header.size:salt_end],
+                    contents[salt_end:hash_end],
+                    wrapped_key)
+
+    # No header: the salt followed by the password hash
+    return (_LEGACY_KDF,
+            contents[:data_formats.SALT_LENGTH],
+            contents[data_formats.SALT_LENGTH:],
+            None)
+
+
+def unwatch_service_accounts(main_account: MainAccount):
+    watcher = _watchers.pop(main_account.account_name, None)
+    if watcher is not None:
+        watcher.close()
+
+
+def _unwrap_data_key(wrapped_key: bytes, wrapping_key: bytes) -> bytes:
+    init_vector = wrapped_key[:data_formats.IV_LENGTH]
+    return cipher.keyed(cipher.AES_CBC, wrapping_key).decrypt(init_vector,
+                                                              wrapped_key[data_formats.IV_LENGTH:])
+
+
+def _update_manifest(main_accountname: str,
+                     key: bytes,
+                     added: Sequence[str] = (),
+                     removed: Sequence[str] = ()):
+    filenames = _load_manifest(main_accountname, key)
+    if filenames is None:
+        # Without a manifest the next login rebuilds one from the directory
+        return
+
+    filenames = [filename for filename in filenames if filename not in removed]
+    filenames.extend(added)
+    _store_manifest(main_accountname, key, filenames)
+
+
 def update_service_accounts(main_account: MainAccount):
-    for account in main_account.service_accounts:
-        delete_service_account(account.filename)
-        filename = store_service_account(main_account.main_pass,
-                                         main_account.account_name,
-                                         account)
-        account.change_filename(filename)
+    """Re-encrypts every service account with the main account's data key. All
+    the files are replaced in a single journal transaction, so a crash leaves
+    either every old file or every new one.
+    """
+    encryption_key = main_account.data_key
+    algorithm = get_cipher()
+
+    with _writing(main_account.account_name), _journaled():
+        vault = _packed_vault(main_account.account_name)
+        if vault is not None:
+            records = []
+            for account in main_account.service_accounts:
+                filename, contents = _encrypt_service_account(account, encryption_key, algorithm)
+                records.append((filename, contents))
+                account.change_filename(filename)
+            # Every old record would be dead, so a new container replaces it
+            packed.pack(_journal.staged_path(vault.path), records).close()
+            vault.close()
+            _packed_vaults.pop(vault.path)
+            return
+
+        for account in main_account.service_accounts:
+            # Encrypted before the old file goes as lazily loaded credentials are
+            # read from it
+            filename, contents = _encrypt_service_account(account, encryption_key, algorithm)
+            _delete_service_file(main_account.account_name, account.filename)
+            _write_file(layout.service_path(main_account.account_name, filename), contents)
+            account.change_filename(filename)
+
+        # The old manifest was encrypted with the previous key
+        _store_manifest(main_account.account_name,
+                        encryption_key,
+                        [account.filename for account in main_account.service_accounts])
+
+
+def _upgrade_cipher(main_account: MainAccount):
+    # Re-encrypts the service accounts if the cipher has been changed since
+    algorithm = get_cipher()
+    filenames = {account.filename for account in main_account.service_accounts}
+    if all(split_service_filename(filename)[0] == algorithm for filename in filenames):
+        return
+    with _writing(main_account.account_name):
+        # Another process may have re-encrypted them while this one waited
+        vault = _packed_vault(main_account.account_name)
+        if vault is not None:
+            current_filenames = set(vault.names())
+        else:
+            current_filenames = set(_load_manifest(main_account.account_name,
+                                                   main_account.data_key) or ())
+        if current_filenames != filenames:
+            return
+        _logger.info("Re-encrypting the service accounts of %s with %s",
+                     main_account.account_name, algorithm)
+        update_service_accounts(main_account)
+
+
+def _upgrade_main_account(main_account: MainAccount, file_path: str, contents: bytes):
+    with _writing(main_account.account_name):
+        # The password may have been changed by another process after the
+        # file was read, the change must not be undone
+        if _find_file([file_path]) is None or _read_file(file_path) != contents:
+            return
+        _logger.info("Upgrading the main account file of %s", main_account.account_name)
+        main_account.salt = None
+        store_main_account(main_account)
+
+
+def _uses_password_derived_key(main_account: MainAccount) -> bool:
+    return main_account.data_key == _derive_encryption_key(main_account.main_pass,
+                                                           main_account.account_name)
 
 
 def validate_main_login(username: str, password_in: str) -> Optional[MainAccount]:
     main_account = None
+    # Only existing accounts are locked, a mistyped name mustn't leave a lock file
+    if not layout.main_account_exists(username):
+        return None
 
-    username_file = username + _MAIN_FILE_EXT
-    filenames = _read_filenames(_MAIN_FILE_EXT)
+    with _reading(username):
+        file_path = _find_file(layout.main_account_paths(username))
+        contents = _read_file(file_path) if file_path is not None else None
 
-    if username_file in filenames:
+    if contents is not None:
         # Account exists
-        contents = _read_file(username_file)
-
-        # Includes the salt
-        actual_password = contents
-        actual_salt = contents[:data_formats.SALT_LENGTH]
+        kdf_parameters, actual_salt, actual_password, wrapped_key = _unpack_main_account(contents)
 
-        hashed_password_in = salt_and_hash(password_in, actual_salt)
+        hashed_password_in = _derive_password_hash(password_in,
+                                                   actual_salt,
+                                                   kdf_parameters,
+                                                   len(actual_password))
+        if wrapped_key is not None:
+            hashed_password_in, wrapping_key = _derive_key_pair(hashed_password_in)
 
         if _compare_hash(hashed_password_in, actual_password):
             # Login successful
-            main_account = MainAccount(username, password_in, actual_salt)
+            if wrapped_key is not None:
+                data_key = _unwrap_data_key(wrapped_key, wrapping_key)
+            else:
+                # Adopt the key the service accounts were encrypted with so
+                # that none of them need to be rewritten
+                data_key = _derive_encryption_key(password_in, username)
+            main_account = MainAccount(username, password_in, actual_salt, data_key)
+            main_account.remember_authentication(password_in)
+
+            if (wrapped_key is None or
+                    kdf_parameters != get_kdf_parameters()):
+                # Stored in an older format or with outdated parameters, now is
+                # the only time the password is known to upgrade them
+                _upgrade_main_account(main_account, file_path, contents)
 
     return main_account
 
 
-def _write_file(filename: str, contents: bytes):
+def watch_service_accounts(main_account: MainAccount):
+    """Starts keeping track of the changes to the main account's files for
+    refresh_service_accounts. Started before loading, no change made while
+    loading goes unnoticed.
+    """
+    unwatch_service_accounts(main_account)
+    _watchers[main_account.account_name] = watch.watch(
+        layout.watched_directories(main_account.account_name))
+
+
+def _wrap_data_key(data_key: bytes, wrapping_key: bytes) -> bytes:
+    # The data key is random so it doesn't need padding or authentication of its
+    # own, a wrong password is already caught by the verifier
+    init_vector = _generate_init_vector()
+    return init_vector + cipher.keyed(cipher.AES_CBC, wrapping_key).encrypt(init_vector, data_key)
+
+
+def _write_file(file_path: str, contents: bytes):
     """Writes the account credentials into a file
     For main accounts
-        filename: the account's name as plain text
+        file_path: ends with the account's name as plain text
         contents: the salted password hash
     For service accounts
-        filename: the service's name as encrypted
+        file_path: ends with the service's name as encrypted
         contents: the service account's username & password as encrypted
+    Within a journal transaction the file is only staged.
     """
 
-    file_path = _FILE_DIR + filename
+    if _journal is not None:
+        _journal.write(file_path, contents)
+        _logger.info("Staged account file %s", file_path)
+        return
 
-    with open(file_path, "wb") as source:
+    try:
+        source = open(file_path, "wb")
+    except FileNotFoundError:
+        # The main account's (shard) directory doesn't exist yet
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        source = open(file_path, "wb")
+
+    with source:
         source.write(contents)
-        _logger.info("Saved account in file %s", filename)
+        _logger.info("Saved account in file %s", file_path)
+
+
+def _write_file_replacing(file_paths: Sequence[str], contents: bytes):
+    # Writes into the primary location and removes the copies elsewhere so that
+    # an ongoing layout migration can't move a stale copy over the new one.
+    _write_file(file_paths[0], contents)
+    for file_path in file_paths[1:]:
+        if _find_file([file_path]) is not None:
+            _remove_file(file_path)
+
+
+def _writing(main_accountname: str) -> contextlib.AbstractContextManager:
+    return locking.exclusive(layout.accounts_directory(), main_accountname)
@@ -0,0 +1,611 @@
+#!/bin/python3
+"""
+Sync module brings two accounts directories, e.g. those of two machines, to the
+same state. The other side is either a directory or a stand-in server serving
+one over a Unix domain socket, one JSON object per line like the agent. The
+socket is kept and checked like the agent's.
+
+Every side keeps an index of its files in .sync/index.json with each file's
+content hash, a version counter that grows whenever the file is changed, and
+the version it had when it was last synced. The index is brought up to date
+from the files' sizes and modification times, so only changed files are read.
+
+The files are the leaves of a Merkle tree in which they're grouped by a prefix
+of their path's hash. The sides compare the hashes of the root's children first
+and then only the children of the nodes that differ, a level per round trip,
+until the differing files are found. Only those files are transferred, so a sync costs about the
+same however large the vaults are as long as they differ by little.
+
+The versions tell which side has the newer file. A file changed on both sides
+since they last synced is a conflict: a change wins over a removal, otherwise
+one side wins and the other keeps its file under .sync/conflicts/. The service
+account files are never changed in place, only added and removed, so conflicts
+are limited to the few files that are, like the main account files and packed
+vaults.
+
+The manifests list the service account files and are written whenever those
+are, so they aren't synced. A side whose service account files a sync changed
+removes its manifests instead and the next login rebuilds them.
+"""
+import abc
+import base64
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import socket
+import socketserver
+
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import passager.agent as agent
+import passager.layout as layout
+import passager.locking as locking
+
+# Hex characters of the path's hash used for each level of the tree
+TREE_DEPTH = 3
+
+_CHUNK_SIZE = 64 * 1024
+# Reading a large batch of files can take a while
+_CLIENT_TIMEOUT = 60.0
+_CONFLICT_DIR = "conflicts"
+# Left out: locks, the crash journal, the sync state itself and the breach list,
+# which can be built again and is large
+_EXCLUDED_DIRS = (".journal", ".locks", ".sync")
+_EXCLUDED_FILES = ("breached-passwords.bin", )
+_INDEX_FILE = "index.json"
+_STATE_DIR = ".sync"
+_TEMPORARY_FILE_EXT = ".tmp"
+
+_logger = logging.getLogger(__name__)
+
+
+class Record:
+    """A file as the index knows it. A removed file is kept as a record without
+    a hash so that the removal is synced too.
+    """
+    __slots__ = ("file_hash", "version", "synced_version")
+
+    def __init__(self, file_hash: Optional[str], version: int, synced_version: int):
+        self.file_hash = file_hash
+        self.version = version
+        self.synced_version = synced_version
+
+    def changed_locally(self) -> bool:
+        # Changed since the last sync
+        return self.version != self.synced_version
+
+
+class SyncResult:
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        # The paths changed on both sides
+        self.conflicts = []
+        self.round_trips = 0
+
+
+class Replica(abc.ABC):
+    """One side of a sync. begin() locks the accounts directory and brings the
+    index up to date, end() saves the index and unlocks the directory.
+    """
+    @abc.abstractmethod
+    def apply(self, changes: Dict[str, Tuple[Record, Optional[bytes], bool]]):
+        """Writes the files with their records. The contents are None for
+        removed files and when only the record changes. The flag tells to keep
+        a copy of the file being replaced as a conflict.
+        """
+
+    @abc.abstractmethod
+    def begin(self):
+        pass
+
+    @abc.abstractmethod
+    def children(self, prefixes: Sequence[str]) -> Dict[str, str]:
+        # The hashes of the tree nodes below the given ones
+        pass
+
+    @abc.abstractmethod
+    def end(self):
+        pass
+
+    @abc.abstractmethod
+    def read(self, paths: Sequence[str]) -> Dict[str, bytes]:
+        pass
+
+    @abc.abstractmethod
+    def records(self, prefixes: Sequence[str]) -> Dict[str, Record]:
+        # The records of the files in the given leaves of the tree
+        pass
+
+
+class DirectoryReplica(Replica):
+    def __init__(self, directory: str):
+        self.directory = os.path.join(directory, "")
+        # Path relative to the directory -> [record, size, modification time in ns]
+        self._index = {}
+        self._locks = None
+        # Node prefix -> hash, and -> the prefixes of its children
+        self._tree = {}
+        self._tree_children = {}
+
+    def abort(self):
+        # Unlocks the directory without saving the index, if it's locked
+        if self._locks is not None:
+            self._locks.close()
+            self._locks = None
+
+    def apply(self, changes: Dict[str, Tuple[Record, Optional[bytes], bool]]):
+        service_directories = set()
+        for path, (record, contents, keep_conflict) in changes.items():
+            _check_path(path)
+            full_path = os.path.join(self.directory, path)
+            if keep_conflict and os.path.exists(full_path):
+                conflict_path = os.path.join(self.directory, _STATE_DIR, _CONFLICT_DIR, path)
+                os.makedirs(os.path.dirname(conflict_path), exist_ok=True)
+                os.replace(full_path, conflict_path)
+            if path.endswith(layout.SERVICE_FILE_EXT) and (contents is not None or record.file_hash is None):
+                service_directories.add(os.path.dirname(full_path))
+            if record.file_hash is None:
+                if os.path.exists(full_path):
+                    os.remove(full_path)
+                self._index[path] = [record, None, None]
+                continue
+            if contents is not None:
+                if hashlib.sha256(contents).hexdigest() != record.file_hash:
+                    raise ValueError("{} was corrupted on the way".format(path))
+                _write_file(full_path, contents)
+            stat = os.stat(full_path)
+            self._index[path] = [record, stat.st_size, stat.st_mtime_ns]
+        self._remove_manifests(service_directories)
+
+    def begin(self):
+        self._index = self._load_index()
+        main_accountnames = [filename[:-len(layout.MAIN_FILE_EXT)]
+                             for _, filename in self._walk() if filename.endswith(layout.MAIN_FILE_EXT)]
+        with contextlib.ExitStack() as locks:
+            locks.enter_context(locking.all_accounts(self.directory, main_accountnames, exclusive_lock=True))
+            self._refresh_index()
+            self._build_tree()
+            # Held until end()
+            self._locks = locks.pop_all()
+
+    def begun(self) -> bool:
+        return self._locks is not None
+
+    def _build_tree(self):
+        buckets = {}
+        for path, (record, _, _) in self._index.items():
+            buckets.setdefault(_leaf(path), []).append((path, record))
+
+        self._tree = {}
+        self._tree_children = {}
+        for prefix, entries in buckets.items():
+            leaf_hash = hashlib.sha256()
+            for path, record in sorted(entries, key=lambda entry: entry[0]):
+                leaf_hash.update("{}\0{}\0{}\n".format(path, record.file_hash, record.version).encode("utf-8"))
+            self._tree[prefix] = leaf_hash.hexdigest()
+        for length in range(TREE_DEPTH, 0, -1):
+            parents = {}
+            for prefix in [prefix for prefix in self._tree if len(prefix) == length]:
+                parents.setdefault(prefix[:-1], []).append(prefix)
+            for parent, children in parents.items():
+                children.sort()
+                self._tree_children[parent] = children
+                self._tree[parent] = hashlib.sha256("".join(child + self._tree[child]
+                                                            for child in children).encode("utf-8")).hexdigest()
+
+    def children(self, prefixes: Sequence[str]) -> Dict[str, str]:
+        return {child: self._tree[child]
+                for prefix in prefixes for child in self._tree_children.get(prefix, [])}
+
+    def end(self):
+        try:
+            self._save_index()
+        finally:
+            self._locks.close()
+            self._locks = None
+
+    def _index_path(self) -> str:
+        return os.path.join(self.directory, _STATE_DIR, _INDEX_FILE)
+
+    def _load_index(self) -> Dict[str, List]:
+        try:
+            with open(self._index_path()) as source:
+                entries = json.load(source)["files"]
+        except FileNotFoundError:
+            return {}
+        except (ValueError, KeyError) as e:
+            # Starting over only costs reading the files once
+            _logger.warning("The sync index of %s couldn't be read: %s", self.directory, e)
+            return {}
+        return {path: [Record(file_hash, version, synced_version), size, mtime]
+                for path, (file_hash, version, synced_version, size, mtime) in entries.items()}
+
+    def read(self, paths: Sequence[str]) -> Dict[str, bytes]:
+        contents = {}
+        for path in paths:
+            _check_path(path)
+            with open(os.path.join(self.directory, path), "rb") as source:
+                contents[path] = source.read()
+        return contents
+
+    def records(self, prefixes: Sequence[str]) -> Dict[str, Record]:
+        leaves = set(prefixes)
+        return {path: record for path, (record, _, _) in self._index.items() if _leaf(path) in leaves}
+
+    def _refresh_index(self):
+        # Hashes only the files whose size or modification time changed
+        seen = set()
+        for path, _ in self._walk():
+            full_path = os.path.join(self.directory, path)
+            try:
+                stat = os.stat(full_path)
+            except FileNotFoundError:
+                continue
+            seen.add(path)
+            entry = self._index.get(path)
+            if entry is not None and entry[1:] == [stat.st_size, stat.st_mtime_ns]:
+                continue
+            file_hash = _file_hash(full_path)
+            if entry is None:
+                record = Record(file_hash, 1, 0)
+            elif entry[0].file_hash != file_hash:
+                record = Record(file_hash, entry[0].version + 1, entry[0].synced_version)
+            else:
+                record = entry[0]
+            self._index[path] = [record, stat.st_size, stat.st_mtime_ns]
+
+        for path, entry in self._index.items():
+            if path not in seen and entry[0].file_hash is not None:
+                entry[0] = Record(None, entry[0].version + 1, entry[0].synced_version)
+                entry[1:] = [None, None]
+
+    def _remove_manifests(self, service_directories: Iterable[str]):
+        # A manifest is next to or above the service account files it lists.
+        # The root is the directory without the trailing separator.
+        root = os.path.dirname(self.directory)
+        directories = set()
+        for directory in service_directories:
+            while (directory == root or directory.startswith(self.directory)) and directory not in directories:
+                directories.add(directory)
+                directory = os.path.dirname(directory)
+        for directory in directories:
+            for entry_name in _entry_names(directory):
+                if entry_name.endswith(layout.MANIFEST_FILE_EXT):
+                    os.remove(os.path.join(directory, entry_name))
+                    _logger.info("Removed %s for the next login to rebuild it", entry_name)
+
+    def _save_index(self):
+        path = self._index_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entries = {file_path: [record.file_hash, record.version, record.synced_version, size, mtime]
+                   for file_path, (record, size, mtime) in self._index.items()}
+        temp_path = path + _TEMPORARY_FILE_EXT
+        with open(temp_path, "w") as target:
+            json.dump({"files": entries}, target)
+        os.replace(temp_path, path)
+
+    def _walk(self) -> Iterable[Tuple[str, str]]:
+        # Yields the path relative to the directory and the filename of every synced file
+        for directory, subdirectories, filenames in os.walk(self.directory):
+            if directory == self.directory:
+                subdirectories[:] = [name for name in subdirectories if name not in _EXCLUDED_DIRS]
+            for filename in filenames:
+                if (filename.endswith((layout.MANIFEST_FILE_EXT, _TEMPORARY_FILE_EXT)) or
+                        filename in _EXCLUDED_FILES):
+                    continue
+                path = os.path.relpath(os.path.join(directory, filename), self.directory)
+                yield path.replace(os.sep, "/"), filename
+
+
+class SocketReplica(Replica):
+    # A directory served by serve() in another process
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self._connection = None
+        self._answers = None
+
+    def apply(self, changes: Dict[str, Tuple[Record, Optional[bytes], bool]]):
+        self._request("apply", changes={path: [_record_fields(record), _encoded(contents), keep_conflict]
+                                        for path, (record, contents, keep_conflict) in changes.items()})
+
+    def begin(self):
+        # Refuses a server run by another user, who would get the files
+        self._connection = agent.connect(self.socket_path, _CLIENT_TIMEOUT)
+        self._answers = self._connection.makefile("rb")
+        self._request("begin")
+
+    def children(self, prefixes: Sequence[str]) -> Dict[str, str]:
+        return self._request("children", prefixes=list(prefixes))["hashes"]
+
+    def end(self):
+        try:
+            self._request("end")
+        finally:
+            self._answers.close()
+            self._connection.close()
+
+    def read(self, paths: Sequence[str]) -> Dict[str, bytes]:
+        return {path: base64.b64decode(contents)
+                for path, contents in self._request("read", paths=list(paths))["contents"].items()}
+
+    def records(self, prefixes: Sequence[str]) -> Dict[str, Record]:
+        return {path: Record(*fields)
+                for path, fields in self._request("records", prefixes=list(prefixes))["records"].items()}
+
+    def _request(self, command: str, **fields) -> Dict:
+        fields["command"] = command
+        self._connection.sendall(json.dumps(fields).encode("utf-8") + b"\n")
+        answer = self._answers.readline()
+        if answer == b"":
+            raise ConnectionError("The sync server closed the connection")
+        answer = json.loads(answer)
+        if not answer["ok"]:
+            raise OSError("The sync server refused: {}".format(answer["error"]))
+        return answer
+
+
+class _SyncServer(socketserver.UnixStreamServer):
+    # Serves one client at a time, who holds the directory's locks meanwhile
+    def __init__(self, socket_path: str, directory: str):
+        self.directory = directory
+        super().__init__(socket_path, _SyncRequestHandler)
+
+
+class _SyncRequestHandler(socketserver.StreamRequestHandler):
+    timeout = _CLIENT_TIMEOUT
+
+    def handle(self):
+        if not agent.same_user(self.request):
+            _logger.warning("Refused a sync connection from another user")
+            return
+        replica = DirectoryReplica(self.server.directory)
+        try:
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                    command = request["command"]
+                    answer = self._answer(replica, command, request)
+                except (KeyError, TypeError, ValueError, OSError) as e:
+                    command = None
+                    answer = _failure(str(e))
+                self.wfile.write(json.dumps(answer).encode("utf-8") + b"\n")
+                if command == "end":
+                    return
+        except (socket.timeout, ConnectionError):
+            _logger.info("Dropped a sync client that stopped talking")
+        finally:
+            # Unlocks the directory for the next client if this one didn't end
+            replica.abort()
+
+    @staticmethod
+    def _answer(replica: DirectoryReplica, command: str, request: Dict) -> Dict:
+        if command == "begin":
+            replica.begin()
+            return {"ok": True}
+        if not replica.begun():
+            return _failure("begin the sync first")
+        if command == "children":
+            return {"ok": True, "hashes": replica.children(request["prefixes"])}
+        if command == "records":
+            return {"ok": True, "records": {path: _record_fields(record)
+                                            for path, record in replica.records(request["prefixes"]).items()}}
+        if command == "read":
+            return {"ok": True, "contents": {path: _encoded(contents)
+                                             for path, contents in replica.read(request["paths"]).items()}}
+        if command == "apply":
+            replica.apply({path: (Record(*fields), _decoded(contents), keep_conflict)
+                           for path, (fields, contents, keep_conflict) in request["changes"].items()})
+            return {"ok": True}
+        if command == "end":
+            replica.end()
+            return {"ok": True}
+        return _failure("unknown command {}".format(command))
+
+
+def _check_path(path: str):
+    # The paths come from the other side, which mustn't reach outside the directory
+    parts = path.split("/")
+    if path.startswith("/") or ".." in parts or parts[0] in _EXCLUDED_DIRS:
+        raise ValueError("{} isn't a path in the accounts directory".format(path))
+
+
+def _decoded(contents: Optional[str]) -> Optional[bytes]:
+    return base64.b64decode(contents) if contents is not None else None
+
+
+def _decide(local: Optional[Record], remote: Optional[Record]) -> Tuple[Record, str, bool]:
+    """Returns the record both sides get, the side whose file it is ("local" or
+    "remote") and whether it was a conflict.
+    """
+    local = local or Record(None, 0, 0)
+    remote = remote or Record(None, 0, 0)
+    version = max(local.version, remote.version)
+    if local.file_hash == remote.file_hash:
+        return Record(local.file_hash, version, version), "local", False
+
+    if not local.changed_locally() and not remote.changed_locally():
+        # Passed on from elsewhere, the higher version is the newer
+        if local.version != remote.version:
+            winner = "local" if local.version > remote.version else "remote"
+            return _settled(local if winner == "local" else remote), winner, False
+    elif not remote.changed_locally() and local.synced_version >= remote.version:
+        return _settled(local), "local", False
+    elif not local.changed_locally() and remote.synced_version >= local.version:
+        return _settled(remote), "remote", False
+
+    # Changed on both sides since they last agreed
+    version += 1
+    if local.file_hash is None or remote.file_hash is None:
+        winner = "remote" if local.file_hash is None else "local"
+    else:
+        # Any rule will do as long as both sides pick the same file
+        winner = "local" if local.file_hash > remote.file_hash else "remote"
+    file_hash = local.file_hash if winner == "local" else remote.file_hash
+    return Record(file_hash, version, version), winner, True
+
+
+def default_socket_path() -> str:
+    return os.path.join(agent.socket_directory(), "sync.sock")
+
+
+def _differing_leaves(local: Replica, remote: Replica, result: SyncResult) -> List[str]:
+    # Descends the trees a level per round trip, only into the differing nodes
+    local_hashes = local.children([""])
+    remote_hashes = remote.children([""])
+    result.round_trips += 1
+    leaves = []
+    while True:
+        differing = sorted(prefix for prefix in local_hashes.keys() | remote_hashes.keys()
+                           if local_hashes.get(prefix) != remote_hashes.get(prefix))
+        leaves.extend(prefix for prefix in differing if len(prefix) == TREE_DEPTH)
+        branches = [prefix for prefix in differing if len(prefix) < TREE_DEPTH]
+        if len(branches) == 0:
+            return leaves
+        local_hashes = local.children(branches)
+        remote_hashes = remote.children(branches)
+        result.round_trips += 1
+
+
+def _encoded(contents: Optional[bytes]) -> Optional[str]:
+    return base64.b64encode(contents).decode("ascii") if contents is not None else None
+
+
+def _entry_names(directory: str) -> List[str]:
+    try:
+        return os.listdir(directory)
+    except FileNotFoundError:
+        return []
+
+
+def _failure(error: str) -> Dict:
+    return {"ok": False, "error": error}
+
+
+def _file_hash(path: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as source:
+        for chunk in iter(lambda: source.read(_CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def _lacks(current: Optional[Record], record: Record) -> bool:
+    # Whether a side with the current record needs the file of the given one
+    return record.file_hash is not None and (current is None or current.file_hash != record.file_hash)
+
+
+def _leaf(path: str) -> str:
+    return hashlib.sha256(path.encode("utf-8")).hexdigest()[:TREE_DEPTH]
+
+
+def _record_fields(record: Record) -> List:
+    return [record.file_hash, record.version, record.synced_version]
+
+
+def serve(directory: str, socket_path: str) -> Optional[str]:
+    """Serves the directory until interrupted. Returns the error that prevented
+    serving, if any.
+    """
+    try:
+        agent.prepare_socket_directory(socket_path)
+    except OSError as e:
+        return str(e)
+    if os.path.exists(socket_path):
+        try:
+            agent.connect(socket_path, _CLIENT_TIMEOUT).close()
+            return "another server is already listening on {}".format(socket_path)
+        except OSError:
+            # Left behind by a server that didn't exit cleanly
+            os.remove(socket_path)
+
+    previous_umask = os.umask(0o177)
+    try:
+        server = _SyncServer(socket_path, directory)
+    finally:
+        os.umask(previous_umask)
+    _logger.info("Serving %s for syncing on %s", directory, socket_path)
+    try:
+        with server:
+            server.serve_forever()
+    finally:
+        os.remove(socket_path)
+    return None
+
+
+def _settled(record: Record) -> Record:
+    # Both sides agree on the record from now on
+    return Record(record.file_hash, record.version, record.version)
+
+
+def sync(local: Replica, remote: Replica) -> SyncResult:
+    """Makes both sides hold the same files. Raises OSError if either side
+    can't be read or written, ValueError if a file is corrupted on the way.
+    """
+    result = SyncResult()
+    local.begin()
+    try:
+        remote.begin()
+        result.round_trips += 1
+        try:
+            _sync(local, remote, result)
+        finally:
+            remote.end()
+            result.round_trips += 1
+    finally:
+        local.end()
+    _logger.info("Synced %s files out and %s in with %s conflicts in %s round trips",
+                 result.sent, result.received, len(result.conflicts), result.round_trips)
+    return result
+
+
+def _sync(local: Replica, remote: Replica, result: SyncResult):
+    leaves = _differing_leaves(local, remote, result)
+    if len(leaves) == 0:
+        return
+    local_records = local.records(leaves)
+    remote_records = remote.records(leaves)
+    result.round_trips += 1
+
+    decisions = {}
+    for path in sorted(local_records.keys() | remote_records.keys()):
+        local_record = local_records.get(path)
+        remote_record = remote_records.get(path)
+        record, winner, conflict = _decide(local_record, remote_record)
+        decisions[path] = (record, winner, conflict, local_record, remote_record)
+        if conflict:
+            result.conflicts.append(path)
+
+    # Only the files the other side lacks are read
+    to_remote = [path for path, (record, winner, _, _, remote_record) in decisions.items()
+                 if winner == "local" and _lacks(remote_record, record)]
+    to_local = [path for path, (record, winner, _, local_record, _) in decisions.items()
+                if winner == "remote" and _lacks(local_record, record)]
+    local_contents = local.read(to_remote) if len(to_remote) != 0 else {}
+    remote_contents = remote.read(to_local) if len(to_local) != 0 else {}
+    if len(to_local) != 0:
+        result.round_trips += 1
+
+    local_changes = {}
+    remote_changes = {}
+    for path, (record, winner, conflict, _, _) in decisions.items():
+        # The losing side of a conflict keeps its file
+        local_changes[path] = (record, remote_contents.get(path), conflict and winner == "remote")
+        remote_changes[path] = (record, local_contents.get(path), conflict and winner == "local")
+    local.apply(local_changes)
+    remote.apply(remote_changes)
+    result.round_trips += 1
+    result.sent = len(to_remote)
+    result.received = len(to_local)
+
+
+def _write_file(path: str, contents: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + _TEMPORARY_FILE_EXT
+    with open(temp_path, "wb") as target:
+        target.write(contents)
+        target.flush()
+        os.fsync(target.fileno())
+    os.replace(temp_path, path)
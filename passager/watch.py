@@ -0,0 +1,259 @@
+#!/bin/python3
+"""
+Watch module tells which files in a set of directories have changed since it was
+last asked, so that a running session can pick up what other processes wrote
+without going through every file again. Directories are given along with
+whether their subdirectories, e.g. the shard directories, are watched as well.
+
+On Linux the kernel reports the changes through inotify and asking costs
+nothing when nothing has changed. Elsewhere the directories are compared with
+a snapshot of their entries. Service account files are written once and then
+only ever removed, so the snapshot rescans only the directories whose
+modification time changed and otherwise just checks the other files' sizes and
+modification times again.
+"""
+import abc
+import logging
+import os
+import struct
+import sys
+
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import passager.layout as layout
+
+from passager.lazy import lazy_import
+
+# Only the inotify watcher needs it
+ctypes = lazy_import("ctypes")
+
+_IN_CLOEXEC = 0o2000000
+_IN_NONBLOCK = 0o4000
+_IN_MODIFY = 0x2
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_DELETE_SELF = 0x400
+_IN_MOVE_SELF = 0x800
+_IN_Q_OVERFLOW = 0x4000
+_IN_IGNORED = 0x8000
+_IN_ONLYDIR = 0x1000000
+_IN_ISDIR = 0x40000000
+_EVENT = struct.Struct("iIII")
+_MASK = (_IN_MODIFY | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE |
+         _IN_DELETE_SELF | _IN_MOVE_SELF | _IN_ONLYDIR)
+_READ_SIZE = 64 * 1024
+
+_logger = logging.getLogger(__name__)
+
+
+class Watcher(abc.ABC):
+    def __init__(self, directories: Sequence[Tuple[str, bool]]):
+        # (directory, whether its subdirectories are watched too)
+        self.directories = list(directories)
+
+    @abc.abstractmethod
+    def changes(self) -> Optional[Set[str]]:
+        """Returns the names of the files added, removed or modified since the
+        previous call or since watching began. None if that can't be told, in
+        which case anything may have changed.
+        """
+
+    def close(self):
+        pass
+
+
+class _InotifyWatcher(Watcher):
+    def __init__(self, directories: Sequence[Tuple[str, bool]], libc):
+        super().__init__(directories)
+        self._libc = libc
+        self._fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # Watch descriptor -> (directory, whether its subdirectories are watched)
+        self._watches = {}
+        # The directories that didn't exist yet, watched once they do
+        self._missing = []
+        self._overflowed = False
+        for directory, recursive in self.directories:
+            self._add_root(directory, recursive)
+
+    def _add(self, directory: str, recursive: bool) -> bool:
+        descriptor = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), _MASK)
+        if descriptor < 0:
+            return False
+        self._watches[descriptor] = (directory, recursive)
+        return True
+
+    def _add_root(self, directory: str, recursive: bool) -> Set[str]:
+        # Returns the files already in the directory
+        if not self._add(directory, recursive):
+            self._missing.append((directory, recursive))
+            return set()
+        names = set()
+        for entry_path, is_directory in _entries(directory):
+            if is_directory and recursive:
+                names |= self._add_subdirectory(entry_path)
+            elif not is_directory:
+                names.add(os.path.basename(entry_path))
+        return names
+
+    def _add_subdirectory(self, directory: str) -> Set[str]:
+        # Files may have been written into it before the watch was added
+        if not self._add(directory, False):
+            return set()
+        return {os.path.basename(entry_path)
+                for entry_path, is_directory in _entries(directory) if not is_directory}
+
+    def changes(self) -> Optional[Set[str]]:
+        names = set()
+        missing = self._missing
+        self._missing = []
+        for directory, recursive in missing:
+            names |= self._add_root(directory, recursive)
+
+        while True:
+            try:
+                data = os.read(self._fd, _READ_SIZE)
+            except BlockingIOError:
+                break
+            names |= self._handle_events(data)
+
+        if self._overflowed:
+            self._overflowed = False
+            return None
+        return names
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _handle_events(self, data: bytes) -> Set[str]:
+        names = set()
+        offset = 0
+        while offset < len(data):
+            descriptor, mask, _, name_length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(data[offset:offset + name_length].rstrip(b"\0"))
+            offset += name_length
+
+            if mask & _IN_Q_OVERFLOW:
+                # Events were dropped
+                self._overflowed = True
+                continue
+            watched = self._watches.get(descriptor)
+            if watched is None:
+                continue
+            directory, recursive = watched
+            if mask & _IN_IGNORED:
+                del self._watches[descriptor]
+                if (directory, recursive) in self.directories:
+                    self._missing.append((directory, recursive))
+            elif mask & (_IN_DELETE_SELF | _IN_MOVE_SELF):
+                # The files in it are reported as removed by their own events
+                continue
+            elif mask & _IN_ISDIR:
+                if recursive and mask & (_IN_CREATE | _IN_MOVED_TO):
+                    names |= self._add_subdirectory(os.path.join(directory, name, ""))
+            elif name:
+                names.add(name)
+        return names
+
+
+class _SnapshotWatcher(Watcher):
+    def __init__(self, directories: Sequence[Tuple[str, bool]]):
+        super().__init__(directories)
+        # Directory -> (its modification time, {file name: (size, modification time)})
+        self._snapshots = {}
+        self._take_snapshots()
+
+    def changes(self) -> Optional[Set[str]]:
+        previous = self._snapshots
+        self._snapshots = {}
+        self._take_snapshots(previous)
+
+        names = set()
+        for directory in previous.keys() | self._snapshots.keys():
+            old_files = previous.get(directory, (None, {}))[1]
+            new_files = self._snapshots.get(directory, (None, {}))[1]
+            names.update(name for name in old_files.keys() | new_files.keys()
+                         if old_files.get(name) != new_files.get(name))
+        return names
+
+    def _snapshot(self, directory: str, previous: Optional[Tuple]) -> Optional[Tuple]:
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        if previous is not None and previous[0] == mtime:
+            # Nothing was added or removed, only files written in place may differ
+            files = dict(previous[1])
+            for name in files:
+                if not name.endswith(layout.SERVICE_FILE_EXT):
+                    files[name] = _file_signature(os.path.join(directory, name))
+            return mtime, files
+        files = {}
+        for entry_path, is_directory in _entries(directory):
+            if not is_directory:
+                files[os.path.basename(entry_path)] = _file_signature(entry_path)
+        return mtime, files
+
+    def _take_snapshots(self, previous: Dict = None):
+        previous = previous or {}
+        for directory, recursive in self.directories:
+            snapshot = self._snapshot(directory, previous.get(directory))
+            if snapshot is None:
+                continue
+            self._snapshots[directory] = snapshot
+            if recursive:
+                for subdirectory in _subdirectories(directory):
+                    subdirectory_snapshot = self._snapshot(subdirectory, previous.get(subdirectory))
+                    if subdirectory_snapshot is not None:
+                        self._snapshots[subdirectory] = subdirectory_snapshot
+
+
+def _entries(directory: str) -> List[Tuple[str, bool]]:
+    # (path, whether it's a directory) of the directory's entries
+    try:
+        with os.scandir(directory) as entries:
+            return [(os.path.join(entry.path, "") if entry.is_dir() else entry.path, entry.is_dir())
+                    for entry in entries]
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+
+def _file_signature(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _inotify():
+    # The C library if it offers inotify, None otherwise
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+def _subdirectories(directory: str) -> List[str]:
+    return [path for path, is_directory in _entries(directory) if is_directory]
+
+
+def watch(directories: Sequence[Tuple[str, bool]]) -> Watcher:
+    libc = _inotify()
+    if libc is not None:
+        try:
+            return _InotifyWatcher(directories, libc)
+        except OSError as e:
+            _logger.warning("Falling back to comparing directory snapshots: %s", e)
+    return _SnapshotWatcher(directories)